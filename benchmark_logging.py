@@ -0,0 +1,78 @@
+''' The CPU time of the event loop's thread spent logging a simulated incoming request: its
+log id, the receiving log line, and four logged blocks, at each log level and sample rate,
+and for comparison, with the synchronous StreamHandler used before logging through a queue.
+Run with stdout discarded, so only the results, written to stderr, are output
+
+    python benchmark_logging.py > /dev/null
+'''
+
+import logging
+import sys
+import time
+
+from shared.logger import (
+    configure_root_logger,
+    get_child_logger,
+    get_root_logger,
+    logged,
+)
+from shared.utils import (
+    random_log_id,
+)
+
+NUM_REQUESTS = 20000
+
+
+def configure_synchronous_logger(level, _):
+    ''' The logging before the queue, each record formatted and written to stdout by the
+    thread that logs it, and no sampling '''
+    app_logger, listener = configure_root_logger(level, 1.0)
+    listener.stop()
+    for handler in list(app_logger.handlers):
+        app_logger.removeHandler(handler)
+    app_logger.addHandler(logging.StreamHandler(sys.stdout))
+    return app_logger, None
+
+
+CONFIGURATIONS = [
+    ('synchronous', configure_synchronous_logger, 'DEBUG', 1.0),
+    ('queue', configure_root_logger, 'DEBUG', 1.0),
+    ('queue', configure_root_logger, 'DEBUG', 0.1),
+    ('queue', configure_root_logger, 'INFO', 1.0),
+]
+
+
+def simulate_request(logger):
+    request_logger = get_child_logger(logger, random_log_id())
+    request_logger.debug('Receiving request (%s) (%s %s HTTP/%s.%s) (%s) (%s)',
+                         '127.0.0.1', 'GET', '/v1/', 1, 1, 'benchmark', '1.2.3.4, 127.0.0.1')
+    for i in range(0, 4):
+        with logged(request_logger, 'Elasticsearch request by (%s) to (%s) (%s) (%s) (%s)',
+                    ['some-id', 'http://127.0.0.1:9200', 'GET', '/activities/_search', {'i': i}]):
+            pass
+
+
+def main():
+    logger = get_root_logger('benchmark')
+    for name, configure, level, sample_rate in CONFIGURATIONS:
+        app_logger, listener = configure(level, sample_rate)
+
+        start = time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+        for _ in range(0, NUM_REQUESTS):
+            simulate_request(logger)
+        end = time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+
+        if listener is not None:
+            listener.stop()
+        for handler in list(app_logger.handlers):
+            app_logger.removeHandler(handler)
+
+        print(f'{name}, {level}, sample rate {sample_rate}: '
+              f'{(end - start) / NUM_REQUESTS * 1000000:.0f}us per request',
+              file=sys.stderr)
+
+    logging.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,12 @@
+import asyncio
+import collections
 import datetime
+import math
+import random
+import re
 import time
 
+import aiohttp
 from aiohttp.web import (
     HTTPNotFound,
 )
@@ -14,16 +20,46 @@ from shared.utils import (
     random_url_safe,
 )
 
+from .app_metrics import (
+    metric_timer,
+)
 from .app_redis import (
     get_private_scroll_id,
 )
 from .app_utils import (
+    async_repeat_until_cancelled,
     flatten,
     flatten_generator,
+    get_child_context,
+    sleep,
 )
 
 ALIAS = 'activities'
 
+# A node is not sent requests for ES_EJECTION_INTERVAL seconds after an error, unless
+# all nodes are ejected, or it was ejected for not responding and a probe finds it
+# responding sooner. A node ejected for a 5xx usually still responds to the probe, so is
+# left ejected until the interval ends
+ES_EJECTION_INTERVAL = 10
+ES_PROBE_RESTORED_REASONS = ('connection', 'timeout')
+ES_PROBE_INTERVAL = 2
+ES_PROBE_TIMEOUT = 5
+ES_REFRESH_INTERVAL = 1
+ES_HEALTH_TIMEOUT = '30s'
+ES_HEALTH_WAIT_MAX = 600
+
+# For a feed's first index, when there is no previous index to base the number of shards on
+ES_DEFAULT_NUMBER_OF_SHARDS = 4
+
+ES_ALIASES_INTERVAL = 10
+
+# Keyword fields that a search can be narrowed on, when filtered to exact values of them
+ES_DIT_APPLICATION_FIELDS = ['dit:application.keyword']
+
+# Matches the names from get_new_index_name, capturing the feed unique id
+ES_INDEX_NAME_REGEX = \
+    f'^{ALIAS}__feed_id_(.+)__date_\\d{{4}}-\\d{{2}}-\\d{{2}}__timestamp_\\d+__batch_id_'
+
 
 def get_new_index_name(feed_unique_id):
     today = datetime.date.today().isoformat()
@@ -40,6 +76,11 @@ def get_new_index_name(feed_unique_id):
         f'batch_id_{unique}__'
 
 
+def get_feed_alias(feed_unique_id):
+    # Not ending in __, so not matched by the patterns that match the feed's indexes
+    return f'{ALIAS}__feed_id_{feed_unique_id}'
+
+
 def indexes_matching_feeds(index_names, feed_unique_ids):
     return flatten([
         indexes_matching_feed(index_names, feed_unique_id)
@@ -55,6 +96,17 @@ def indexes_matching_feed(index_names, feed_unique_id):
     ]
 
 
+def indexes_by_feed(index_names):
+    ''' The index names grouped by the unique id of their feed. Names not of the form from
+    get_new_index_name are skipped '''
+    grouped = collections.defaultdict(list)
+    for index_name in index_names:
+        match = re.match(ES_INDEX_NAME_REGEX, index_name)
+        if match:
+            grouped[match[1]].append(index_name)
+    return grouped
+
+
 def indexes_matching_no_feeds(index_names, feed_unique_ids):
     indexes_matching = indexes_matching_feeds(index_names, feed_unique_ids)
     return [
@@ -97,10 +149,13 @@ async def add_remove_aliases_atomically(context, es_endpoint, index_name,
     with logged(context.logger, 'Atomically flipping {ALIAS} alias to (%s)',
                 [feed_unique_id]):
         remove_pattern = f'{ALIAS}__feed_id_{feed_unique_id}__*'
+        feed_alias = get_feed_alias(feed_unique_id)
         actions = ujson.dumps({
             'actions': [
                 {'remove': {'index': remove_pattern, 'alias': ALIAS}},
-                {'add': {'index': index_name, 'alias': ALIAS}}
+                {'remove': {'index': remove_pattern, 'alias': feed_alias}},
+                {'add': {'index': index_name, 'alias': ALIAS}},
+                {'add': {'index': index_name, 'alias': feed_alias}},
             ]
         }).encode('utf-8')
 
@@ -129,30 +184,64 @@ async def delete_indexes(context, es_endpoint, index_names):
             )
 
 
-async def create_index(context, es_endpoint, index_name):
-    with logged(context.logger, 'Creating index (%s)', [index_name]):
+async def get_number_of_shards(context, es_endpoint, index_names, index_config):
+    if not index_names:
+        return ES_DEFAULT_NUMBER_OF_SHARDS
+
+    with logged(context.logger, 'Finding size of indexes (%s)', [index_names]):
+        results = await es_request_non_200_exception(
+            context=context,
+            endpoint=es_endpoint,
+            method='GET',
+            path=f'/_cat/indices/{",".join(index_names)}',
+            query={'format': 'json', 'bytes': 'b', 'h': 'index,docs.count,pri.store.size'},
+            headers={'Content-Type': 'application/json'},
+            payload=b'',
+        )
+        indexes = await results.json()
+
+    number_of_shards = number_of_shards_for_size(indexes, index_config)
+    context.logger.debug('Finding size of indexes... (%s)', number_of_shards)
+    return number_of_shards
+
+
+def number_of_shards_for_size(indexes, index_config):
+    ''' The number of shards so each has at most around the target bytes and documents,
+    assuming the new index will be the size of the previous indexes, as returned by
+    _cat/indices '''
+    # The sizes are null if the index's primary shards aren't allocated
+    num_bytes = sum(int(index['pri.store.size'] or 0) for index in indexes)
+    num_docs = sum(int(index['docs.count'] or 0) for index in indexes)
+    return max(1, min(index_config.max_shards, max(
+        math.ceil(num_bytes / index_config.shard_target_bytes),
+        math.ceil(num_docs / index_config.shard_target_docs),
+    )))
+
+
+async def create_index(context, es_endpoint, index_name, number_of_shards, mappings):
+    ''' The index is created to be bulk loaded: it's not searchable until the alias is added,
+    so it has no replicas and its translog isn't synced on every request. This is reversed
+    by restore_index_durability '''
+    with logged(context.logger, 'Creating index (%s) (%s)', [index_name, number_of_shards]):
         index_definition = ujson.dumps({
             'settings': {
                 'index': {
-                    'number_of_shards': 4,
-                    'number_of_replicas': 1,
+                    'number_of_shards': number_of_shards,
+                    'number_of_replicas': 0,
                     'refresh_interval': '-1',
+                    'translog': {
+                        'durability': 'async',
+                    },
+                    # Searches sorted the same way, such as for the latest activities, can
+                    # stop on each segment once they have enough
+                    'sort': {
+                        'field': ['published', 'id'],
+                        'order': ['desc', 'desc'],
+                    },
                 }
             },
             'mappings': {
-                '_doc': {
-                    'properties': {
-                        'published_date': {
-                            'type': 'date',
-                        },
-                        'type': {
-                            'type': 'keyword',
-                        },
-                        'object.type': {
-                            'type': 'keyword',
-                        },
-                    },
-                },
+                '_doc': mappings,
             },
         }, escape_forward_slashes=False, ensure_ascii=False).encode('utf-8')
         await es_request_non_200_exception(
@@ -166,6 +255,94 @@ async def create_index(context, es_endpoint, index_name):
         )
 
 
+async def restore_index_durability(context, es_endpoint, index_name, number_of_replicas):
+    with logged(context.logger, 'Restoring durability of index (%s) (%s)',
+                [index_name, number_of_replicas]):
+        settings = ujson.dumps({
+            'index': {
+                'number_of_replicas': number_of_replicas,
+                'translog': {
+                    'durability': 'request',
+                },
+            },
+        }).encode('utf-8')
+        await es_request_non_200_exception(
+            context=context,
+            endpoint=es_endpoint,
+            method='PUT',
+            path=f'/{index_name}/_settings',
+            query={},
+            headers={'Content-Type': 'application/json'},
+            payload=settings,
+        )
+
+
+async def wait_for_index_health(context, es_endpoint, index_name, number_of_replicas):
+    ''' Waits for green, or for yellow if there are too few nodes for the replicas to be
+    allocated, in which case the index would never be green '''
+    with logged(context.logger, 'Waiting for health of index (%s)', [index_name]):
+        cluster_health_result = await es_request_non_200_exception(
+            context=context,
+            endpoint=es_endpoint,
+            method='GET',
+            path='/_cluster/health',
+            query={},
+            headers={'Content-Type': 'application/json'},
+            payload=b'',
+        )
+        number_of_data_nodes = (await cluster_health_result.json())['number_of_data_nodes']
+        status = \
+            'green' if number_of_replicas < number_of_data_nodes else \
+            'yellow'
+        if status != 'green':
+            context.logger.warning(
+                'Too few nodes (%s) for replicas (%s), waiting for (%s)',
+                number_of_data_nodes, number_of_replicas, status)
+
+        # Elasticsearch responds with a 408 if the status isn't reached by the timeout, and
+        # the request is repeated until the status is reached, or ES_HEALTH_WAIT_MAX overall
+        async def wait_for_status():
+            while True:
+                index_health_result = await es_request(
+                    context=context,
+                    endpoint=es_endpoint,
+                    method='GET',
+                    path=f'/_cluster/health/{index_name}',
+                    query={'wait_for_status': status, 'timeout': ES_HEALTH_TIMEOUT},
+                    headers={'Content-Type': 'application/json'},
+                    payload=b'',
+                )
+                if index_health_result.status == 200:
+                    break
+                if index_health_result.status != 408:
+                    raise Exception(await index_health_result.text())
+
+        try:
+            await asyncio.wait_for(wait_for_status(), ES_HEALTH_WAIT_MAX)
+        except asyncio.TimeoutError as exception:
+            raise ESUnavailable(
+                f'Index ({index_name}) not ({status}) after ({ES_HEALTH_WAIT_MAX}) seconds'
+            ) from exception
+
+
+async def force_merge_index(context, es_endpoint, index_name, max_num_segments):
+    with logged(context.logger, 'Force merging index (%s) (%s)',
+                [index_name, max_num_segments]):
+        try:
+            await es_request_non_200_exception(
+                context=context,
+                endpoint=es_endpoint,
+                method='POST',
+                path=f'/{index_name}/_forcemerge',
+                query={'max_num_segments': str(max_num_segments)},
+                headers={'Content-Type': 'application/json'},
+                payload=b'',
+            )
+        except asyncio.TimeoutError:
+            # Elasticsearch continues the merge, and the index is usable while it does
+            context.logger.warning('Timed out force merging index (%s)', index_name)
+
+
 async def refresh_index(context, es_endpoint, index_name):
     with logged(context.logger, 'Refreshing index (%s)', [index_name]):
         await es_request_non_200_exception(
@@ -179,8 +356,194 @@ async def refresh_index(context, es_endpoint, index_name):
         )
 
 
-async def es_search_new_scroll(_, __, query):
-    return f'/{ALIAS}/_search', {'scroll': '15s'}, query
+def es_get_refresh_queue():
+    return {
+        # The time each index was first requested to be refreshed since its last refresh
+        'index_names': collections.OrderedDict(),
+        'has_index_names': asyncio.Event(),
+    }
+
+
+def refresh_indexes_later(context, index_names):
+    ''' Fire-and-forget refresh, coalesced with others into a single refresh of all the
+    indexes requested within the refresh interval '''
+    refresh_queue = context.es_refresh_queue
+    now = time.monotonic()
+    for index_name in index_names:
+        refresh_queue['index_names'].setdefault(index_name, now)
+    if index_names:
+        refresh_queue['has_index_names'].set()
+
+
+def create_es_refresher(parent_context, es_endpoint, refresh_interval, exception_intervals):
+    ''' Refreshes at most once per refresh_interval, so that is the maximum delay between
+    a refresh being requested and its start, plus the time of any previous refresh '''
+    context = get_child_context(parent_context, 'elasticsearch-refresh')
+    refresh_queue = context.es_refresh_queue
+
+    async def refresh_indexes():
+        await refresh_queue['has_index_names'].wait()
+        await sleep(context, refresh_interval)
+
+        refresh_queue['has_index_names'].clear()
+        index_names_requested = list(refresh_queue['index_names'].items())
+        refresh_queue['index_names'].clear()
+        index_names = [index_name for index_name, _ in index_names_requested]
+
+        try:
+            with logged(context.logger, 'Refreshing indexes (%s)', [index_names]):
+                await es_request_non_200_exception(
+                    context=context,
+                    endpoint=es_endpoint,
+                    method='POST',
+                    path=f'/{",".join(index_names)}/_refresh',
+                    query={'ignore_unavailable': 'true'},
+                    headers={'Content-Type': 'application/json'},
+                    payload=b'',
+                )
+        except BaseException:
+            # Requested again, at their original times, so the delay is measured correctly
+            for index_name, requested in index_names_requested:
+                refresh_queue['index_names'].setdefault(index_name, requested)
+            refresh_queue['has_index_names'].set()
+            raise
+
+        now = time.monotonic()
+        for _, requested in index_names_requested:
+            context.metrics['elasticsearch_refresh_delay_seconds'].observe(now - requested)
+
+    asyncio.get_event_loop().create_task(
+        async_repeat_until_cancelled(context, exception_intervals, refresh_indexes)
+    )
+
+
+def get_es_search_new_scroll(feed_dit_applications, es_aliases):
+    ''' Searches only the feeds that can have activities matching the query, through their
+    per-feed aliases. feed_dit_applications is the applications each feed declares its
+    activities are from, or None if it doesn't '''
+    async def es_search_new_scroll(_, __, query):
+        feed_aliases = es_search_feed_aliases(feed_dit_applications, es_aliases, query)
+        return \
+            (f'/{",".join(feed_aliases)}/_search',
+             {'scroll': '15s', 'ignore_unavailable': 'true'}, query) if feed_aliases else \
+            (f'/{ALIAS}/_search', {'scroll': '15s'}, query)
+
+    return es_search_new_scroll
+
+
+def es_search_feed_aliases(feed_dit_applications, es_aliases, query):
+    ''' The per-feed aliases to search instead of ALIAS, or None if it can't be shown they
+    have all the activities the query matches '''
+    dit_applications = _es_query_dit_applications(query)
+    if dit_applications is None:
+        return None
+
+    # Each searchable index must be aliased by a configured feed, otherwise its activities
+    # could be from any application. A feed alias only moves with ALIAS, so is always on the
+    # same index, and so can be searched even if it was added after es_aliases was fetched
+    feed_aliases = {
+        get_feed_alias(feed_unique_id): applications
+        for feed_unique_id, applications in feed_dit_applications.items()
+    }
+    aliases_by_index = es_aliases['aliases_by_index']
+    if any(ALIAS in aliases and not any(alias in feed_aliases for alias in aliases)
+           for aliases in aliases_by_index.values()):
+        return None
+
+    matching_feed_aliases = sorted(
+        feed_alias
+        for feed_alias, applications in feed_aliases.items()
+        if applications is None or dit_applications & set(applications)
+    )
+    is_any_searchable = any(
+        feed_alias in aliases
+        for aliases in aliases_by_index.values()
+        for feed_alias in matching_feed_aliases
+    )
+    return matching_feed_aliases if is_any_searchable else None
+
+
+def _es_query_dit_applications(query):
+    ''' The set of dit:application values that each activity matching the query must have one
+    of, or None if the query isn't recognised as restricting them '''
+    try:
+        query = ujson.loads(query)['query']
+    except (ValueError, KeyError, TypeError):
+        return None
+    return _es_clause_dit_applications(query)
+
+
+def _es_clause_dit_applications(clause):
+    if not isinstance(clause, dict) or len(clause) != 1:
+        return None
+    (clause_type, params), = clause.items()
+    if not isinstance(params, dict):
+        return None
+
+    # Each filter and must clause of a bool query must match, regardless of the others
+    if clause_type == 'bool':
+        sub_clauses = [
+            sub_clause
+            for occur in ['filter', 'must']
+            for occur_clauses in [params.get(occur, [])]
+            for sub_clause in (
+                occur_clauses if isinstance(occur_clauses, list) else [occur_clauses]
+            )
+        ]
+        restricted = [
+            dit_applications
+            for dit_applications in map(_es_clause_dit_applications, sub_clauses)
+            if dit_applications is not None
+        ]
+        return set.intersection(*restricted) if restricted else None
+
+    values = [params[field] for field in ES_DIT_APPLICATION_FIELDS if field in params]
+    if len(values) != 1:
+        return None
+    value = values[0]
+
+    if clause_type == 'term':
+        value = value.get('value') if isinstance(value, dict) else value
+        return {value} if isinstance(value, str) else None
+
+    if clause_type == 'terms':
+        is_strings = isinstance(value, list) and all(isinstance(v, str) for v in value)
+        return set(value) if is_strings else None
+
+    return None
+
+
+def get_es_aliases():
+    ''' The aliases of each activities index, as last fetched from Elasticsearch '''
+    return {
+        'aliases_by_index': {},
+    }
+
+
+def create_es_aliases_poller(parent_context, es_endpoint, es_aliases, exception_intervals):
+    context = get_child_context(parent_context, 'elasticsearch-aliases')
+
+    async def poll_aliases():
+        results = await es_request_non_200_exception(
+            context=context,
+            endpoint=es_endpoint,
+            method='GET',
+            path='/_aliases',
+            query={},
+            headers={'Content-Type': 'application/json'},
+            payload=b'',
+        )
+        indexes = await results.json()
+        es_aliases['aliases_by_index'] = {
+            index_name: list(index_details['aliases'].keys())
+            for index_name, index_details in indexes.items()
+            if index_name.startswith(f'{ALIAS}_')
+        }
+        await sleep(context, ES_ALIASES_INTERVAL)
+
+    asyncio.get_event_loop().create_task(
+        async_repeat_until_cancelled(context, exception_intervals, poll_aliases)
+    )
 
 
 async def es_search_existing_scroll(context, match_info, _):
@@ -203,22 +566,37 @@ async def es_search_existing_scroll(context, match_info, _):
 
 
 async def es_search(context, es_endpoint, path, query, body, headers, to_public_scroll_url):
-    results = await es_request(
-        context=context,
-        endpoint=es_endpoint,
-        method='GET',
-        path=path,
-        query=query,
-        headers=headers,
-        payload=body,
-    )
+    with metric_timer(context.metrics['http_request_stage_duration_seconds'],
+                      ['elasticsearch']):
+        results = await es_request(
+            context=context,
+            endpoint=es_endpoint,
+            method='GET',
+            path=path,
+            query=query,
+            headers=headers,
+            payload=body,
+        )
+        response = await results.json()
+
+    if 'took' in response:
+        context.metrics['elasticsearch_took_seconds'].observe(response['took'] / 1000)
+    if '_shards' in response:
+        context.metrics['elasticsearch_search_shards'].labels(_es_search_route(path)).observe(
+            response['_shards']['total'])
 
-    response = await results.json()
     return \
         (await activities(response, to_public_scroll_url), 200) if results.status == 200 else \
         (response, results.status)
 
 
+def _es_search_route(path):
+    return \
+        'scroll' if path == '/_search/scroll' else \
+        'alias' if path == f'/{ALIAS}/_search' else \
+        'feeds'
+
+
 async def activities(elasticsearch_reponse, to_public_scroll_url):
     elasticsearch_hits = elasticsearch_reponse['hits'].get('hits', [])
     private_scroll_id = elasticsearch_reponse['_scroll_id']
@@ -242,26 +620,76 @@ async def activities(elasticsearch_reponse, to_public_scroll_url):
 
 
 async def es_bulk(context, es_endpoint, items):
+    ''' Returns the positions of the items that Elasticsearch rejected '''
     with logged(context.logger, 'Pushing (%s) items into Elasticsearch', [len(items)]):
         if not items:
-            return
-
-        with logged(context.logger, 'Converting to Elasticsearch bulk ingest commands', []):
-            es_bulk_contents = ''.join(flatten_generator(
-                [ujson.dumps(item['action_and_metadata'], sort_keys=True,
-                             escape_forward_slashes=False, ensure_ascii=False),
-                 '\n',
-                 ujson.dumps(item['source'], sort_keys=True,
-                             escape_forward_slashes=False, ensure_ascii=False),
-                 '\n']
-                for item in items
-            )).encode('utf-8')
-
-        with logged(context.logger, 'POSTing bulk ingest to Elasticsearch', []):
-            await es_request_non_200_exception(
-                context=context, endpoint=es_endpoint, method='POST', path='/_bulk', query={},
-                headers={'Content-Type': 'application/x-ndjson'}, payload=es_bulk_contents,
-            )
+            return []
+
+        es_bulk_contents = get_es_bulk_contents(context, items)
+        return await es_bulk_contents_post(context, es_endpoint, es_bulk_contents)
+
+
+def get_es_bulk_contents(context, items):
+    with logged(context.logger, 'Converting to Elasticsearch bulk ingest commands', []):
+        return ''.join(flatten_generator(
+            [ujson.dumps(item['action_and_metadata'], sort_keys=True,
+                         escape_forward_slashes=False, ensure_ascii=False),
+             '\n',
+             ujson.dumps(item['source'], sort_keys=True,
+                         escape_forward_slashes=False, ensure_ascii=False),
+             '\n']
+            for item in items
+        )).encode('utf-8')
+
+
+async def es_bulk_contents_post(context, es_endpoint, es_bulk_contents):
+    ''' Returns the positions of the bulk ingest commands that Elasticsearch rejected '''
+    with logged(context.logger, 'POSTing bulk ingest to Elasticsearch', []):
+        results = await es_request_non_200_exception(
+            context=context, endpoint=es_endpoint, method='POST', path='/_bulk', query={},
+            headers={'Content-Type': 'application/x-ndjson'}, payload=es_bulk_contents,
+        )
+        return es_bulk_rejected_positions(ujson.loads(await results.text()))
+
+
+def es_bulk_rejected_positions(response):
+    ''' A bulk ingest is accepted with a 200 even if some of its commands fail, with each
+    failure in the command's position in `items`. If any failed since Elasticsearch is
+    unavailable, such as its write queue being full, they would succeed later, so as for the
+    whole request, ESUnavailable is raised, and the rest are written again with them '''
+    if not response.get('errors'):
+        return []
+
+    results = [result for item in response['items'] for result in item.values()]
+    failed = [
+        (position, result) for position, result in enumerate(results) if 'error' in result
+    ]
+    if any(result['status'] == 429 or result['status'] >= 500 for _, result in failed):
+        raise ESUnavailable(ujson.dumps([result for _, result in failed]))
+    return [position for position, _ in failed]
+
+
+def filter_es_bulk_contents(es_bulk_contents, index_names):
+    ''' The bulk ingest commands that are into one of index_names. Each command is an
+    action line followed by a source line, and neither can contain a newline '''
+    index_names_set = set(index_names)
+    lines = es_bulk_contents.split(b'\n')
+    return b''.join(
+        action_and_metadata + b'\n' + source + b'\n'
+        for action_and_metadata, source in zip(lines[0::2], lines[1::2])
+        if ujson.loads(action_and_metadata)['index']['_index'] in index_names_set
+    )
+
+
+def select_es_bulk_contents(es_bulk_contents, positions):
+    ''' The bulk ingest commands at positions, as in filter_es_bulk_contents '''
+    positions_set = set(positions)
+    lines = es_bulk_contents.split(b'\n')
+    return b''.join(
+        action_and_metadata + b'\n' + source + b'\n'
+        for position, (action_and_metadata, source) in enumerate(zip(lines[0::2], lines[1::2]))
+        if position in positions_set
+    )
 
 
 async def es_searchable_total(context, es_endpoint):
@@ -317,6 +745,24 @@ async def es_feed_activities_total(context, es_endpoint, feed_id):
     return searchable, nonsearchable
 
 
+async def es_feed_index_bytes(context, es_endpoint, feed_id):
+    ''' The size of the primary shards of the feed's searchable index '''
+    result = await es_maybe_unvailable_metrics(
+        context=context,
+        endpoint=es_endpoint,
+        method='GET',
+        path=f'/{get_feed_alias(feed_id)}/_stats/store',
+        query={'ignore_unavailable': 'true'},
+        headers={'Content-Type': 'application/json'},
+        payload=b'',
+    )
+    try:
+        return ujson.loads(await result.text())['_all']['primaries']['store']['size_in_bytes']
+    except KeyError as exception:
+        # If the feed's index isn't searchable yet
+        raise ESMetricsUnavailable() from exception
+
+
 async def es_min_verification_age(context, es_endpoint):
     payload = ujson.dumps({
         'size': 0,
@@ -352,16 +798,18 @@ async def es_min_verification_age(context, es_endpoint):
                             ['verifier_activities']['max_published']['value'] / 1000)
         now = int(time.time())
         age = now - max_published
-    except (KeyError, TypeError):
+    except (KeyError, TypeError) as exception:
         # If there aren't any activities yet, don't error
-        raise ESMetricsUnavailable()
+        raise ESMetricsUnavailable() from exception
     return age
 
 
 async def es_request_non_200_exception(context, endpoint, method, path, query, headers, payload):
     results = await es_request(context, endpoint, method, path, query, headers, payload)
+    if results.status == 429 or results.status >= 500:
+        raise ESUnavailable(await results.text())
     if results.status != 200:
-        raise Exception(await results.text())
+        raise ESRejected(await results.text())
     return results
 
 
@@ -376,27 +824,113 @@ async def es_maybe_unvailable_metrics(context, endpoint, method, path, query, he
 
 
 async def es_request(context, endpoint, method, path, query, headers, payload):
+    node = es_choose_node(context.es_nodes)
+    return await es_node_request(context, endpoint, node, method, path, query, headers, payload)
+
+
+async def es_node_request(context, endpoint, node, method, path, query, headers, payload):
     with logged(
-        context.logger, 'Elasticsearch request by (%s) to (%s) (%s) (%s)',
-        [endpoint['access_key_id'], method, path, query],
+        context.logger, 'Elasticsearch request by (%s) to (%s) (%s) (%s) (%s)',
+        [endpoint['access_key_id'], node['base_url'], method, path, query],
     ):
-        auth_headers = aws_auth_headers(
-            service='es',
-            endpoint=endpoint, method=method,
-            path=path, query=query,
-            headers=headers, payload=payload,
-        )
+        with metric_timer(context.metrics['elasticsearch_request_signing_duration_seconds'], []):
+            auth_headers = aws_auth_headers(
+                service='es',
+                endpoint={**endpoint, 'host': node['host']}, method=method,
+                path=path, query=query,
+                headers=headers, payload=payload,
+            )
 
         query_string = '&'.join([key + '=' + query[key] for key in query.keys()])
-        url = endpoint['base_url'] + path + (('?' + query_string) if query_string != '' else '')
-        async with context.session.request(
-            method, url,
-            data=payload, headers={**headers, **auth_headers}
-        ) as result:
-            # Without this, after some number of requests, they end up hanging
-            await result.read()
-            return result
+        url = node['base_url'] + path + (('?' + query_string) if query_string != '' else '')
+        outstanding_metric = \
+            context.metrics['elasticsearch_node_requests_outstanding'].labels(node['base_url'])
+        node['outstanding'] += 1
+        outstanding_metric.inc()
+        try:
+            async with context.es_session.request(
+                method, url,
+                data=payload, headers={**headers, **auth_headers}
+            ) as result:
+                # Without this, after some number of requests, they end up hanging
+                await result.read()
+        except aiohttp.ClientConnectionError:
+            es_eject_node(context, node, 'connection')
+            raise
+        finally:
+            node['outstanding'] -= 1
+            outstanding_metric.dec()
+
+        # A 503 is returned when shards of an index aren't available, which is not
+        # specific to the node
+        if result.status >= 500 and result.status != 503:
+            es_eject_node(context, node, str(result.status))
+        return result
+
+
+def get_es_nodes(es_endpoint):
+    ''' The state of each node in this process, used to choose the node for each request '''
+    return [
+        {**node, 'outstanding': 0, 'ejected_until': 0, 'ejected_reason': None}
+        for node in es_endpoint['nodes']
+    ]
+
+
+def es_choose_node(es_nodes):
+    ''' The node with the fewest outstanding requests, ties broken randomly, skipping the
+    ejected nodes unless all of them are ejected '''
+    now = time.monotonic()
+    healthy_nodes = [node for node in es_nodes if node['ejected_until'] <= now]
+    return min(healthy_nodes or es_nodes, key=lambda node: (node['outstanding'], random.random()))
+
+
+def es_any_node_healthy(es_nodes):
+    now = time.monotonic()
+    return any(node['ejected_until'] <= now for node in es_nodes)
+
+
+def es_eject_node(context, node, reason):
+    context.logger.warning('Ejecting node (%s) (%s)', node['base_url'], reason)
+    context.metrics['elasticsearch_node_ejections_total'].labels(node['base_url'], reason).inc()
+    node['ejected_until'] = time.monotonic() + ES_EJECTION_INTERVAL
+    node['ejected_reason'] = reason
+
+
+def create_es_nodes_prober(parent_context, es_endpoint, exception_intervals):
+    context = get_child_context(parent_context, 'elasticsearch-nodes')
+
+    async def probe_node(node):
+        try:
+            result = await asyncio.wait_for(
+                es_node_request(context, es_endpoint, node, 'GET', '/', {}, {}, b''),
+                ES_PROBE_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            es_eject_node(context, node, 'timeout')
+        except aiohttp.ClientConnectionError:
+            pass
+        else:
+            if result.status < 500 and node['ejected_until'] and \
+                    node['ejected_reason'] in ES_PROBE_RESTORED_REASONS:
+                context.logger.debug('Restoring node (%s)', node['base_url'])
+                node['ejected_until'] = 0
+
+    async def probe_nodes():
+        await asyncio.gather(*[probe_node(node) for node in context.es_nodes])
+        await sleep(context, ES_PROBE_INTERVAL)
+
+    asyncio.get_event_loop().create_task(
+        async_repeat_until_cancelled(context, exception_intervals, probe_nodes)
+    )
 
 
 class ESMetricsUnavailable(Exception):
-    pass
+    ''' A metric can't be queried yet, for example from an index that isn't searchable '''
+
+
+class ESUnavailable(Exception):
+    ''' Elasticsearch is rejecting requests, but may accept them later '''
+
+
+class ESRejected(Exception):
+    ''' Elasticsearch has rejected a request, and would reject it again '''
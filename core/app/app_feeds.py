@@ -1,4 +1,4 @@
-import asyncio
+import collections
 import re
 
 import aiohttp
@@ -7,7 +7,48 @@ import yarl
 from .app_hawk import (
     get_hawk_header,
 )
-from .app_utils import sub_dict_lower
+from .app_utils import (
+    get_priority_lock,
+    sub_dict_lower,
+)
+
+NUMBER_OF_REPLICAS = '1'
+SHARD_TARGET_BYTES = str(10 * 1024 * 1024 * 1024)
+SHARD_TARGET_DOCS = '20000000'
+MAX_SHARDS = '16'
+
+ES_KEYWORD = {'type': 'keyword'}
+
+# Clients search on the .keyword sub-field that dynamic mapping gives every string, so the
+# properties typed explicitly as keywords keep it
+ES_KEYWORD_WITH_SUB_FIELD = {
+    'type': 'keyword',
+    'fields': {
+        'keyword': ES_KEYWORD,
+    },
+}
+
+IndexConfig = collections.namedtuple(
+    'IndexConfig', ['number_of_replicas', 'force_merge_segments', 'shard_target_bytes',
+                    'shard_target_docs', 'max_shards'],
+)
+
+# The Activity Streams properties that activities are filtered and sorted on, typed explicitly
+# rather than by dynamic mapping, that indexes every string as both text and keyword
+ES_ACTIVITY_STREAM_PROPERTIES = {
+    'id': ES_KEYWORD_WITH_SUB_FIELD,
+    'type': ES_KEYWORD_WITH_SUB_FIELD,
+    'published': {
+        'type': 'date',
+    },
+    'dit:application': ES_KEYWORD_WITH_SUB_FIELD,
+    'object': {
+        'properties': {
+            'id': ES_KEYWORD_WITH_SUB_FIELD,
+            'type': ES_KEYWORD_WITH_SUB_FIELD,
+        },
+    },
+}
 
 
 def parse_feed_config(feed_config):
@@ -18,26 +59,58 @@ def parse_feed_config(feed_config):
     return by_feed_type[feed_config['TYPE']].parse_config(feed_config)
 
 
+def parse_index_config(config):
+    ''' The replicas of a feed's index once it's searchable, and if not 0, the number of
+    segments it's force merged to beforehand. Its shards are chosen so each is at most
+    around the target bytes and documents, based on the previous index '''
+    return IndexConfig(
+        number_of_replicas=int(config.get('NUMBER_OF_REPLICAS', NUMBER_OF_REPLICAS)),
+        force_merge_segments=int(config.get('FORCE_MERGE_SEGMENTS', '0')),
+        shard_target_bytes=int(config.get('SHARD_TARGET_BYTES', SHARD_TARGET_BYTES)),
+        shard_target_docs=int(config.get('SHARD_TARGET_DOCS', SHARD_TARGET_DOCS)),
+        max_shards=int(config.get('MAX_SHARDS', MAX_SHARDS)),
+    )
+
+
 class ActivityStreamFeed:
 
     full_ingest_page_interval = 0.25
     updates_page_interval = 1
+    updates_page_interval_max = 32
     exception_intervals = [1, 2, 4, 8, 16, 32, 64]
 
+    # Sources can have any other properties, such as names and content that are searched as
+    # text, so they are still mapped dynamically
+    es_mappings = {
+        'properties': ES_ACTIVITY_STREAM_PROPERTIES,
+    }
+
     @classmethod
     def parse_config(cls, config):
         return cls(**sub_dict_lower(config,
-                                    ['UNIQUE_ID', 'SEED', 'ACCESS_KEY_ID', 'SECRET_ACCESS_KEY']))
+                                    ['UNIQUE_ID', 'SEED', 'ACCESS_KEY_ID', 'SECRET_ACCESS_KEY']),
+                   long_poll_seconds=int(config.get('LONG_POLL_SECONDS', '0')),
+                   dit_applications=config.get('DIT_APPLICATIONS'),
+                   index_config=parse_index_config(config))
 
-    def __init__(self, unique_id, seed, access_key_id, secret_access_key):
+    def __init__(self, unique_id, seed, access_key_id, secret_access_key, long_poll_seconds,
+                 dit_applications, index_config):
         self.unique_id = unique_id
         self.seed = seed
         self.access_key_id = access_key_id
         self.secret_access_key = secret_access_key
+        self.index_config = index_config
+
+        # If the feed supports it, it holds a request for updates open for up to this long,
+        # until there are new activities
+        self.long_poll_seconds = long_poll_seconds
+
+        # If declared, searches filtered to other applications don't search the feed's index
+        self.dit_applications = dit_applications
 
     @staticmethod
     def get_lock():
-        return asyncio.Lock()
+        return get_priority_lock(max_consecutive_priority=4)
 
     @staticmethod
     def next_href(feed):
@@ -82,23 +155,42 @@ class ZendeskFeed:
     # Could be higher on prod, but KISS
     full_ingest_page_interval = 30
     updates_page_interval = 120
+    updates_page_interval_max = 480
+    long_poll_seconds = 0
     exception_intervals = [120, 180, 240, 300]
+    dit_applications = ['zendesk']
+
+    # All the properties of the activities are known, so any others aren't indexed
+    es_mappings = {
+        'dynamic': False,
+        'properties': {
+            **ES_ACTIVITY_STREAM_PROPERTIES,
+            'actor': {
+                'properties': {
+                    'type': ES_KEYWORD_WITH_SUB_FIELD,
+                    'dit:companiesHouseNumber': ES_KEYWORD_WITH_SUB_FIELD,
+                },
+            },
+        },
+    }
 
     company_number_regex = r'Company number:\s*(\d+)'
 
     @classmethod
     def parse_config(cls, config):
-        return cls(**sub_dict_lower(config, ['UNIQUE_ID', 'SEED', 'API_EMAIL', 'API_KEY']))
+        return cls(**sub_dict_lower(config, ['UNIQUE_ID', 'SEED', 'API_EMAIL', 'API_KEY']),
+                   index_config=parse_index_config(config))
 
-    def __init__(self, unique_id, seed, api_email, api_key):
+    def __init__(self, unique_id, seed, api_email, api_key, index_config):
         self.unique_id = unique_id
         self.seed = seed
         self.api_email = api_email
         self.api_key = api_key
+        self.index_config = index_config
 
     @staticmethod
     def get_lock():
-        return asyncio.Lock()
+        return get_priority_lock(max_consecutive_priority=4)
 
     @staticmethod
     def next_href(feed):
@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import os
 
 import aiohttp
@@ -7,6 +8,10 @@ from prometheus_client import (
     CollectorRegistry,
 )
 
+from shared.elasticsearch import (
+    es_trace_config,
+    get_es_session,
+)
 from shared.logger import (
     get_root_logger,
     logged,
@@ -20,11 +25,26 @@ from shared.web import (
     authenticate_by_ip,
 )
 
+from .app_elasticsearch import (
+    ES_REFRESH_INTERVAL,
+    es_get_refresh_queue,
+    create_es_aliases_poller,
+    create_es_nodes_prober,
+    create_es_refresher,
+    get_es_aliases,
+    get_es_nodes,
+)
 from .app_feeds import (
     parse_feed_config,
 )
 from .app_metrics import (
-    get_metrics,
+    create_event_loop_monitor,
+    get_incoming_metrics,
+)
+from .app_push import (
+    PUSH_QUEUE_MAX_ITEMS,
+    create_push_writer,
+    get_push_queue,
 )
 from .app_raven import (
     get_raven_client,
@@ -38,11 +58,17 @@ from .app_server import (
     handle_get_existing,
     handle_get_new,
     handle_get_metrics,
+    handle_get_memory,
+    handle_get_profile,
     handle_post,
     raven_reporter,
+    request_metrics,
 )
 from .app_redis import (
+    REDIS_POOL_SIZE,
+    create_redis_writes_flusher,
     redis_get_client,
+    redis_get_write_queue,
 )
 from .app_utils import (
     Context,
@@ -50,45 +76,86 @@ from .app_utils import (
     main,
 )
 
+EXCEPTION_INTERVALS = [1, 2, 4, 8, 16, 32, 64]
+SLOW_CALLBACK_THRESHOLD = 0.5
 NONCE_EXPIRE = 120
 PAGINATION_EXPIRE = 10
 
+IncomingConfig = collections.namedtuple(
+    'IncomingConfig', [
+        'es_endpoint', 'redis_uri', 'sentry', 'redis_pool_size', 'slow_callback_threshold',
+        'refresh_interval', 'feed_endpoints', 'port', 'incoming_key_pairs', 'ip_whitelist',
+        'admin_ip_whitelist',
+    ],
+)
 
-async def run_incoming_application():
-    logger = get_root_logger('incoming')
 
-    with logged(logger, 'Examining environment', []):
-        env = normalise_environment(os.environ)
-        es_endpoint, redis_uri, sentry = get_common_config(env)
-        feed_endpoints = [parse_feed_config(feed) for feed in env['FEEDS']]
-        port = env['PORT']
-        incoming_key_pairs = [{
+def parse_incoming_config(env):
+    es_endpoint, redis_uri, sentry = get_common_config(env)
+    return IncomingConfig(
+        es_endpoint=es_endpoint,
+        redis_uri=redis_uri,
+        sentry=sentry,
+        redis_pool_size=int(env.get('REDIS_POOL_SIZE', REDIS_POOL_SIZE)),
+        slow_callback_threshold=float(
+            env.get('SLOW_CALLBACK_THRESHOLD', SLOW_CALLBACK_THRESHOLD)),
+        refresh_interval=float(env.get('REFRESH_INTERVAL', ES_REFRESH_INTERVAL)),
+        feed_endpoints=[parse_feed_config(feed) for feed in env['FEEDS']],
+        port=env['PORT'],
+        incoming_key_pairs=[{
             'key_id': key_pair['KEY_ID'],
             'secret_key': key_pair['SECRET_KEY'],
             'permissions': key_pair['PERMISSIONS'],
-        } for key_pair in env['INCOMING_ACCESS_KEY_PAIRS']]
-        ip_whitelist = env['INCOMING_IP_WHITELIST']
+            'feed_unique_id': key_pair.get('FEED_UNIQUE_ID'),
+        } for key_pair in env['INCOMING_ACCESS_KEY_PAIRS']],
+        ip_whitelist=env['INCOMING_IP_WHITELIST'],
+        admin_ip_whitelist=env.get('ADMIN_IP_WHITELIST', []),
+    )
+
+
+async def run_incoming_application():
+    logger = get_root_logger('incoming')
+
+    with logged(logger, 'Examining environment', []):
+        config = parse_incoming_config(normalise_environment(os.environ))
 
     conn = aiohttp.TCPConnector(use_dns_cache=False, resolver=aiohttp.AsyncResolver())
     session = aiohttp.ClientSession(
         connector=conn,
         headers={'Accept-Encoding': 'identity;q=1.0, *;q=0'},
     )
-    raven_client = get_raven_client(sentry, session)
+    raven_client = get_raven_client(config.sentry, session)
 
-    redis_client = await redis_get_client(redis_uri)
+    redis_client = await redis_get_client(config.redis_uri, config.redis_pool_size)
 
     metrics_registry = CollectorRegistry()
-    metrics = get_metrics(metrics_registry)
+    metrics = get_incoming_metrics(metrics_registry)
+
+    es_session = get_es_session(
+        [es_trace_config(metrics)], resolver=aiohttp.AsyncResolver(),
+        headers={'Accept-Encoding': 'identity;q=1.0, *;q=0'},
+    )
 
     context = Context(
         logger=logger, metrics=metrics,
-        raven_client=raven_client, redis_client=redis_client, session=session)
+        raven_client=raven_client, redis_client=redis_client,
+        redis_write_queue=redis_get_write_queue(), session=session, es_session=es_session,
+        es_nodes=get_es_nodes(config.es_endpoint), es_refresh_queue=es_get_refresh_queue(),
+        es_bulk_spool=None)
+    create_redis_writes_flusher(context, EXCEPTION_INTERVALS)
+    create_es_refresher(context, config.es_endpoint, config.refresh_interval,
+                        EXCEPTION_INTERVALS)
+    create_es_nodes_prober(context, config.es_endpoint, EXCEPTION_INTERVALS)
+    es_aliases = get_es_aliases()
+    create_es_aliases_poller(context, config.es_endpoint, es_aliases, EXCEPTION_INTERVALS)
+    create_event_loop_monitor(context, EXCEPTION_INTERVALS, config.slow_callback_threshold)
+
+    push_queue = get_push_queue(PUSH_QUEUE_MAX_ITEMS)
+    create_push_writer(context, config.es_endpoint, push_queue, EXCEPTION_INTERVALS)
 
     with logged(context.logger, 'Creating listening web application', []):
         runner = await create_incoming_application(
-            context, port, ip_whitelist, incoming_key_pairs,
-            es_endpoint, feed_endpoints,
+            context, metrics_registry, config, push_queue, es_aliases,
         )
 
     async def cleanup():
@@ -99,43 +166,54 @@ async def run_incoming_application():
         await redis_client.wait_closed()
 
         await session.close()
+        await es_session.close()
         # https://github.com/aio-libs/aiohttp/issues/1925
         await asyncio.sleep(0.250)
 
     return cleanup
 
 
-async def create_incoming_application(
-        context, port, ip_whitelist, incoming_key_pairs,
-        es_endpoint, feed_endpoints):
+async def create_incoming_application(context, metrics_registry, config, push_queue,
+                                      es_aliases):
 
     app = web.Application(middlewares=[
         server_logger(context.logger),
+        request_metrics(context),
         convert_errors_to_json(),
         raven_reporter(context),
     ])
 
     private_app = web.Application(middlewares=[
-        authenticate_by_ip(INCORRECT, ip_whitelist),
-        authenticator(context, incoming_key_pairs, NONCE_EXPIRE),
+        authenticate_by_ip(INCORRECT, config.ip_whitelist),
+        authenticator(context, config.incoming_key_pairs, NONCE_EXPIRE),
         authorizer(),
     ])
     private_app.add_routes([
-        web.post('/', handle_post),
+        web.post('/', handle_post(context, push_queue, es_aliases)),
         web.get(
             '/',
-            handle_get_new(context, PAGINATION_EXPIRE, es_endpoint)
+            handle_get_new(context, PAGINATION_EXPIRE, config.es_endpoint,
+                           config.feed_endpoints, es_aliases)
         ),
         web.get(
             '/{public_scroll_id}',
-            handle_get_existing(context, PAGINATION_EXPIRE, es_endpoint),
+            handle_get_existing(context, PAGINATION_EXPIRE, config.es_endpoint),
             name='scroll',
         ),
     ])
     app.add_subapp('/v1/', private_app)
+
+    admin_app = web.Application(middlewares=[
+        authenticate_by_ip(INCORRECT, config.admin_ip_whitelist),
+    ])
+    admin_app.add_routes([
+        web.get('/profile', handle_get_profile()),
+        web.get('/memory', handle_get_memory()),
+    ])
+    app.add_subapp('/admin/', admin_app)
     app.add_routes([
-        web.get('/check', handle_get_check(context, es_endpoint, feed_endpoints)),
-        web.get('/metrics', handle_get_metrics(context)),
+        web.get('/check', handle_get_check(context, config.es_endpoint, config.feed_endpoints)),
+        web.get('/metrics', handle_get_metrics(context, metrics_registry)),
     ])
 
     class NullAccessLogger(aiohttp.abc.AbstractAccessLogger):
@@ -146,7 +224,7 @@ async def create_incoming_application(
 
     runner = web.AppRunner(app, access_log_class=NullAccessLogger)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', port)
+    site = web.TCPSite(runner, '0.0.0.0', config.port)
     await site.start()
 
     return runner
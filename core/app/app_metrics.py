@@ -1,6 +1,10 @@
 import asyncio
+import collections
 import contextlib
+import sys
+import threading
 import time
+import traceback
 
 from prometheus_client import (
     Counter,
@@ -9,16 +13,99 @@ from prometheus_client import (
     Summary,
     PlatformCollector,
     ProcessCollector,
+    generate_latest,
+)
+from prometheus_client.core import (
+    Metric,
+)
+from prometheus_client.parser import (
+    text_string_to_metric_families,
+)
+
+from shared.elasticsearch import (
+    METRICS_CONF_ES_SESSION,
+)
+from shared.logger import (
+    span,
 )
 
+from .app_utils import (
+    async_repeat_until_cancelled,
+    get_child_context,
+)
+
+EVENT_LOOP_MONITOR_INTERVAL = 0.1
+
+LAG_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'),
+)
+
+BYTES_BUCKETS = (
+    1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, float('inf'),
+)
+
+ITEMS_BUCKETS = (
+    1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'),
+)
+
+SHARDS_BUCKETS = (
+    1, 2, 4, 8, 16, 32, 64, 128, 256, float('inf'),
+)
+
+# Both outgoing and incoming run an event loop, and make requests to Elasticsearch
+METRICS_CONF_EVENT_LOOP = [
+    (Histogram, 'event_loop_lag_seconds',
+     'The time the event loop ran a callback after it was scheduled to in seconds',
+     [], {'buckets': LAG_BUCKETS}),
+    (Gauge, 'event_loop_tasks_total',
+     'The number of tasks that have not finished', []),
+]
+
+METRICS_CONF_ES_CLIENT = [
+    *METRICS_CONF_ES_SESSION,
+    (Gauge, 'elasticsearch_node_requests_outstanding',
+     'The number of requests to an Elasticsearch node awaiting a response',
+     ['node']),
+    (Counter, 'elasticsearch_node_ejections_total',
+     'The number of times an Elasticsearch node was ejected from receiving requests',
+     ['node', 'reason']),
+    (Histogram, 'elasticsearch_refresh_delay_seconds',
+     'Time from an index being requested to be refreshed, to the refresh completing, '
+     'in seconds', []),
+]
 
 METRICS_CONF = [
     (Summary, 'ingest_feed_duration_seconds',
      'Time to ingest all pages of a feed in seconds',
      ['feed_unique_id', 'ingest_type', 'status']),
+    (Summary, 'ingest_feed_full_stage_duration_seconds',
+     'Time for each stage of a full ingest of a feed in seconds',
+     ['feed_unique_id', 'stage', 'status']),
     (Histogram, 'ingest_page_duration_seconds',
      'Time for a page of data to be ingested in seconds',
      ['feed_unique_id', 'ingest_type', 'stage', 'status']),
+    (Histogram, 'ingest_page_size_bytes',
+     'The size of a page of data fetched from a feed in bytes',
+     ['feed_unique_id', 'ingest_type'], {'buckets': BYTES_BUCKETS}),
+    (Histogram, 'ingest_page_items',
+     'The number of items in a page of data fetched from a feed',
+     ['feed_unique_id', 'ingest_type'], {'buckets': ITEMS_BUCKETS}),
+    (Histogram, 'ingest_page_bulk_size_bytes',
+     'The size of the bulk ingest of a page of data into Elasticsearch in bytes',
+     ['feed_unique_id', 'ingest_type'], {'buckets': BYTES_BUCKETS}),
+    (Histogram, 'ingest_feed_lock_wait_seconds',
+     'Time waiting for the lock on a feed before requesting a page in seconds',
+     ['feed_unique_id', 'ingest_type', 'status']),
+    (Gauge, 'ingest_feed_index_shards',
+     'The number of shards of the index of the latest full ingest of a feed',
+     ['feed_unique_id']),
+    (Gauge, 'ingest_spool_records',
+     'The number of bulk ingests spooled while Elasticsearch is unavailable', []),
+    (Gauge, 'ingest_spool_bytes',
+     'The size of the bulk ingests spooled while Elasticsearch is unavailable in bytes', []),
+    (Counter, 'ingest_spool_records_total',
+     'The number of bulk ingests spooled, written, discarded or dead-lettered from the spool',
+     ['result']),
     (Gauge, 'ingest_inprogress_ingests_total',
      'The number of inprogress ingests', []),
     (Counter, 'ingest_activities_nonunique_total',
@@ -28,25 +115,113 @@ METRICS_CONF = [
     (Gauge, 'elasticsearch_feed_activities_total',
      'The number of activities from a feed stored in Elasticsearch',
      ['feed_unique_id', 'searchable']),
+    (Gauge, 'elasticsearch_feed_index_bytes',
+     'The size of the primary shards of the searchable index of a feed in bytes',
+     ['feed_unique_id']),
     # Only need verification, but keeping it consistent with other metrics
     (Gauge, 'elasticsearch_activities_age_minimum_seconds',
      'The minimum age of activites from a feed stored in Elasticsearch in seconds',
      ['feed_unique_id']),
+    (Histogram, 'redis_command_duration_seconds',
+     'Time for a Redis command to complete in seconds',
+     ['command', 'status']),
+    *METRICS_CONF_EVENT_LOOP,
+    *METRICS_CONF_ES_CLIENT,
+]
+
+# Exported by each incoming instance, prefixed with incoming_, and appended to the
+# metrics saved in Redis by outgoing. Process and platform metrics are not included
+# since they would clash with those from outgoing
+METRICS_CONF_INCOMING = [
+    (Histogram, 'http_request_duration_seconds',
+     'Time to respond to an incoming HTTP request in seconds',
+     ['route', 'key_id', 'status']),
+    (Histogram, 'http_request_stage_duration_seconds',
+     'Time spent in each stage of responding to an incoming HTTP request in seconds',
+     ['stage', 'status']),
+    (Histogram, 'http_response_size_bytes',
+     'The size of responses to incoming HTTP requests in bytes',
+     ['route', 'key_id', 'status'], {'buckets': BYTES_BUCKETS}),
+    (Counter, 'http_authentication_failures_total',
+     'The number of failed authentications of incoming HTTP requests',
+     ['reason']),
+    (Counter, 'push_activities_total',
+     'The number of activities pushed, accepted, rejected since the queue was full or the '
+     'feed had no index, or dropped since Elasticsearch rejected them',
+     ['feed_unique_id', 'result']),
+    (Gauge, 'push_queue_items',
+     'The number of pushed activities waiting to be written to Elasticsearch', []),
+    (Histogram, 'push_batch_duration_seconds',
+     'Time to write a batch of pushed activities to Elasticsearch in seconds',
+     ['status']),
+    (Histogram, 'elasticsearch_took_seconds',
+     'The time Elasticsearch reports a search took in seconds', []),
+    (Histogram, 'elasticsearch_search_shards',
+     'The number of shards a search is sent to, by whether it was narrowed to feeds',
+     ['route'], {'buckets': SHARDS_BUCKETS}),
+    (Histogram, 'redis_command_duration_seconds',
+     'Time for a Redis command to complete in seconds',
+     ['command', 'status']),
+    *METRICS_CONF_EVENT_LOOP,
+    *METRICS_CONF_ES_CLIENT,
 ]
 
 
 def get_metrics(registry):
     PlatformCollector(registry=registry)
     ProcessCollector(registry=registry)
+    return _get_metrics(registry, METRICS_CONF, '')
+
+
+def get_incoming_metrics(registry):
+    return _get_metrics(registry, METRICS_CONF_INCOMING, 'incoming')
+
+
+def _get_metrics(registry, metrics_conf, namespace):
     return {
         # The metric classes are constructed via decorators which
         # result in pylint giving a false positive
         # pylint: disable=unexpected-keyword-arg
-        name: metric_class(name, description, labels, registry=registry)
-        for metric_class, name, description, labels in METRICS_CONF
+        name: metric_class(name, description, labels, namespace=namespace, registry=registry,
+                           **(optional[0] if optional else {}))
+        for metric_class, name, description, labels, *optional in metrics_conf
     }
 
 
+# generate_latest only needs an object with a collect method
+_MergedRegistry = collections.namedtuple('_MergedRegistry', ['collect'])
+
+
+def merge_metrics(metrics_texts):
+    ''' Merges the Prometheus text output of several processes into one
+
+    The samples of gauges are combined by taking the maximum, since the gauges are
+    either the same in every process, or are process metrics where the maximum is
+    more useful than a sum. The samples of all other types are summed.
+    '''
+    families = collections.OrderedDict()
+    for metrics_text in metrics_texts:
+        for family in text_string_to_metric_families(metrics_text.decode('utf-8')):
+            merged_family, merged_samples = families.setdefault(family.name, (
+                Metric(family.name, family.documentation, family.type),
+                collections.OrderedDict(),
+            ))
+            combine = max if merged_family.type == 'gauge' else sum
+            for name, labels, value, *_ in family.samples:
+                key = (name, tuple(sorted(labels.items())))
+                merged_samples[key] = \
+                    combine([merged_samples[key], value]) if key in merged_samples else \
+                    value
+
+    def collect():
+        for merged_family, merged_samples in families.values():
+            for (name, labels), value in merged_samples.items():
+                merged_family.add_sample(name, dict(labels), value)
+            yield merged_family
+
+    return generate_latest(_MergedRegistry(collect=collect))
+
+
 @contextlib.contextmanager
 def metric_inprogress(metric):
     try:
@@ -60,7 +235,9 @@ def metric_inprogress(metric):
 def metric_timer(metric, labels):
     start_counter = time.perf_counter()
     try:
-        yield
+        # pylint: disable=protected-access
+        with span(metric._name, {'labels': labels}):
+            yield
         status = 'success'
     except asyncio.CancelledError:
         status = 'cancelled'
@@ -83,3 +260,41 @@ def metric_counter(metric, labels, increment_by):
         raise
     finally:
         metric.labels(*labels).inc(increment_by_value)
+
+
+def create_event_loop_monitor(parent_context, exception_intervals, slow_callback_threshold):
+    ''' Measures how late the event loop wakes a task, which is how long other callbacks held
+    the loop, and the number of tasks. A thread logs the stack of the event loop's thread if a
+    callback holds the loop for longer than slow_callback_threshold, while it still holds it '''
+    context = get_child_context(parent_context, 'event-loop')
+    metrics = context.metrics
+    loop = asyncio.get_event_loop()
+    loop_thread_id = threading.get_ident()
+    last_wakeup = [loop.time()]
+    is_stopped = threading.Event()
+
+    async def monitor():
+        expected_wakeup = loop.time() + EVENT_LOOP_MONITOR_INTERVAL
+        try:
+            await asyncio.sleep(EVENT_LOOP_MONITOR_INTERVAL)
+        except asyncio.CancelledError:
+            is_stopped.set()
+            raise
+        last_wakeup[0] = loop.time()
+        metrics['event_loop_lag_seconds'].observe(max(0, last_wakeup[0] - expected_wakeup))
+        metrics['event_loop_tasks_total'].set(len(asyncio.Task.all_tasks()))
+
+    def watch():
+        logged_wakeup = None
+        while not is_stopped.wait(slow_callback_threshold / 2):
+            wakeup = last_wakeup[0]
+            held_for = loop.time() - wakeup - EVENT_LOOP_MONITOR_INTERVAL
+            if held_for > slow_callback_threshold and wakeup != logged_wakeup:
+                logged_wakeup = wakeup
+                # pylint: disable=protected-access
+                stack = traceback.format_stack(sys._current_frames()[loop_thread_id])
+                context.logger.warning('Event loop held for at least (%s) seconds by (%s)',
+                                       held_for, ''.join(stack))
+
+    loop.create_task(async_repeat_until_cancelled(context, exception_intervals, monitor))
+    threading.Thread(target=watch, daemon=True).start()
@@ -1,162 +1,502 @@
 import asyncio
+import collections
+import hashlib
 import os
+import signal
+import sys
 
 import aiohttp
+import aioredis
 from prometheus_client import (
     CollectorRegistry,
     generate_latest,
 )
 import ujson
 
+from shared.elasticsearch import (
+    es_trace_config,
+    get_es_session,
+)
 from shared.logger import (
     get_root_logger,
     logged,
+    traced,
 )
 from shared.utils import (
     get_common_config,
     normalise_environment,
+    random_log_id,
+    random_url_safe,
 )
 
 from .app_elasticsearch import (
+    ES_REFRESH_INTERVAL,
     ESMetricsUnavailable,
-    es_bulk,
     es_feed_activities_total,
+    es_feed_index_bytes,
     es_searchable_total,
     es_nonsearchable_total,
     es_min_verification_age,
     create_index,
+    force_merge_index,
+    restore_index_durability,
+    wait_for_index_health,
     get_new_index_name,
+    get_number_of_shards,
     get_old_index_names,
     indexes_matching_feeds,
     indexes_matching_no_feeds,
+    indexes_by_feed,
     add_remove_aliases_atomically,
     delete_indexes,
     refresh_index,
+    refresh_indexes_later,
+    es_get_refresh_queue,
+    create_es_nodes_prober,
+    create_es_refresher,
+    get_es_nodes,
 )
 
 from .app_feeds import (
     parse_feed_config,
 )
 from .app_metrics import (
-    metric_counter,
+    create_event_loop_monitor,
     metric_inprogress,
     metric_timer,
     get_metrics,
+    merge_metrics,
 )
 from .app_raven import (
     get_raven_client,
 )
 from .app_redis import (
+    REDIS_POOL_SIZE,
+    create_redis_writes_flusher,
     redis_get_client,
-    acquire_and_keep_lock,
+    redis_get_write_queue,
+    acquire_feed_lease,
+    extend_feed_lease,
+    release_feed_lease,
+    set_instance_heartbeat,
+    get_instance_ids,
+    remove_instance,
     set_feed_updates_seed_url_init,
+    append_feed_updates_journal,
+    get_feed_updates_journal,
+    delete_feed_updates_journal,
     set_feed_updates_seed_url,
     set_feed_updates_url,
     get_feed_updates_url,
+    redis_get_instances_metrics,
+    redis_set_instance_metrics,
     redis_set_metrics,
     set_feed_status,
 )
+from .app_spool import (
+    SPOOL_MAX_BYTES,
+    SPOOL_SEGMENT_MAX_BYTES,
+    create_spool_writer,
+    es_bulk_or_spool,
+    es_bulk_spool_written,
+    get_spool,
+)
 from .app_utils import (
     Context,
     get_child_context,
     async_repeat_until_cancelled,
     cancel_non_current_tasks,
+    rendezvous_owner,
     sleep,
     http_429_retry_after,
     main,
 )
 
 EXCEPTION_INTERVALS = [1, 2, 4, 8, 16, 32, 64]
+SLOW_CALLBACK_THRESHOLD = 0.5
 METRICS_INTERVAL = 1
+INSTANCE_METRICS_EXPIRE = 10
+
+# Instances that haven't heartbeated within INSTANCE_TTL are considered dead,
+# and their feeds are leased by the others once their leases expire
+INSTANCE_TTL = 3
+LEASE_TTL = 3
+LEASE_INTERVAL = 0.5
+
+# A worker that exits is restarted, and the supervisor heartbeats on its behalf until it
+# has had WORKER_STARTUP_INTERVAL to heartbeat itself, so its feeds don't move to the others
+WORKER_RESTART_INTERVAL = 1
+WORKER_STARTUP_INTERVAL = 30
+WORKER_SUPERVISOR_POLL_INTERVAL = 1
 
 UPDATES_INTERVAL = 1
+JOURNAL_REPLAY_BATCH_SIZE = 1000
 
 
-async def run_outgoing_application():
-    logger = get_root_logger('outgoing')
+OutgoingConfig = collections.namedtuple(
+    'OutgoingConfig', [
+        'es_endpoint', 'redis_uri', 'sentry', 'redis_pool_size', 'slow_callback_threshold',
+        'refresh_interval', 'feed_endpoints', 'num_workers', 'worker_id', 'supervisor_pid',
+        'spool_directory', 'spool_max_bytes', 'spool_segment_max_bytes',
+    ],
+)
+
+
+def parse_outgoing_config(env):
+    es_endpoint, redis_uri, sentry = get_common_config(env)
+    spool = env.get('SPOOL', {})
+    return OutgoingConfig(
+        es_endpoint=es_endpoint,
+        redis_uri=redis_uri,
+        sentry=sentry,
+        redis_pool_size=int(env.get('REDIS_POOL_SIZE', REDIS_POOL_SIZE)),
+        slow_callback_threshold=float(
+            env.get('SLOW_CALLBACK_THRESHOLD', SLOW_CALLBACK_THRESHOLD)),
+        refresh_interval=float(env.get('REFRESH_INTERVAL', ES_REFRESH_INTERVAL)),
+        feed_endpoints=[parse_feed_config(feed) for feed in env['FEEDS']],
+        num_workers=int(env.get('OUTGOING_WORKERS', '0')),
+        worker_id=env.get('OUTGOING_WORKER_ID'),
+        supervisor_pid=(
+            int(env['OUTGOING_SUPERVISOR_PID']) if 'OUTGOING_SUPERVISOR_PID' in env else
+            None
+        ),
+        spool_directory=spool.get('DIRECTORY'),
+        spool_max_bytes=int(spool.get('MAX_BYTES', SPOOL_MAX_BYTES)),
+        spool_segment_max_bytes=int(spool.get('SEGMENT_MAX_BYTES', SPOOL_SEGMENT_MAX_BYTES)),
+    )
 
-    with logged(logger, 'Examining environment', []):
-        env = normalise_environment(os.environ)
-        es_endpoint, redis_uri, sentry = get_common_config(env)
-        feed_endpoints = [parse_feed_config(feed) for feed in env['FEEDS']]
 
+async def get_outgoing_context(logger, config, metrics):
     conn = aiohttp.TCPConnector(use_dns_cache=False, resolver=aiohttp.AsyncResolver())
     session = aiohttp.ClientSession(
         connector=conn,
         headers={'Accept-Encoding': 'identity;q=1.0, *;q=0'},
     )
-    raven_client = get_raven_client(sentry, session)
+    raven_client = get_raven_client(config.sentry, session)
 
-    redis_client = await redis_get_client(redis_uri)
+    redis_client = await redis_get_client(config.redis_uri, config.redis_pool_size)
 
-    metrics_registry = CollectorRegistry()
-    metrics = get_metrics(metrics_registry)
+    es_session = get_es_session(
+        [es_trace_config(metrics)], resolver=aiohttp.AsyncResolver(),
+        headers={'Accept-Encoding': 'identity;q=1.0, *;q=0'},
+    )
 
-    context = Context(
+    return Context(
         logger=logger, metrics=metrics,
-        raven_client=raven_client, redis_client=redis_client, session=session)
+        raven_client=raven_client, redis_client=redis_client,
+        redis_write_queue=redis_get_write_queue(), session=session, es_session=es_session,
+        es_nodes=get_es_nodes(config.es_endpoint), es_refresh_queue=es_get_refresh_queue(),
+        es_bulk_spool=None)
 
-    await acquire_and_keep_lock(context, EXCEPTION_INTERVALS, 'lock')
-    await create_outgoing_application(context, feed_endpoints, es_endpoint)
-    await create_metrics_application(
-        context, metrics_registry, feed_endpoints, es_endpoint,
-    )
+
+async def run_outgoing_application():
+    logger = get_root_logger('outgoing')
+
+    with logged(logger, 'Examining environment', []):
+        config = parse_outgoing_config(normalise_environment(os.environ))
+    es_endpoint = config.es_endpoint
+    feed_endpoints = config.feed_endpoints
+
+    # Workers are given their id by the supervisor, so it's kept across restarts
+    instance_id = \
+        config.worker_id if config.worker_id is not None else \
+        random_url_safe(16)
+
+    metrics_registry = CollectorRegistry()
+    context = await get_outgoing_context(logger, config, get_metrics(metrics_registry))
+    create_redis_writes_flusher(context, EXCEPTION_INTERVALS)
+    create_es_refresher(context, es_endpoint, config.refresh_interval, EXCEPTION_INTERVALS)
+    create_es_nodes_prober(context, es_endpoint, EXCEPTION_INTERVALS)
+    create_event_loop_monitor(context, EXCEPTION_INTERVALS, config.slow_callback_threshold)
+
+    # The supervisor of workers doesn't ingest, and each worker has its own spool, kept
+    # across its restarts since it keeps its id
+    if config.spool_directory and not config.num_workers:
+        with logged(logger, 'Opening spool', []):
+            context = context._replace(es_bulk_spool=get_spool(
+                context, os.path.join(config.spool_directory, config.worker_id or 'outgoing'),
+                config.spool_max_bytes, config.spool_segment_max_bytes,
+            ))
+        create_spool_writer(context, es_endpoint, EXCEPTION_INTERVALS)
+
+    worker_tasks = []
+    if config.num_workers:
+        worker_tasks = await create_workers_application(context, instance_id, config.num_workers)
+        await create_supervisor_metrics(context, metrics_registry, feed_endpoints, es_endpoint)
+    elif config.worker_id is not None:
+        create_supervisor_watcher(context, config.supervisor_pid, EXCEPTION_INTERVALS)
+        await create_outgoing_application(context, instance_id, feed_endpoints, es_endpoint)
+        await create_worker_metrics(context, instance_id, metrics_registry)
+    else:
+        await create_outgoing_application(context, instance_id, feed_endpoints, es_endpoint)
+        await create_metrics_application(
+            context, instance_id, metrics_registry, feed_endpoints, es_endpoint,
+        )
 
     async def cleanup():
-        await cancel_non_current_tasks()
+        # The workers leave their feeds on SIGTERM, which must finish before we exit
+        for worker_task in worker_tasks:
+            worker_task.cancel()
+        if worker_tasks:
+            await asyncio.wait(worker_tasks)
 
-        redis_client.close()
-        await redis_client.wait_closed()
+        await cancel_non_current_tasks()
 
-        await session.close()
+        # So other instances can take over our feeds without waiting for expiry. If
+        # this fails, they take over once the leases expire
+        try:
+            with logged(context.logger, 'Leaving', []):
+                for feed_endpoint in feed_endpoints:
+                    await release_feed_lease(context, feed_endpoint.unique_id, instance_id)
+                await remove_instance(context, instance_id)
+        except (aioredis.RedisError, OSError, asyncio.TimeoutError) as exception:
+            context.logger.warning('Unable to leave, leases will expire (%s)', exception)
+
+        context.redis_client.close()
+        await context.redis_client.wait_closed()
+
+        await context.session.close()
+        await context.es_session.close()
+        if context.es_bulk_spool is not None:
+            context.es_bulk_spool.executor.shutdown()
         # https://github.com/aio-libs/aiohttp/issues/1925
         await asyncio.sleep(0.250)
 
     return cleanup
 
 
-async def create_outgoing_application(context, feed_endpoints, es_endpoint):
+async def create_outgoing_application(context, instance_id, feed_endpoints, es_endpoint):
     async def ingester():
-        await ingest_feeds(context, feed_endpoints, es_endpoint)
+        await ingest_feeds(context, instance_id, feed_endpoints, es_endpoint)
 
     asyncio.get_event_loop().create_task(
         async_repeat_until_cancelled(context, EXCEPTION_INTERVALS, ingester)
     )
 
 
-async def ingest_feeds(context, feed_endpoints, es_endpoint):
+class WorkerExited(Exception):
+    pass
+
+
+async def create_workers_application(parent_context, supervisor_id, num_workers):
+    context = get_child_context(parent_context, 'workers')
+
+    def worker_runner(worker_context, worker_id):
+        async def _worker_runner():
+            heartbeat = asyncio.get_event_loop().create_task(
+                heartbeat_starting_worker(worker_context, worker_id))
+            try:
+                return_code = await run_worker(worker_context, worker_id)
+            finally:
+                heartbeat.cancel()
+
+            if return_code:
+                raise WorkerExited(f'Worker ({worker_id}) exited with code ({return_code})')
+            worker_context.logger.info('Worker (%s) exited, restarting', worker_id)
+            await sleep(worker_context, WORKER_RESTART_INTERVAL)
+        return _worker_runner
+
+    return [
+        asyncio.get_event_loop().create_task(async_repeat_until_cancelled(
+            worker_context, [WORKER_RESTART_INTERVAL], worker_runner(worker_context, worker_id),
+        ))
+        for worker_index in range(0, num_workers)
+        for worker_context in [get_child_context(context, str(worker_index))]
+        for worker_id in [f'{supervisor_id}-{worker_index}']
+    ]
+
+
+async def heartbeat_starting_worker(context, worker_id):
+    try:
+        for _ in range(0, int(WORKER_STARTUP_INTERVAL / LEASE_INTERVAL)):
+            await set_instance_heartbeat(context, worker_id, INSTANCE_TTL)
+            await sleep(context, LEASE_INTERVAL)
+    except (aioredis.RedisError, OSError, asyncio.TimeoutError) as exception:
+        context.logger.warning('Unable to heartbeat for worker (%s) (%s)', worker_id, exception)
+
+
+async def run_worker(context, worker_id):
+    ''' Runs a worker process until it exits, returning its exit code, and it's then
+    restarted by the caller
+
+    The worker keeps its instance id across restarts, so if it is restarted before its
+    heartbeat expires, none of the feeds move between the workers, and it takes back
+    its own leases
+    '''
+    env = {
+        **{key: value for key, value in os.environ.items() if key != 'OUTGOING_WORKERS'},
+        'OUTGOING_WORKER_ID': worker_id,
+        'OUTGOING_SUPERVISOR_PID': str(os.getpid()),
+    }
+    with logged(context.logger, 'Starting worker (%s)', [worker_id]):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', __spec__.name, env=env,
+        )
+
+    try:
+        return_code = await process.wait()
+    except asyncio.CancelledError:
+        with logged(context.logger, 'Stopping worker (%s)', [worker_id]):
+            process.terminate()
+            await process.wait()
+        raise
+
+    return return_code
+
+
+def create_supervisor_watcher(parent_context, supervisor_pid, exception_intervals):
+    ''' Stops this worker if its supervisor has exited, which, if the supervisor was killed,
+    didn't stop its workers. The supervisor passes its pid, since it can exit before the
+    worker has started '''
+    context = get_child_context(parent_context, 'supervisor')
+
+    async def watch_supervisor():
+        if os.getppid() != supervisor_pid:
+            context.logger.warning('Supervisor (%s) has exited, stopping', supervisor_pid)
+            os.kill(os.getpid(), signal.SIGTERM)
+        await sleep(context, WORKER_SUPERVISOR_POLL_INTERVAL)
+
+    asyncio.get_event_loop().create_task(
+        async_repeat_until_cancelled(context, exception_intervals, watch_supervisor)
+    )
+
+
+async def ingest_feeds(context, instance_id, feed_endpoints, es_endpoint):
     all_feed_ids = feed_unique_ids(feed_endpoints)
     indexes_without_alias, indexes_with_alias = await get_old_index_names(context, es_endpoint)
 
     indexes_to_delete = indexes_matching_no_feeds(
         indexes_without_alias + indexes_with_alias, all_feed_ids)
-    await delete_indexes(
-        get_child_context(context, 'initial-delete'), es_endpoint, indexes_to_delete,
+    await delete_unleased_feed_indexes(
+        get_child_context(context, 'initial-delete'), instance_id, es_endpoint,
+        indexes_to_delete,
     )
 
-    def feed_ingester(ingest_type_context, feed_lock, feed_endpoint, ingest_func):
+    leases_context = get_child_context(context, 'leases')
+    feed_ingests = {}
+    try:
+        while True:
+            await lease_feeds(context, instance_id, feed_ingests, feed_endpoints, es_endpoint)
+            await sleep(leases_context, LEASE_INTERVAL)
+    except BaseException:
+        # We can't be sure we still have the leases, so we must stop ingesting. We don't
+        # release them, since the failure is likely to be in Redis itself
+        for feed_id in list(feed_ingests.keys()):
+            await stop_ingest_feed(feed_ingests, feed_id)
+        raise
+
+
+async def delete_unleased_feed_indexes(context, instance_id, es_endpoint, index_names):
+    ''' Deletes the indexes of feeds that no other instance has leased. During a deploy
+    that adds a feed, another instance can be ingesting a feed this one isn't configured
+    with, and its index must not be deleted from under it '''
+    for feed_id, feed_index_names in indexes_by_feed(index_names).items():
+        if not await acquire_feed_lease(context, feed_id, instance_id, LEASE_TTL):
+            context.logger.debug('Not deleting indexes of leased (%s)', feed_id)
+            continue
+        try:
+            await delete_indexes(context, es_endpoint, feed_index_names)
+        finally:
+            await release_feed_lease(context, feed_id, instance_id)
+
+
+async def lease_feeds(parent_context, instance_id, feed_ingests, feed_endpoints, es_endpoint):
+    ''' Leases the feeds assigned to this instance, and releases those that aren't
+
+    Each instance is assigned feeds by rendezvous hashing over the alive instances, so
+    when instances start or stop only the feeds of that instance move. The lease is
+    what guarantees that only one instance ingests from a feed at any one time, and so
+    a feed's ingest is only started once its lease is acquired
+    '''
+    context = get_child_context(parent_context, 'leases')
+    instance_ids = await set_instance_heartbeat(context, instance_id, INSTANCE_TTL)
+
+    for feed in feed_endpoints:
+        is_assigned = rendezvous_owner(instance_ids, feed.unique_id) == instance_id
+        is_ingesting = feed.unique_id in feed_ingests
+
+        if is_ingesting and is_assigned:
+            if not await extend_feed_lease(context, feed.unique_id, instance_id, LEASE_TTL):
+                context.raven_client.captureMessage('Lease has been lost')
+                await stop_ingest_feed(feed_ingests, feed.unique_id)
+
+        elif is_ingesting:
+            with logged(context.logger, 'Handing over (%s)', [feed.unique_id]):
+                await stop_ingest_feed(feed_ingests, feed.unique_id)
+                await release_feed_lease(context, feed.unique_id, instance_id)
+
+        elif is_assigned and await acquire_feed_lease(context, feed.unique_id, instance_id,
+                                                      LEASE_TTL):
+            context.logger.debug('Leased (%s)', feed.unique_id)
+            feed_ingests[feed.unique_id] = asyncio.get_event_loop().create_task(
+                ingest_feed(parent_context, feed, es_endpoint)
+            )
+
+
+async def stop_ingest_feed(feed_ingests, feed_id):
+    ingest_task = feed_ingests.pop(feed_id)
+    ingest_task.cancel()
+    await asyncio.wait([ingest_task])
+
+
+async def ingest_feed(parent_context, feed, es_endpoint):
+    context = get_child_context(parent_context, feed.unique_id)
+    feed_lock = feed.get_lock()
+    feed_state = get_feed_state(feed)
+
+    updates_interval = get_updates_interval(feed)
+
+    # Held while updates are written into the live index and journaled, and while the full
+    # ingest replays the journal into its index and flips the alias to it. Updates can't then
+    # be written into the live index after its replay, and so be lost by the flip
+    journal_lock = asyncio.Lock()
+
+    def feed_ingester(ingest_type_context, ingest_func):
         async def _feed_ingester():
-            await ingest_func(ingest_type_context, feed_lock, feed_endpoint, es_endpoint)
+            await ingest_func(ingest_type_context, feed_lock, feed, es_endpoint)
         return _feed_ingester
 
+    async def ingest_full(context, feed_lock, feed, es_endpoint):
+        await ingest_feed_full(context, feed_lock, feed_state, journal_lock, feed, es_endpoint)
+
+    async def ingest_updates(context, feed_lock, feed, es_endpoint):
+        await ingest_feed_updates(context, feed_lock, feed_state, journal_lock, feed,
+                                  es_endpoint, updates_interval)
+
     await asyncio.gather(*[
-        async_repeat_until_cancelled(context, feed_endpoint.exception_intervals, ingester)
-        for feed_endpoint in feed_endpoints
-        for feed_lock in [feed_endpoint.get_lock()]
-        for feed_context in [get_child_context(context, feed_endpoint.unique_id)]
-        for feed_func_ingest_type in [(ingest_feed_full, 'full'), (ingest_feed_updates, 'updates')]
-        for ingest_type_logger in [get_child_context(feed_context, feed_func_ingest_type[1])]
-        for ingester in [feed_ingester(ingest_type_logger, feed_lock, feed_endpoint,
-                                       feed_func_ingest_type[0])]
+        async_repeat_until_cancelled(parent_context, feed.exception_intervals, ingester)
+        for feed_func_ingest_type in [(ingest_full, 'full'), (ingest_updates, 'updates')]
+        for ingest_type_context in [get_child_context(context, feed_func_ingest_type[1])]
+        for ingester in [feed_ingester(ingest_type_context, feed_func_ingest_type[0])]
     ])
 
 
+def get_feed_state(feed):
+    ''' Shared by the full and updates ingests of a feed '''
+    return {
+        # The request of the updates ingest's long poll, if in progress, which the full ingest
+        # interrupts rather than wait for the feed lock until the feed has changes
+        'long_poll': None,
+        'is_long_poll_interrupted': False,
+        # The interval until the updates ingest next polls the feed
+        'updates_interval': feed.updates_page_interval,
+        # The feed's live indexes that updates are written into, only changed by the full
+        # ingest while it holds the journal lock, so only found once for each ingest of the feed
+        'live_index_names': None,
+    }
+
+
 def feed_unique_ids(feed_endpoints):
     return [feed_endpoint.unique_id for feed_endpoint in feed_endpoints]
 
 
-async def ingest_feed_full(context, feed_lock, feed, es_endpoint):
+async def ingest_feed_full(context, feed_lock, feed_state, journal_lock, feed, es_endpoint):
     metrics = context.metrics
+
+    def stage_timer(stage):
+        return metric_timer(metrics['ingest_feed_full_stage_duration_seconds'],
+                            [feed.unique_id, stage])
+
     with \
             logged(context.logger, 'Full ingest', []), \
             metric_timer(metrics['ingest_feed_duration_seconds'], [feed.unique_id, 'full']), \
@@ -164,86 +504,269 @@ async def ingest_feed_full(context, feed_lock, feed, es_endpoint):
 
         await set_feed_updates_seed_url_init(context, feed.unique_id)
 
-        indexes_without_alias, _ = await get_old_index_names(context, es_endpoint)
-        indexes_to_delete = indexes_matching_feeds(indexes_without_alias, [feed.unique_id])
-        await delete_indexes(context, es_endpoint, indexes_to_delete)
+        # Updates before the index is created are fetched by the full ingest itself
+        await delete_feed_updates_journal(context, feed.unique_id)
 
-        index_name = get_new_index_name(feed.unique_id)
-        await create_index(context, es_endpoint, index_name)
+        with stage_timer('create'):
+            indexes_without_alias, indexes_with_alias = \
+                await get_old_index_names(context, es_endpoint)
+            indexes_to_delete = indexes_matching_feeds(indexes_without_alias, [feed.unique_id])
+            await delete_indexes(context, es_endpoint, indexes_to_delete)
 
-        href = feed.seed
-        while href:
-            updates_href = href
-            href = await ingest_feed_page(
-                context, 'full', feed_lock, feed, es_endpoint, [index_name], href,
+            number_of_shards = await get_number_of_shards(
+                context, es_endpoint, indexes_matching_feeds(indexes_with_alias, [feed.unique_id]),
+                feed.index_config,
             )
-            await sleep(context, feed.full_ingest_page_interval)
+            metrics['ingest_feed_index_shards'].labels(feed.unique_id).set(number_of_shards)
+
+            index_name = get_new_index_name(feed.unique_id)
+            await create_index(context, es_endpoint, index_name, number_of_shards,
+                               feed.es_mappings)
+
+        with stage_timer('pages'):
+            href = feed.seed
+            while href:
+                updates_href = href
+                href, _ = await ingest_feed_page(
+                    context, 'full', feed_lock, feed_state, feed, es_endpoint, [index_name],
+                    href,
+                )
+                await sleep(context, feed.full_ingest_page_interval)
 
-        await refresh_index(context, es_endpoint, index_name)
-        await add_remove_aliases_atomically(context, es_endpoint, index_name, feed.unique_id)
+            await es_bulk_spool_written(context)
+
+        with stage_timer('refresh'):
+            await refresh_index(context, es_endpoint, index_name)
+
+        # Before the replicas are added, so they copy the merged segments
+        if feed.index_config.force_merge_segments:
+            with stage_timer('force_merge'):
+                await force_merge_index(context, es_endpoint, index_name,
+                                        feed.index_config.force_merge_segments)
+
+        with stage_timer('restore_durability'):
+            await restore_index_durability(context, es_endpoint, index_name,
+                                           feed.index_config.number_of_replicas)
+            await wait_for_index_health(context, es_endpoint, index_name,
+                                        feed.index_config.number_of_replicas)
+
+        # Updates were only written into the live index during the full ingest, so are
+        # replayed into the new index before it replaces the live index
+        async with journal_lock:
+            with stage_timer('journal'):
+                await replay_feed_updates_journal(context, feed, es_endpoint, index_name)
+            with stage_timer('alias'):
+                await add_remove_aliases_atomically(context, es_endpoint, index_name,
+                                                    feed.unique_id)
+                feed_state['live_index_names'] = [index_name]
+            await delete_feed_updates_journal(context, feed.unique_id)
         await set_feed_updates_seed_url(context, feed.unique_id, updates_href)
 
 
-async def ingest_feed_updates(context, feed_lock, feed, es_endpoint):
+async def replay_feed_updates_journal(context, feed, es_endpoint, index_name):
+    # Read in batches, so a large journal isn't all in memory at once
+    with logged(context.logger, 'Replaying journaled updates', []):
+        cursor, num_replayed = 0, 0
+        while True:
+            cursor, journal = await get_feed_updates_journal(
+                context, feed.unique_id, cursor, JOURNAL_REPLAY_BATCH_SIZE)
+            await es_bulk_or_spool(context, es_endpoint, [
+                {
+                    'action_and_metadata': {
+                        'index': {
+                            '_id': activity_id,
+                            '_index': index_name,
+                            '_type': '_doc',
+                        },
+                    },
+                    'source': source,
+                }
+                for activity_id, source in journal
+            ])
+            num_replayed += len(journal)
+            if not cursor:
+                break
+        await es_bulk_spool_written(context)
+
+        context.logger.debug('Replayed (%s) journaled updates', num_replayed)
+        if num_replayed:
+            await refresh_index(context, es_endpoint, index_name)
+
+
+def get_updates_interval(feed):
+    ''' The interval before the next updates ingest, which doubles, up to
+    updates_page_interval_max, while updates ingests find only a single page that is empty or
+    the same as before, and returns to updates_page_interval when one finds anything else. If
+    the feed long polls, it waits for changes itself, so the interval doesn't increase '''
+    interval = [feed.updates_page_interval]
+    previous_page_digest = [None]
+
+    def _get_updates_interval(page_digests):
+        # A pass can find no pages at all if it has no URL to start from
+        is_idle = \
+            len(page_digests) <= 1 and \
+            all(page_digest in [None, previous_page_digest[0]] for page_digest in page_digests) \
+            and not feed.long_poll_seconds
+        interval[0] = \
+            min(interval[0] * 2, feed.updates_page_interval_max) if is_idle else \
+            feed.updates_page_interval
+        if page_digests:
+            previous_page_digest[0] = page_digests[-1]
+        return interval[0]
+
+    return _get_updates_interval
+
+
+async def ingest_feed_updates(context, feed_lock, feed_state, journal_lock, feed, es_endpoint,
+                              updates_interval):
     metrics = context.metrics
     with \
             logged(context.logger, 'Updates ingest', []), \
             metric_timer(metrics['ingest_feed_duration_seconds'], [feed.unique_id, 'updates']):
 
         href = await get_feed_updates_url(context, feed.unique_id)
-        indexes_without_alias, indexes_with_alias = await get_old_index_names(context, es_endpoint)
-
-        # We deliberatly ingest into both the live and ingesting indexes
-        indexes_to_ingest_into = indexes_matching_feeds(
-            indexes_without_alias + indexes_with_alias, [feed.unique_id])
 
+        # Only the first page can have nothing new, so only it is long polled
+        page_digests = []
         while href:
             updates_href = href
-            href = await ingest_feed_page(context, 'updates', feed_lock, feed, es_endpoint,
-                                          indexes_to_ingest_into, href)
+            href, page_digest = await ingest_feed_page(
+                context, 'updates', feed_lock, feed_state, feed, es_endpoint, None, href,
+                long_poll_seconds=0 if page_digests else feed.long_poll_seconds,
+                journal_lock=journal_lock,
+            )
+            page_digests.append(page_digest)
 
-        for index_name in indexes_matching_feeds(indexes_with_alias, [feed.unique_id]):
-            await refresh_index(context, es_endpoint, index_name)
+        await es_bulk_spool_written(context)
+        if any(page_digest is not None for page_digest in page_digests):
+            refresh_indexes_later(context, feed_state['live_index_names'])
         await set_feed_updates_url(context, feed.unique_id, updates_href)
 
-    await sleep(context, feed.updates_page_interval)
+    # The feed is shown as red if it's not polled within the interval, so once it's backed off,
+    # it's not shown as red while waiting for the next poll
+    feed_state['updates_interval'] = updates_interval(page_digests)
+    set_feed_status(context, feed.unique_id, get_feed_max_interval(feed, feed_state), b'GREEN')
+    await sleep(context, feed_state['updates_interval'])
 
 
-async def ingest_feed_page(context, ingest_type, feed_lock, feed, es_endpoint, index_names, href):
+async def ingest_feed_page(context, ingest_type, feed_lock, feed_state, feed, es_endpoint,
+                           index_names, href, long_poll_seconds=0, journal_lock=None):
+    ''' Returns the href of the next page, and a digest of this page, None if it's empty or its
+    long poll was interrupted, in which case the href is of this page. If index_names is None,
+    the page is written into the feed's live indexes at the time, found while holding
+    journal_lock, and journaled to be replayed into the index of the full ingest
+    '''
     with \
+            traced(random_log_id(), 'Page', {
+                'context': context.logger.extra['context'], 'href': href,
+            }), \
             logged(context.logger, 'Polling/pushing page', []), \
             metric_timer(context.metrics['ingest_page_duration_seconds'],
                          [feed.unique_id, ingest_type, 'total']):
 
-        # Lock so there is only 1 request per feed at any given time
-        async with feed_lock:
-            with \
-                    logged(context.logger, 'Polling page (%s)', [href]), \
-                    metric_timer(context.metrics['ingest_page_duration_seconds'],
-                                 [feed.unique_id, ingest_type, 'pull']):
-                feed_contents = await get_feed_contents(context, href, feed.auth_headers(href),
-                                                        _http_429_retry_after_context=context)
+        feed_contents = await fetch_feed_page(context, ingest_type, feed_lock, feed_state, feed,
+                                              href, long_poll_seconds)
+        if feed_contents is None:
+            return href, None
 
         with logged(context.logger, 'Parsing JSON', []):
             feed_parsed = ujson.loads(feed_contents)
 
-        with logged(context.logger, 'Converting to bulk Elasticsearch items', []):
-            es_bulk_items = feed.convert_to_bulk_es(feed_parsed, index_names)
-
+        with metric_timer(context.metrics['ingest_page_duration_seconds'],
+                          [feed.unique_id, ingest_type, 'push']):
+            es_bulk_items, es_bulk_size = await write_feed_page(
+                context, feed, feed_state, es_endpoint, index_names, feed_parsed, journal_lock)
+
+        page_labels = [feed.unique_id, ingest_type]
+        context.metrics['ingest_activities_nonunique_total'].labels(feed.unique_id).inc(
+            len(es_bulk_items))
+        context.metrics['ingest_page_size_bytes'].labels(*page_labels).observe(len(feed_contents))
+        context.metrics['ingest_page_items'].labels(*page_labels).observe(len(es_bulk_items))
+        context.metrics['ingest_page_bulk_size_bytes'].labels(*page_labels).observe(es_bulk_size)
+
+        set_feed_status(context, feed.unique_id, get_feed_max_interval(feed, feed_state),
+                        b'GREEN')
+
+        page_digest = hashlib.sha256(feed_contents).digest() if es_bulk_items else None
+        return feed.next_href(feed_parsed), page_digest
+
+
+async def fetch_feed_page(context, ingest_type, feed_lock, feed_state, feed, href,
+                          long_poll_seconds):
+    ''' The contents of the page, or None if it was long polled, and the long poll was
+    interrupted by the full ingest '''
+    # Lock so there is only 1 request per feed at any given time, including a long poll. Only
+    # the updates ingest long polls, and the full ingest interrupts it, rather than wait until
+    # the feed has changes. Updates have priority, so they aren't held up behind the pages of a
+    # full ingest
+    acquire_feed_lock, release_feed_lock = feed_lock
+    if ingest_type == 'full' and feed_state['long_poll'] is not None:
+        feed_state['is_long_poll_interrupted'] = True
+        feed_state['long_poll'].cancel()
+
+    with metric_timer(context.metrics['ingest_feed_lock_wait_seconds'],
+                      [feed.unique_id, ingest_type]):
+        await acquire_feed_lock(is_priority=ingest_type == 'updates')
+    try:
         with \
+                logged(context.logger, 'Polling page (%s)', [href]), \
                 metric_timer(context.metrics['ingest_page_duration_seconds'],
-                             [feed.unique_id, ingest_type, 'push']), \
-                metric_counter(context.metrics['ingest_activities_nonunique_total'],
-                               [feed.unique_id], len(es_bulk_items)):
-            await es_bulk(context, es_endpoint, es_bulk_items)
+                             [feed.unique_id, ingest_type, 'pull']):
+            request = asyncio.ensure_future(get_feed_contents(context, href, {
+                **feed.auth_headers(href),
+                **({'Prefer': f'wait={long_poll_seconds}'} if long_poll_seconds else {}),
+            }, _http_429_retry_after_context=context))
+            if long_poll_seconds:
+                feed_state['long_poll'] = request
+                feed_state['is_long_poll_interrupted'] = False
+            try:
+                return await request
+            except asyncio.CancelledError:
+                if not (long_poll_seconds and feed_state['is_long_poll_interrupted']):
+                    raise
+                context.logger.debug('Long poll interrupted by full ingest')
+                return None
+            finally:
+                # The request is its own task, so it would outlive the ingest if cancelled
+                request.cancel()
+                if long_poll_seconds:
+                    feed_state['long_poll'] = None
+    finally:
+        release_feed_lock()
+
+
+def get_feed_max_interval(feed, feed_state):
+    ''' The longest the feed is expected to go without being polled '''
+    assumed_max_es_ingest_time = 10
+    return \
+        max(feed.full_ingest_page_interval, feed_state['updates_interval'],
+            feed.long_poll_seconds) + \
+        assumed_max_es_ingest_time
+
+
+async def write_feed_page(context, feed, feed_state, es_endpoint, index_names, feed_parsed,
+                          journal_lock):
+    ''' Returns the bulk items and their size in bytes. If index_names is None, they are
+    written into the feed's live indexes and journaled, as in ingest_feed_page '''
+    async def write_page(index_names):
+        with logged(context.logger, 'Converting to bulk Elasticsearch items', []):
+            es_bulk_items = feed.convert_to_bulk_es(feed_parsed, index_names)
+        return es_bulk_items, await es_bulk_or_spool(context, es_endpoint, es_bulk_items)
 
-        assumed_max_es_ingest_time = 10
-        max_interval = \
-            max(feed.full_ingest_page_interval, feed.updates_page_interval) + \
-            assumed_max_es_ingest_time
-        asyncio.ensure_future(set_feed_status(context, feed.unique_id, max_interval, b'GREEN'))
+    if index_names is not None:
+        return await write_page(index_names)
 
-        return feed.next_href(feed_parsed)
+    async with journal_lock:
+        if feed_state['live_index_names'] is None:
+            _, indexes_with_alias = await get_old_index_names(context, es_endpoint)
+            feed_state['live_index_names'] = \
+                indexes_matching_feeds(indexes_with_alias, [feed.unique_id])
+        es_bulk_items, es_bulk_size = await write_page(feed_state['live_index_names'])
+        await append_feed_updates_journal(context, feed.unique_id, [
+            (es_bulk_item['action_and_metadata']['index']['_id'], es_bulk_item['source'])
+            for es_bulk_item in es_bulk_items
+        ])
+    return es_bulk_items, es_bulk_size
 
 
 @http_429_retry_after
@@ -253,40 +776,32 @@ async def get_feed_contents(context, href, headers, **_):
         return await result.read()
 
 
-async def create_metrics_application(parent_context, metrics_registry, feed_endpoints,
-                                     es_endpoint):
+async def create_metrics_application(parent_context, instance_id, metrics_registry,
+                                     feed_endpoints, es_endpoint):
     context = get_child_context(parent_context, 'metrics')
-    metrics = context.metrics
 
     async def poll_metrics():
-        with logged(context.logger, 'Polling', []):
-            searchable = await es_searchable_total(context, es_endpoint)
-            metrics['elasticsearch_activities_total'].labels('searchable').set(searchable)
+        await poll_es_metrics(context, feed_endpoints, es_endpoint)
 
-            await set_metric_if_can(
-                metrics['elasticsearch_activities_total'],
-                ['nonsearchable'],
-                es_nonsearchable_total(context, es_endpoint),
-            )
-            await set_metric_if_can(
-                metrics['elasticsearch_activities_age_minimum_seconds'],
-                ['verification'],
-                es_min_verification_age(context, es_endpoint),
-            )
+        # Each instance only has the ingest metrics of the feeds it has ingested, so
+        # they are combined with those of the other alive instances
+        await redis_set_instance_metrics(context, instance_id, generate_latest(metrics_registry),
+                                         INSTANCE_METRICS_EXPIRE)
+        await set_merged_metrics(context, [])
+        await sleep(context, METRICS_INTERVAL)
 
-            feed_ids = feed_unique_ids(feed_endpoints)
-            for feed_id in feed_ids:
-                try:
-                    searchable, nonsearchable = await es_feed_activities_total(
-                        context, es_endpoint, feed_id)
-                    metrics['elasticsearch_feed_activities_total'].labels(
-                        feed_id, 'searchable').set(searchable)
-                    metrics['elasticsearch_feed_activities_total'].labels(
-                        feed_id, 'nonsearchable').set(nonsearchable)
-                except ESMetricsUnavailable:
-                    pass
-
-        await redis_set_metrics(context, generate_latest(metrics_registry))
+    asyncio.get_event_loop().create_task(
+        async_repeat_until_cancelled(context, EXCEPTION_INTERVALS, poll_metrics)
+    )
+
+
+async def create_worker_metrics(parent_context, instance_id, metrics_registry):
+    context = get_child_context(parent_context, 'metrics')
+
+    # The supervisor polls Elasticsearch and merges, so each worker just exports its own
+    async def poll_metrics():
+        await redis_set_instance_metrics(context, instance_id, generate_latest(metrics_registry),
+                                         INSTANCE_METRICS_EXPIRE)
         await sleep(context, METRICS_INTERVAL)
 
     asyncio.get_event_loop().create_task(
@@ -294,6 +809,68 @@ async def create_metrics_application(parent_context, metrics_registry, feed_endp
     )
 
 
+async def create_supervisor_metrics(parent_context, metrics_registry, feed_endpoints,
+                                    es_endpoint):
+    context = get_child_context(parent_context, 'metrics')
+
+    async def poll_metrics():
+        await poll_es_metrics(context, feed_endpoints, es_endpoint)
+        await set_merged_metrics(context, [generate_latest(metrics_registry)])
+        await sleep(context, METRICS_INTERVAL)
+
+    asyncio.get_event_loop().create_task(
+        async_repeat_until_cancelled(context, EXCEPTION_INTERVALS, poll_metrics)
+    )
+
+
+async def poll_es_metrics(context, feed_endpoints, es_endpoint):
+    metrics = context.metrics
+
+    with logged(context.logger, 'Polling', []):
+        searchable = await es_searchable_total(context, es_endpoint)
+        metrics['elasticsearch_activities_total'].labels('searchable').set(searchable)
+
+        await set_metric_if_can(
+            metrics['elasticsearch_activities_total'],
+            ['nonsearchable'],
+            es_nonsearchable_total(context, es_endpoint),
+        )
+        await set_metric_if_can(
+            metrics['elasticsearch_activities_age_minimum_seconds'],
+            ['verification'],
+            es_min_verification_age(context, es_endpoint),
+        )
+
+        feed_ids = feed_unique_ids(feed_endpoints)
+        for feed_id in feed_ids:
+            try:
+                searchable, nonsearchable = await es_feed_activities_total(
+                    context, es_endpoint, feed_id)
+                metrics['elasticsearch_feed_activities_total'].labels(
+                    feed_id, 'searchable').set(searchable)
+                metrics['elasticsearch_feed_activities_total'].labels(
+                    feed_id, 'nonsearchable').set(nonsearchable)
+            except ESMetricsUnavailable:
+                pass
+
+            await set_metric_if_can(
+                metrics['elasticsearch_feed_index_bytes'],
+                [feed_id],
+                es_feed_index_bytes(context, es_endpoint, feed_id),
+            )
+
+
+async def set_merged_metrics(context, metrics_texts):
+    instance_ids = await get_instance_ids(context)
+    instances_metrics = \
+        await redis_get_instances_metrics(context, instance_ids) if instance_ids else \
+        []
+    await redis_set_metrics(context, merge_metrics(metrics_texts + [
+        instance_metrics for instance_metrics in instances_metrics
+        if instance_metrics is not None
+    ]))
+
+
 async def set_metric_if_can(metric, labels, get_value_coroutine):
     try:
         metric.labels(*labels).set(await get_value_coroutine)
@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+PROFILE_INTERVAL = 0.005
+PROFILE_SECONDS = 10
+PROFILE_SECONDS_MAX = 60
+MEMORY_DIFF_SECONDS = 10
+MEMORY_DIFF_SECONDS_MAX = 60
+MEMORY_STATISTICS_LIMIT = 50
+MEMORY_TRACEBACK_FRAMES = 10
+
+# Diffs can overlap, so tracing is stopped only when the last of them finishes, and only if a
+# diff started it
+_MEMORY_TRACING = {'diffs': 0, 'started_by_diff': False}
+
+
+async def profile(seconds):
+    ''' Samples the stacks of the thread running the event loop for `seconds`, returning
+    the number of times each stack was seen '''
+    thread_id = threading.get_ident()
+    return await asyncio.get_event_loop().run_in_executor(
+        None, sample_stacks, thread_id, seconds, PROFILE_INTERVAL,
+    )
+
+
+def sample_stacks(thread_id, seconds, interval):
+    ''' Samples from another thread, so other than waiting for the GIL, the profiled thread
+    runs as normal. Frames are identified by the first line of their function, so all the
+    samples in a function are combined '''
+    stacks = collections.Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        # pylint: disable=protected-access
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        stacks[tuple(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed_stacks(stacks):
+    ''' The format of Brendan Gregg's flamegraph.pl, also importable into speedscope '''
+    return ''.join(
+        ';'.join(f'{name} ({filename}:{line})' for name, filename, line in stack) +
+        f' {count}\n'
+        for stack, count in stacks.items()
+    )
+
+
+def speedscope_profile(stacks, seconds):
+    frames = list({frame for stack in stacks for frame in stack})
+    frame_indexes = {frame: i for i, frame in enumerate(frames)}
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': {
+            'frames': [
+                {'name': name, 'file': filename, 'line': line}
+                for name, filename, line in frames
+            ],
+        },
+        'profiles': [{
+            'type': 'sampled',
+            'name': f'activity-stream ({os.getpid()})',
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': seconds,
+            'samples': [[frame_indexes[frame] for frame in stack] for stack in stacks.keys()],
+            'weights': [count * PROFILE_INTERVAL for count in stacks.values()],
+        }],
+    }
+
+
+async def write_profile(logger):
+    ''' For processes without an HTTP server: profiles, and writes the profile to a file '''
+    stacks = await profile(PROFILE_SECONDS)
+    path = os.path.join(tempfile.gettempdir(), f'profile-{os.getpid()}-{int(time.time())}.txt')
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(collapsed_stacks(stacks))
+    logger.info('Written profile to (%s)', path)
+
+
+async def memory_diff(seconds):
+    ''' Traces allocations for `seconds`, returning where the memory still allocated at the
+    end was allocated, so what grows or is leaked. Tracing slows allocations, so it's only
+    on while a diff is taken, unless it was already on '''
+    if not _MEMORY_TRACING['diffs']:
+        _MEMORY_TRACING['started_by_diff'] = not tracemalloc.is_tracing()
+        if _MEMORY_TRACING['started_by_diff']:
+            tracemalloc.start(MEMORY_TRACEBACK_FRAMES)
+    _MEMORY_TRACING['diffs'] += 1
+    try:
+        before = memory_snapshot()
+        await asyncio.sleep(seconds)
+        after = memory_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        _MEMORY_TRACING['diffs'] -= 1
+        if not _MEMORY_TRACING['diffs'] and _MEMORY_TRACING['started_by_diff']:
+            tracemalloc.stop()
+
+    # Grouped by traceback, so allocations in shared code are attributed to their callers
+    statistics = after.compare_to(before, 'traceback')[:MEMORY_STATISTICS_LIMIT]
+    return \
+        f'Traced memory: current={current} peak={peak}\n' + \
+        ''.join(
+            f'\n{statistic}\n' + ''.join(f'{line}\n' for line in statistic.traceback.format())
+            for statistic in statistics
+        )
+
+
+def memory_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+
+
+async def write_memory_diff(logger):
+    ''' For processes without an HTTP server: diffs memory, and writes the diff to a file '''
+    diff = await memory_diff(MEMORY_DIFF_SECONDS)
+    path = os.path.join(tempfile.gettempdir(), f'memory-{os.getpid()}-{int(time.time())}.txt')
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(diff)
+    logger.info('Written memory diff to (%s)', path)
@@ -0,0 +1,172 @@
+import asyncio
+import collections
+import itertools
+
+from shared.logger import (
+    logged,
+)
+
+from .app_elasticsearch import (
+    ESRejected,
+    es_bulk,
+    get_old_index_names,
+    indexes_matching_feeds,
+    refresh_indexes_later,
+)
+from .app_feeds import (
+    ActivityStreamFeed,
+)
+from .app_metrics import (
+    metric_timer,
+)
+from .app_redis import (
+    append_feed_updates_journal,
+)
+from .app_utils import (
+    async_repeat_until_cancelled,
+    get_child_context,
+    sleep,
+)
+
+PUSH_QUEUE_MAX_ITEMS = 10000
+PUSH_BATCH_MAX_ITEMS = 1000
+
+# After the first item arrives, the writer waits this long for more to write in the same batch
+PUSH_BATCH_LINGER = 0.1
+
+PushQueue = collections.namedtuple(
+    'PushQueue', ['items', 'max_items', 'is_not_empty'],
+)
+
+
+def get_push_queue(max_items):
+    ''' Activities pushed to this instance, waiting to be written to Elasticsearch, as
+    (feed_unique_id, item) pairs '''
+    return PushQueue(items=collections.deque(), max_items=max_items,
+                     is_not_empty=asyncio.Event())
+
+
+def push_queue_put(context, push_queue, feed_unique_id, items):
+    ''' Returns False without queuing any items if they don't all fit '''
+    if len(push_queue.items) + len(items) > push_queue.max_items:
+        context.metrics['push_activities_total'].labels(feed_unique_id, 'rejected').inc(
+            len(items))
+        return False
+
+    push_queue.items.extend((feed_unique_id, item) for item in items)
+    push_queue.is_not_empty.set()
+    context.metrics['push_activities_total'].labels(feed_unique_id, 'accepted').inc(len(items))
+    context.metrics['push_queue_items'].set(len(push_queue.items))
+    return True
+
+
+def create_push_writer(parent_context, es_endpoint, push_queue, exception_intervals):
+    context = get_child_context(parent_context, 'push')
+
+    async def write_batch():
+        await push_queue.is_not_empty.wait()
+        await sleep(context, PUSH_BATCH_LINGER)
+
+        # Items are only removed once written or dropped, so are retried if Elasticsearch is
+        # unavailable
+        batch = list(itertools.islice(push_queue.items, 0, PUSH_BATCH_MAX_ITEMS))
+        with \
+                logged(context.logger, 'Writing (%s) pushed items', [len(batch)]), \
+                metric_timer(context.metrics['push_batch_duration_seconds'], []):
+            await write_items(context, es_endpoint, batch)
+
+        for _ in batch:
+            push_queue.items.popleft()
+        if not push_queue.items:
+            push_queue.is_not_empty.clear()
+        context.metrics['push_queue_items'].set(len(push_queue.items))
+
+    asyncio.get_event_loop().create_task(
+        async_repeat_until_cancelled(context, exception_intervals, write_batch)
+    )
+
+
+async def write_items(context, es_endpoint, feed_unique_ids_items):
+    items_by_feed = collections.defaultdict(list)
+    for feed_unique_id, item in feed_unique_ids_items:
+        items_by_feed[feed_unique_id].append(item)
+
+    # Journaled as updates are, but before the indexes are found, since the full ingest's lock
+    # is in another process. If its index is created after they are found, they are replayed
+    # into it from the journal, or if they were journaled before the full ingest cleared it,
+    # fetched by the full ingest itself. If it replays the journal before they are journaled,
+    # they are found after its index is created, and written into it
+    for feed_unique_id, items in items_by_feed.items():
+        await append_feed_updates_journal(context, feed_unique_id, [
+            (item['id'], item) for item in items
+        ])
+
+    indexes_without_alias, indexes_with_alias = await get_old_index_names(context, es_endpoint)
+
+    # Into both the live and ingesting indexes, so they are searchable now, and remain
+    # searchable after the ingesting index replaces the live index. Pushes are rejected if
+    # their feed has no index, but its indexes could have been deleted since
+    feed_index_names = {
+        feed_unique_id: indexes_matching_feeds(indexes_without_alias + indexes_with_alias,
+                                               [feed_unique_id])
+        for feed_unique_id in items_by_feed
+    }
+    for feed_unique_id, index_names in feed_index_names.items():
+        if not index_names:
+            num_items = len(items_by_feed[feed_unique_id])
+            context.logger.warning('Dropping (%s) pushed items of (%s) without an index',
+                                   num_items, feed_unique_id)
+            context.metrics['push_activities_total'].labels(feed_unique_id, 'dropped').inc(
+                num_items)
+
+    await es_bulk_or_drop(context, es_endpoint, [
+        (feed_unique_id, item, feed_index_names[feed_unique_id])
+        for feed_unique_id, item in feed_unique_ids_items
+        if feed_index_names[feed_unique_id]
+    ])
+
+    refresh_indexes_later(
+        context, indexes_matching_feeds(indexes_with_alias, list(items_by_feed.keys())))
+
+
+async def es_bulk_or_drop(context, es_endpoint, feed_items_indexes):
+    ''' Writes (feed_unique_id, item, index_names) triples, and if Elasticsearch rejects them,
+    splits them in half and writes each half, so only items it rejects on their own are dropped.
+    Items it rejects individually in a bulk ingest it accepts are dropped without splitting
+    '''
+    # The position of each bulk ingest command's item, since an item is written into each of
+    # its indexes
+    es_bulk_items_positions = [
+        (es_bulk_item, position)
+        for position, (_, item, index_names) in enumerate(feed_items_indexes)
+        for es_bulk_item in ActivityStreamFeed.convert_to_bulk_es(
+            {'orderedItems': [item]}, index_names,
+        )
+    ]
+    try:
+        rejected_positions = await es_bulk(context, es_endpoint, [
+            es_bulk_item for es_bulk_item, _ in es_bulk_items_positions
+        ])
+    except ESRejected:
+        if len(feed_items_indexes) == 1:
+            drop_item(context, *feed_items_indexes[0])
+            return
+
+        middle = len(feed_items_indexes) // 2
+        for half in [feed_items_indexes[:middle],
+                     feed_items_indexes[middle:]]:
+            await es_bulk_or_drop(context, es_endpoint, half)
+        return
+
+    # An item rejected from any of its indexes is dropped, even if written into the others
+    for position in sorted(set(
+            es_bulk_items_positions[rejected_position][1]
+            for rejected_position in rejected_positions
+    )):
+        drop_item(context, *feed_items_indexes[position])
+
+
+def drop_item(context, feed_unique_id, item, _):
+    context.logger.warning('Dropping pushed item (%s) (%s) rejected by Elasticsearch',
+                           feed_unique_id, item['id'])
+    context.metrics['push_activities_total'].labels(feed_unique_id, 'dropped').inc()
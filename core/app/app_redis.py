@@ -1,12 +1,20 @@
 import asyncio
+import collections
+import hashlib
+import time
 
 import aioredis
+import ujson
 
 from shared.logger import (
     logged,
 )
+from .app_metrics import (
+    metric_timer,
+)
 from .app_utils import (
     async_repeat_until_cancelled,
+    flatten,
     get_child_context,
     sleep,
 )
@@ -16,63 +24,176 @@ from .app_utils import (
 FEED_UPDATE_URL_EXPIRE = 60 * 60 * 24 * 31
 NOT_EXISTS = b'__NOT_EXISTS__'
 SHOW_FEED_AS_RED_IF_NO_REQUEST_IN_SECONDS = 10
+REDIS_POOL_SIZE = 3
+INSTANCES_KEY = 'outgoing-instances'
+
+RedisScript = collections.namedtuple('RedisScript', ['name', 'source', 'sha'])
+
+
+def redis_script(name, source):
+    return RedisScript(name=name, source=source,
+                       sha=hashlib.sha1(source.encode('utf-8')).hexdigest())
+
+
+# Equivalent to an atomic GETSET of the seed key to NOT_EXISTS, followed by a GET
+# of the latest key if the seed key didn't have a URL
+GET_FEED_UPDATES_URL_SCRIPT = redis_script('GET_FEED_UPDATES_URL', '''
+local seed_url = redis.call('GETSET', KEYS[1], ARGV[1])
+if seed_url and seed_url ~= ARGV[1] then
+    return seed_url
+end
+return redis.call('GET', KEYS[2])
+''')
+
+# Acquires the lock if no-one has it, or re-acquires it if we already have it
+LOCK_ACQUIRE_SCRIPT = redis_script('LOCK_ACQUIRE', '''
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+''')
+
+# Extends the lock only if we still have it
+LOCK_EXTEND_SCRIPT = redis_script('LOCK_EXTEND', '''
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('EXPIRE', KEYS[1], ARGV[2])
+''')
+
+# Releases the lock only if we still have it
+LOCK_RELEASE_SCRIPT = redis_script('LOCK_RELEASE', '''
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+''')
+
+# Instances are members of a sorted set, scored by the time they are alive until
+INSTANCE_HEARTBEAT_SCRIPT = redis_script('INSTANCE_HEARTBEAT', '''
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+return redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], '+inf')
+''')
+
+
+async def redis_get_client(redis_uri, pool_size):
+    return await aioredis.create_redis_pool(redis_uri, minsize=pool_size, maxsize=pool_size)
+
+
+def redis_get_write_queue():
+    return {
+        # Only the latest pending write to each key is kept
+        'writes': collections.OrderedDict(),
+        'has_writes': asyncio.Event(),
+    }
+
+
+async def redis_execute(context, command, *args):
+    with metric_timer(context.metrics['redis_command_duration_seconds'], [command]):
+        return await context.redis_client.execute(command, *args)
+
+
+async def redis_eval(context, script, keys, args):
+    ''' Runs a Lua script, only sending its source if Redis doesn't have it cached '''
+    with metric_timer(context.metrics['redis_command_duration_seconds'], [script.name]):
+        try:
+            return await context.redis_client.execute(
+                'EVALSHA', script.sha, len(keys), *keys, *args)
+        except aioredis.ReplyError as error:
+            if not str(error).startswith('NOSCRIPT'):
+                raise
+        return await context.redis_client.execute(
+            'EVAL', script.source, len(keys), *keys, *args)
+
+
+def redis_set_later(context, key, value, expire):
+    ''' Fire-and-forget SET, coalesced with others into a single pipeline '''
+    write_queue = context.redis_write_queue
+    write_queue['writes'].pop(key, None)
+    write_queue['writes'][key] = (value, expire)
+    write_queue['has_writes'].set()
+
+
+async def redis_flush_writes(context):
+    write_queue = context.redis_write_queue
+    await write_queue['has_writes'].wait()
+    write_queue['has_writes'].clear()
+
+    writes = list(write_queue['writes'].items())
+    write_queue['writes'].clear()
+
+    pipeline = context.redis_client.pipeline()
+    for key, (value, expire) in writes:
+        pipeline.set(key, value, expire=expire)
+
+    with \
+            logged(context.logger, 'Flushing (%s) writes to Redis', [len(writes)]), \
+            metric_timer(context.metrics['redis_command_duration_seconds'], ['PIPELINE']):
+        await pipeline.execute()
+
+
+def create_redis_writes_flusher(parent_context, exception_intervals):
+    context = get_child_context(parent_context, 'redis-writes')
+
+    async def flush_writes_forever():
+        await redis_flush_writes(context)
 
-
-async def redis_get_client(redis_uri):
-    return await aioredis.create_redis_pool(redis_uri, minsize=3, maxsize=3)
+    asyncio.get_event_loop().create_task(async_repeat_until_cancelled(
+        context, exception_intervals, flush_writes_forever,
+    ))
 
 
 async def set_private_scroll_id(context, public_scroll_id, private_scroll_id, expire):
-    await context.redis_client.execute('SET', f'private-scroll-id-{public_scroll_id}',
-                                       private_scroll_id, 'EX', expire)
+    await redis_execute(context, 'SET', f'private-scroll-id-{public_scroll_id}',
+                        private_scroll_id, 'EX', expire)
 
 
 async def get_private_scroll_id(context, public_scroll_id):
-    return await context.redis_client.execute('GET', f'private-scroll-id-{public_scroll_id}')
+    return await redis_execute(context, 'GET', f'private-scroll-id-{public_scroll_id}')
+
+
+async def set_instance_heartbeat(context, instance_id, ttl):
+    ''' Marks the instance as alive for the next ttl seconds, returning all alive instances '''
+    now = time.time()
+    instance_ids = await redis_eval(context, INSTANCE_HEARTBEAT_SCRIPT, [INSTANCES_KEY],
+                                    [now, now + ttl, instance_id])
+    return [instance_id.decode('utf-8') for instance_id in instance_ids]
 
 
-async def acquire_and_keep_lock(parent_context, exception_intervals, key):
-    ''' Prevents Elasticsearch errors during deployments
+async def get_instance_ids(context):
+    instance_ids = await redis_execute(context, 'ZRANGEBYSCORE', INSTANCES_KEY, time.time(),
+                                       '+inf')
+    return [instance_id.decode('utf-8') for instance_id in instance_ids]
 
-    The exceptions would be caused by a new deployment deleting indexes while
-    the previous deployment is still ingesting into them
 
-    We do not offer a delete for simplicity: the lock will just expire if it's
-    not extended, which happens on destroy of the application
+async def remove_instance(context, instance_id):
+    await redis_execute(context, 'ZREM', INSTANCES_KEY, instance_id)
 
-    We don't use Redlock, since we don't care too much if a Redis failure causes
-    multiple clients to have the lock for a period of time. It would only cause
-    Elasticsearch errors to appear in sentry, but otherwise there would be no
-    harm
+
+async def acquire_feed_lease(context, feed_id, instance_id, ttl):
+    ''' Prevents more than one instance ingesting from a feed at any one time
+
+    This both keeps the guarantee of a single request to each feed, and prevents
+    Elasticsearch errors caused by one instance deleting indexes that another is
+    ingesting into, e.g. during deployments
+
+    We do not use Redlock, since we don't care too much if a Redis failure causes
+    multiple instances to have the lease for a period of time
     '''
-    context = get_child_context(parent_context, 'lock')
-    logger = context.logger
-    redis_client = context.redis_client
-    ttl = 3
-    aquire_interval = 0.5
-    extend_interval = 0.5
-
-    async def acquire():
-        while True:
-            logger.debug('Acquiring...')
-            response = await redis_client.execute('SET', key, '1', 'EX', ttl, 'NX')
-            if response == b'OK':
-                logger.debug('Acquiring... (done)')
-                break
-            logger.debug('Acquiring... (failed)')
-            await sleep(context, aquire_interval)
+    return await redis_eval(context, LOCK_ACQUIRE_SCRIPT, ['feed-lease-' + feed_id],
+                            [instance_id, ttl]) == 1
 
-    async def extend_forever():
-        await sleep(context, extend_interval)
-        response = await redis_client.execute('EXPIRE', key, ttl)
-        if response != 1:
-            context.raven_client.captureMessage('Lock has been lost')
-            await acquire()
 
-    await acquire()
-    asyncio.get_event_loop().create_task(async_repeat_until_cancelled(
-        context, exception_intervals, extend_forever,
-    ))
+async def extend_feed_lease(context, feed_id, instance_id, ttl):
+    return await redis_eval(context, LOCK_EXTEND_SCRIPT, ['feed-lease-' + feed_id],
+                            [instance_id, ttl]) == 1
+
+
+async def release_feed_lease(context, feed_id, instance_id):
+    await redis_eval(context, LOCK_RELEASE_SCRIPT, ['feed-lease-' + feed_id], [instance_id])
 
 
 async def get_feed_updates_url(context, feed_id):
@@ -85,22 +206,12 @@ async def get_feed_updates_url(context, feed_id):
     with logged(context.logger, 'Getting updates url', []):
         while True:
             # We want the equivalent of an atomic GET/DEL, to avoid the race condition that the
-            # full ingest sets the updates seed URL, but the updates chain then overwrites it
-            # There is no atomic GETDEL command available, but it could be done with redis multi
-            # exec, but, we have multiple concurrent usages of the redis client, which I suspect
-            # would make transactions impossible right now
-            # We do have an atomic GETSET however, so we use that with a special NOT_EXISTS value
-            updates_seed_url = await context.redis_client.execute('GETSET', updates_seed_url_key,
-                                                                  NOT_EXISTS)
-            context.logger.debug('Getting updates url... (seed: %s)', updates_seed_url)
-            if updates_seed_url is not None and updates_seed_url != NOT_EXISTS:
-                url = updates_seed_url
-                break
-
-            updates_latest_url = await context.redis_client.execute('GET', updates_latest_url_key)
-            context.logger.debug('Getting updates url... (latest: %s)', updates_latest_url)
-            if updates_latest_url is not None:
-                url = updates_latest_url
+            # full ingest sets the updates seed URL, but the updates chain then overwrites it.
+            # The script does a GETSET with a special NOT_EXISTS value, and falls back to the
+            # latest URL, in a single round trip
+            url = await redis_eval(context, GET_FEED_UPDATES_URL_SCRIPT,
+                                   [updates_seed_url_key, updates_latest_url_key], [NOT_EXISTS])
+            if url is not None:
                 break
 
             await sleep(context, 1)
@@ -112,7 +223,8 @@ async def get_feed_updates_url(context, feed_id):
 async def set_feed_updates_seed_url_init(context, feed_id):
     updates_seed_url_key = 'feed-updates-seed-url-' + feed_id
     with logged(context.logger, 'Setting updates seed url initial to (%s)', [NOT_EXISTS]):
-        result = await context.redis_client.execute(
+        result = await redis_execute(
+            context,
             'SET', updates_seed_url_key, NOT_EXISTS,
             'EX', FEED_UPDATE_URL_EXPIRE,
             'NX',
@@ -124,38 +236,89 @@ async def set_feed_updates_seed_url_init(context, feed_id):
 async def set_feed_updates_seed_url(context, feed_id, updates_url):
     updates_seed_url_key = 'feed-updates-seed-url-' + feed_id
     with logged(context.logger, 'Setting updates seed url to (%s)', [updates_url]):
-        await context.redis_client.execute('SET', updates_seed_url_key, updates_url,
-                                           'EX', FEED_UPDATE_URL_EXPIRE)
+        await redis_execute(context, 'SET', updates_seed_url_key, updates_url,
+                            'EX', FEED_UPDATE_URL_EXPIRE)
 
 
 async def set_feed_updates_url(context, feed_id, updates_url):
     updates_latest_url_key = 'feed-updates-latest-url-' + feed_id
     with logged(context.logger, 'Setting updates url to (%s)', [updates_url]):
-        await context.redis_client.execute('SET', updates_latest_url_key, updates_url,
-                                           'EX', FEED_UPDATE_URL_EXPIRE)
+        await redis_execute(context, 'SET', updates_latest_url_key, updates_url,
+                            'EX', FEED_UPDATE_URL_EXPIRE)
+
+
+async def append_feed_updates_journal(context, feed_id, ids_and_sources):
+    ''' The latest source of each activity written by updates or pushed, keyed by its id. As
+    the URLs of feeds, it expires if the feed is turned off '''
+    journal_key = 'feed-updates-journal-' + feed_id
+    sources_by_id = {
+        activity_id: ujson.dumps(source, escape_forward_slashes=False, ensure_ascii=False)
+        for activity_id, source in ids_and_sources
+    }
+    if not sources_by_id:
+        return
+
+    pipeline = context.redis_client.pipeline()
+    pipeline.hmset(journal_key, *flatten(sources_by_id.items()))
+    pipeline.expire(journal_key, FEED_UPDATE_URL_EXPIRE)
+
+    with \
+            logged(context.logger, 'Journaling (%s) updates', [len(sources_by_id)]), \
+            metric_timer(context.metrics['redis_command_duration_seconds'], ['PIPELINE']):
+        await pipeline.execute()
+
+
+async def get_feed_updates_journal(context, feed_id, cursor, count):
+    ''' The next cursor, and around count (id, source) pairs of the activities written by
+    updates or pushed, from cursor, 0 to start from the beginning. The next cursor is 0 once
+    the journal has been read, and an activity may be in more than one batch '''
+    journal_key = 'feed-updates-journal-' + feed_id
+    with logged(context.logger, 'Getting updates journal from (%s)', [cursor]):
+        next_cursor, ids_and_sources = await redis_execute(
+            context, 'HSCAN', journal_key, cursor, 'COUNT', count)
+    return int(next_cursor), [
+        (activity_id.decode('utf-8'), ujson.loads(source))
+        for activity_id, source in zip(ids_and_sources[0::2], ids_and_sources[1::2])
+    ]
+
+
+async def delete_feed_updates_journal(context, feed_id):
+    journal_key = 'feed-updates-journal-' + feed_id
+    with logged(context.logger, 'Deleting updates journal', []):
+        await redis_execute(context, 'DEL', journal_key)
 
 
 async def redis_set_metrics(context, metrics):
     with logged(context.logger, 'Saving to Redis', []):
-        await context.redis_client.execute('SET', 'metrics', metrics)
+        await redis_execute(context, 'SET', 'metrics', metrics)
 
 
 async def redis_get_metrics(context):
-    return await context.redis_client.execute('GET', 'metrics')
+    return await redis_execute(context, 'GET', 'metrics')
+
+
+async def redis_set_instance_metrics(context, instance_id, metrics, expire):
+    await redis_execute(context, 'SET', 'metrics-instance-' + instance_id, metrics,
+                        'EX', expire)
+
+
+async def redis_get_instances_metrics(context, instance_ids):
+    return await redis_execute(context, 'MGET', *[
+        'metrics-instance-' + instance_id for instance_id in instance_ids
+    ])
 
 
 async def set_nonce_nx(context, nonce_key, nonce_expire):
-    return await context.redis_client.execute('SET', nonce_key, '1',
-                                              'EX', nonce_expire, 'NX')
+    return await redis_execute(context, 'SET', nonce_key, '1',
+                               'EX', nonce_expire, 'NX')
 
 
-async def set_feed_status(context, feed_id, feed_max_interval, status):
-    await context.redis_client.execute(
-        'SET', feed_id + '-status', status,
-        'EX', feed_max_interval + SHOW_FEED_AS_RED_IF_NO_REQUEST_IN_SECONDS)
+def set_feed_status(context, feed_id, feed_max_interval, status):
+    redis_set_later(context, feed_id + '-status', status,
+                    feed_max_interval + SHOW_FEED_AS_RED_IF_NO_REQUEST_IN_SECONDS)
 
 
 async def get_feeds_status(context, feed_ids):
-    return await context.redis_client.execute('MGET', *[
+    return await redis_execute(context, 'MGET', *[
         feed_id + '-status' for feed_id in feed_ids
     ])
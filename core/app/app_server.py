@@ -2,6 +2,10 @@ import hmac
 import time
 
 from aiohttp import web
+from prometheus_client import (
+    generate_latest,
+)
+import ujson
 
 from shared.logger import (
     logged,
@@ -12,73 +16,113 @@ from shared.utils import (
 )
 
 from .app_elasticsearch import (
+    ES_ALIASES_INTERVAL,
     es_search,
     es_search_existing_scroll,
-    es_search_new_scroll,
     es_min_verification_age,
+    get_es_search_new_scroll,
+    indexes_matching_feeds,
 )
 from .app_hawk import (
     authenticate_hawk_header,
 )
+from .app_metrics import (
+    metric_timer,
+)
+from .app_profiler import (
+    MEMORY_DIFF_SECONDS,
+    MEMORY_DIFF_SECONDS_MAX,
+    PROFILE_SECONDS,
+    PROFILE_SECONDS_MAX,
+    collapsed_stacks,
+    memory_diff,
+    profile,
+    speedscope_profile,
+)
+from .app_push import (
+    push_queue_put,
+)
 from .app_utils import (
     get_child_context,
 )
 from .app_redis import (
     set_private_scroll_id,
+    redis_execute,
     redis_get_metrics,
     get_feeds_status,
 )
 
 NOT_PROVIDED = 'Authentication credentials were not provided.'
 INCORRECT = 'Incorrect authentication credentials.'
+INVALID_PROFILE_SECONDS = f'The seconds must be a number from 0 to {PROFILE_SECONDS_MAX}.'
+INVALID_MEMORY_DIFF_SECONDS = \
+    f'The seconds must be a number from 0 to {MEMORY_DIFF_SECONDS_MAX}.'
 MISSING_CONTENT_TYPE = 'Content-Type header was not set. ' + \
                        'It must be set for authentication, even if as the empty string.'
 MISSING_X_FORWARDED_PROTO = 'The X-Forwarded-Proto header was not set.'
 NOT_AUTHORIZED = 'You are not authorized to perform this action.'
+NOT_AUTHORIZED_PUSH = 'You are not authorized to push activities.'
+INVALID_ACTIVITIES = 'The body must be an Activity Streams collection, with an orderedItems ' + \
+                     'list of objects, each with a string id.'
+PUSH_QUEUE_FULL = 'Too many activities are waiting to be written. Try again later.'
+PUSH_NO_INDEX = 'The feed has no index to write activities into yet. Try again later.'
+PUSH_RETRY_AFTER = 1
 UNKNOWN_ERROR = 'An unknown error occurred.'
 
 
 def authenticator(context, incoming_key_pairs, nonce_expire):
 
+    metrics = context.metrics
+
     def _lookup_credentials(passed_access_key_id):
         return lookup_credentials(incoming_key_pairs, passed_access_key_id)
 
+    def _failed(reason):
+        metrics['http_authentication_failures_total'].labels(reason).inc()
+
     @web.middleware
     async def authenticate(request, handler):
         if 'X-Forwarded-Proto' not in request.headers:
             request['logger'].warning(
                 'Failed authentication: no X-Forwarded-Proto header passed'
             )
+            _failed('Missing X-Forwarded-Proto')
             raise web.HTTPUnauthorized(text=MISSING_X_FORWARDED_PROTO)
 
         if 'Authorization' not in request.headers:
+            _failed('Missing Authorization')
             raise web.HTTPUnauthorized(text=NOT_PROVIDED)
 
         if 'Content-Type' not in request.headers:
+            _failed('Missing Content-Type')
             raise web.HTTPUnauthorized(text=MISSING_CONTENT_TYPE)
 
-        is_authentic, private_error_message, credentials = await authenticate_hawk_header(
-            context=context,
-            nonce_expire=nonce_expire,
-            lookup_credentials=_lookup_credentials,
-            header=request.headers['Authorization'],
-            method=request.method,
-            host=request.url.host,
-            port=str(request.url.with_scheme(request.headers['X-Forwarded-Proto']).port),
-            path=request.url.raw_path_qs,
-            content_type=request.headers['Content-Type'].encode('utf-8'),
-            content=await request.read()
-        )
+        with metric_timer(metrics['http_request_stage_duration_seconds'], ['auth']):
+            is_authentic, private_error_message, credentials = await authenticate_hawk_header(
+                context=context,
+                nonce_expire=nonce_expire,
+                lookup_credentials=_lookup_credentials,
+                header=request.headers['Authorization'],
+                method=request.method,
+                host=request.url.host,
+                port=str(request.url.with_scheme(request.headers['X-Forwarded-Proto']).port),
+                path=request.url.raw_path_qs,
+                content_type=request.headers['Content-Type'].encode('utf-8'),
+                content=await request.read()
+            )
 
         if not is_authentic:
             request['logger'].warning('Failed authentication (%s)', private_error_message)
+            _failed(private_error_message)
             raise web.HTTPUnauthorized(text=INCORRECT)
 
         request['logger'] = get_child_logger(
             request['logger'],
             credentials['id'],
         )
+        request['key_id'] = credentials['id']
         request['permissions'] = credentials['permissions']
+        request['feed_unique_id'] = credentials['feed_unique_id']
         return await handler(request)
 
     return authenticate
@@ -95,6 +139,7 @@ def lookup_credentials(incoming_key_pairs, passed_access_key_id):
         'id': matching_key_pairs[0]['key_id'],
         'key': matching_key_pairs[0]['secret_key'],
         'permissions': matching_key_pairs[0]['permissions'],
+        'feed_unique_id': matching_key_pairs[0]['feed_unique_id'],
     } if matching_key_pairs else None
 
 
@@ -131,6 +176,29 @@ def raven_reporter(context):
     return _raven_reporter
 
 
+def request_metrics(context):
+    metrics = context.metrics
+
+    def _route(request):
+        resource = request.match_info.route.resource
+        return resource.canonical if resource is not None else '-'
+
+    @web.middleware
+    async def _request_metrics(request, handler):
+        start_counter = time.perf_counter()
+        response = await handler(request)
+        end_counter = time.perf_counter()
+
+        labels = [_route(request), request.get('key_id', '-'), str(response.status)]
+        metrics['http_request_duration_seconds'].labels(*labels).observe(
+            end_counter - start_counter)
+        metrics['http_response_size_bytes'].labels(*labels).observe(
+            response.content_length or 0)
+        return response
+
+    return _request_metrics
+
+
 def convert_errors_to_json():
     @web.middleware
     async def _convert_errors_to_json(request, handler):
@@ -146,12 +214,54 @@ def convert_errors_to_json():
     return _convert_errors_to_json
 
 
-async def handle_post(_):
-    return json_response({'secret': 'to-be-hidden'}, status=200)
+def handle_post(context, push_queue, es_aliases):
+    ''' Queues the pushed activities to be written to the indexes of the feed of the key. They
+    are rejected if the feed has no index, as last fetched, since they would be dropped '''
+
+    def parse_items(body):
+        try:
+            items = ujson.loads(body)['orderedItems']
+        except (ValueError, KeyError, TypeError) as exception:
+            raise web.HTTPBadRequest(text=INVALID_ACTIVITIES) from exception
+        if not isinstance(items, list) or not all(
+                isinstance(item, dict) and isinstance(item.get('id'), str) for item in items):
+            raise web.HTTPBadRequest(text=INVALID_ACTIVITIES)
+        return items
 
+    async def handle(request):
+        body = await request.read()
+        if not body:
+            return json_response({'accepted': 0}, status=200)
+
+        feed_unique_id = request['feed_unique_id']
+        if feed_unique_id is None:
+            raise web.HTTPForbidden(text=NOT_AUTHORIZED_PUSH)
+
+        items = parse_items(body)
+        if not indexes_matching_feeds(list(es_aliases['aliases_by_index']), [feed_unique_id]):
+            context.metrics['push_activities_total'].labels(feed_unique_id, 'rejected').inc(
+                len(items))
+            return json_response({'details': PUSH_NO_INDEX}, status=503, headers={
+                'Retry-After': str(ES_ALIASES_INTERVAL),
+            })
 
-def handle_get_new(context, pagination_expire, es_endpoint):
-    return _handle_get(context, pagination_expire, es_endpoint, es_search_new_scroll)
+        if not push_queue_put(context, push_queue, feed_unique_id, items):
+            return json_response({'details': PUSH_QUEUE_FULL}, status=429, headers={
+                'Retry-After': str(PUSH_RETRY_AFTER),
+            })
+
+        return json_response({'accepted': len(items)}, status=200)
+
+    return handle
+
+
+def handle_get_new(context, pagination_expire, es_endpoint, feed_endpoints, es_aliases):
+    feed_dit_applications = {
+        feed.unique_id: feed.dit_applications
+        for feed in feed_endpoints
+    }
+    return _handle_get(context, pagination_expire, es_endpoint,
+                       get_es_search_new_scroll(feed_dit_applications, es_aliases))
 
 
 def handle_get_existing(context, pagination_expire, es_endpoint):
@@ -178,7 +288,9 @@ def _handle_get(context, pagination_expire, es_endpoint, get_path_query):
                                           {'Content-Type': request.headers['Content-Type']},
                                           to_public_scroll_url)
 
-        return json_response(results, status=status)
+        with metric_timer(context.metrics['http_request_stage_duration_seconds'],
+                          ['serialization']):
+            return json_response(results, status=status)
 
     return handle
 
@@ -194,8 +306,8 @@ def handle_get_check(parent_context, es_endpoint, feed_endpoints):
         context = get_child_context(parent_context, 'check')
 
         with logged(context.logger, 'Checking', []):
-            await context.redis_client.execute('SET', 'redis-check', b'GREEN', 'EX', 1)
-            redis_result = await context.redis_client.execute('GET', 'redis-check')
+            await redis_execute(context, 'SET', 'redis-check', b'GREEN', 'EX', 1)
+            redis_result = await redis_execute(context, 'GET', 'redis-check')
             is_redis_green = redis_result == b'GREEN'
 
             min_age = await es_min_verification_age(context, es_endpoint)
@@ -236,16 +348,58 @@ def handle_get_check(parent_context, es_endpoint, feed_endpoints):
     return handle
 
 
-def handle_get_metrics(context):
+def handle_get_metrics(context, metrics_registry):
     async def handle(_):
-        return web.Response(body=await redis_get_metrics(context), status=200, headers={
+        # The outgoing metrics are saved in Redis, but the incoming metrics are only
+        # those of the instance that happens to serve this request
+        outgoing_metrics = await redis_get_metrics(context) or b''
+        incoming_metrics = generate_latest(metrics_registry)
+        return web.Response(body=outgoing_metrics + incoming_metrics, status=200, headers={
             'Content-Type': 'text/plain; charset=utf-8',
         })
 
     return handle
 
 
-def json_response(data, status):
+def handle_get_profile():
+    async def handle(request):
+        try:
+            seconds = float(request.query.get('seconds', PROFILE_SECONDS))
+        except ValueError as exception:
+            raise web.HTTPBadRequest(text=INVALID_PROFILE_SECONDS) from exception
+        if not 0 < seconds <= PROFILE_SECONDS_MAX:
+            raise web.HTTPBadRequest(text=INVALID_PROFILE_SECONDS)
+
+        with logged(request['logger'], 'Profiling for (%s) seconds', [seconds]):
+            stacks = await profile(seconds)
+
+        return \
+            json_response(speedscope_profile(stacks, seconds), status=200) if \
+            request.query.get('format') == 'speedscope' else \
+            web.Response(text=collapsed_stacks(stacks), status=200)
+
+    return handle
+
+
+def handle_get_memory():
+    async def handle(request):
+        try:
+            seconds = float(request.query.get('seconds', MEMORY_DIFF_SECONDS))
+        except ValueError as exception:
+            raise web.HTTPBadRequest(text=INVALID_MEMORY_DIFF_SECONDS) from exception
+        if not 0 < seconds <= MEMORY_DIFF_SECONDS_MAX:
+            raise web.HTTPBadRequest(text=INVALID_MEMORY_DIFF_SECONDS)
+
+        with logged(request['logger'], 'Tracing memory for (%s) seconds', [seconds]):
+            diff = await memory_diff(seconds)
+
+        return web.Response(text=diff, status=200)
+
+    return handle
+
+
+def json_response(data, status, headers=None):
     return web.json_response(data, status=status, headers={
-        'Server': 'activity-stream'
+        'Server': 'activity-stream',
+        **(headers or {}),
     })
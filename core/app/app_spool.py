@@ -0,0 +1,369 @@
+import asyncio
+import collections
+import concurrent.futures
+import mmap
+import os
+import struct
+import zlib
+
+import aiohttp
+
+from shared.logger import (
+    logged,
+)
+
+from .app_elasticsearch import (
+    ESRejected,
+    ESUnavailable,
+    es_any_node_healthy,
+    es_bulk_contents_post,
+    filter_es_bulk_contents,
+    get_es_bulk_contents,
+    get_old_index_names,
+    select_es_bulk_contents,
+)
+from .app_utils import (
+    async_repeat_until_cancelled,
+    get_child_context,
+    sleep,
+)
+
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+SPOOL_SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+SPOOL_WRITE_INTERVAL = 1
+
+# Each record in a segment is its length and CRC32, followed by the bulk ingest contents
+SPOOL_RECORD_HEADER = struct.Struct('!II')
+SPOOL_SEGMENT_SUFFIX = '.segment'
+SPOOL_HEAD_FILE = 'head'
+
+# Records that Elasticsearch rejects, or that are corrupt, and the items of bulk ingests that it
+# rejects individually, are appended to this file in the same format as the segments, rather
+# than blocking the spool or being lost
+SPOOL_DEAD_LETTER_FILE = 'dead-letter'
+
+Spool = collections.namedtuple(
+    'Spool', ['directory', 'max_bytes', 'segment_max_bytes', 'state', 'is_not_empty',
+              'executor'],
+)
+
+
+class SpoolFull(Exception):
+    pass
+
+
+def get_spool(context, directory, max_bytes, segment_max_bytes):
+    ''' An append-only queue of bulk ingest contents in segment files in directory, that
+    outlives the process. The head file stores the position of the first unwritten record '''
+    os.makedirs(directory, exist_ok=True)
+
+    try:
+        with open(os.path.join(directory, SPOOL_HEAD_FILE), 'rb') as head_file:
+            head_segment, head_offset = struct.unpack('!QQ', head_file.read())
+    except FileNotFoundError:
+        head_segment, head_offset = 0, 0
+
+    segments = sorted(
+        int(file_name[:-len(SPOOL_SEGMENT_SUFFIX)])
+        for file_name in os.listdir(directory)
+        if file_name.endswith(SPOOL_SEGMENT_SUFFIX)
+    )
+    for segment in segments:
+        if segment < head_segment:
+            os.remove(_segment_path(directory, segment))
+
+    # The head segment is removed before the head file is updated to the next
+    if head_segment not in segments:
+        head_segment = min((segment for segment in segments if segment > head_segment),
+                           default=head_segment)
+        head_offset = 0
+
+    # A record can be partially written if the process was killed, so the spool is truncated
+    # at the first record that doesn't match its checksum, and anything after is dead-lettered
+    num_records, num_bytes = 0, 0
+    tail_segment, tail_offset = head_segment, head_offset
+    is_valid = True
+    for segment in [segment for segment in segments if segment >= head_segment]:
+        path = _segment_path(directory, segment)
+        if not is_valid:
+            _dead_letter_segment_from(context, directory, path, 0)
+            os.remove(path)
+            continue
+
+        offset = head_offset if segment == head_segment else 0
+        segment_size = os.path.getsize(path)
+        while offset < segment_size:
+            payload = _segment_read(path, offset)[0]
+            if payload is None:
+                context.logger.warning(
+                    'Dead-lettering spool from (%s) (%s)', path, offset)
+                is_valid = False
+                _dead_letter_segment_from(context, directory, path, offset)
+                with open(path, 'r+b') as segment_file:
+                    segment_file.truncate(offset)
+                break
+            offset += SPOOL_RECORD_HEADER.size + len(payload)
+            num_records += 1
+            num_bytes += SPOOL_RECORD_HEADER.size + len(payload)
+        tail_segment, tail_offset = segment, offset
+
+    # A single thread, so file operations are made in the order they are requested
+    spool = Spool(
+        directory=directory, max_bytes=max_bytes, segment_max_bytes=segment_max_bytes,
+        state={
+            'head_segment': head_segment, 'head_offset': head_offset,
+            'tail_segment': tail_segment, 'tail_offset': tail_offset,
+            'num_records': num_records, 'num_bytes': num_bytes,
+            'num_appended': num_records, 'num_written': 0,
+        },
+        is_not_empty=asyncio.Event(),
+        executor=concurrent.futures.ThreadPoolExecutor(max_workers=1),
+    )
+    if num_records:
+        spool.is_not_empty.set()
+    _set_spool_metrics(context, spool)
+    return spool
+
+
+def _segment_path(directory, segment):
+    return os.path.join(directory, f'{segment:020d}{SPOOL_SEGMENT_SUFFIX}')
+
+
+def _segment_read(path, offset):
+    ''' The payload of the record at offset, or None if it's incomplete or corrupt, and the
+    size of the record. If the size can't be determined from the record, it's the rest of the
+    segment '''
+    with open(path, 'rb') as segment_file, \
+            mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as segment_map:
+        header_end = offset + SPOOL_RECORD_HEADER.size
+        if header_end > len(segment_map):
+            return None, len(segment_map) - offset
+        length, checksum = SPOOL_RECORD_HEADER.unpack(segment_map[offset:header_end])
+        payload = segment_map[header_end:header_end + length]
+
+    return \
+        (payload, SPOOL_RECORD_HEADER.size + length) \
+        if len(payload) == length and zlib.crc32(payload) == checksum else \
+        (None, SPOOL_RECORD_HEADER.size + len(payload))
+
+
+def _segment_append(path, payload):
+    with open(path, 'ab') as segment_file:
+        segment_file.write(SPOOL_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        segment_file.write(payload)
+
+
+def _segment_read_from(path, offset):
+    with open(path, 'rb') as segment_file:
+        segment_file.seek(offset)
+        return segment_file.read()
+
+
+def _segment_remove_if_read(path, offset):
+    ''' Whether the segment had been read up to its end, and so was removed '''
+    is_read = offset >= os.path.getsize(path)
+    if is_read:
+        os.remove(path)
+    return is_read
+
+
+def _head_write(directory, head_segment, head_offset):
+    # Replaced atomically, so the head is never partially written
+    head_path = os.path.join(directory, SPOOL_HEAD_FILE)
+    with open(head_path + '.tmp', 'wb') as head_file:
+        head_file.write(struct.pack('!QQ', head_segment, head_offset))
+    os.replace(head_path + '.tmp', head_path)
+
+
+def _dead_letter_segment_from(context, directory, path, offset):
+    ''' Only used before the spool is created, so not in its executor '''
+    _segment_append(os.path.join(directory, SPOOL_DEAD_LETTER_FILE),
+                    _segment_read_from(path, offset))
+    context.metrics['ingest_spool_records_total'].labels('dead_lettered').inc()
+
+
+async def _spool_run(spool, func, *args):
+    return await asyncio.get_event_loop().run_in_executor(spool.executor, func, *args)
+
+
+def _set_spool_metrics(context, spool):
+    context.metrics['ingest_spool_records'].set(spool.state['num_records'])
+    context.metrics['ingest_spool_bytes'].set(spool.state['num_bytes'])
+
+
+async def spool_append(context, spool, payload):
+    state = spool.state
+    record_size = SPOOL_RECORD_HEADER.size + len(payload)
+    if state['num_bytes'] + record_size > spool.max_bytes:
+        context.metrics['ingest_spool_records_total'].labels('rejected').inc()
+        raise SpoolFull()
+
+    if state['tail_offset'] and state['tail_offset'] + record_size > spool.segment_max_bytes:
+        state['tail_segment'] += 1
+        state['tail_offset'] = 0
+
+    # The state is updated before the record is written, so anything appended or written
+    # while it's being written is after it, and the spool's single thread writes it before
+    # anything can read it
+    path = _segment_path(spool.directory, state['tail_segment'])
+    state['tail_offset'] += record_size
+    state['num_records'] += 1
+    state['num_bytes'] += record_size
+    state['num_appended'] += 1
+    spool.is_not_empty.set()
+    context.metrics['ingest_spool_records_total'].labels('spooled').inc()
+    _set_spool_metrics(context, spool)
+
+    await _spool_run(spool, _segment_append, path, payload)
+
+
+async def spool_peek(spool):
+    ''' The payload of the first unwritten record, or None if it's corrupt, and its size '''
+    state = spool.state
+    path = _segment_path(spool.directory, state['head_segment'])
+    if await _spool_run(spool, _segment_remove_if_read, path, state['head_offset']):
+        state['head_segment'] += 1
+        state['head_offset'] = 0
+        path = _segment_path(spool.directory, state['head_segment'])
+
+    return await _spool_run(spool, _segment_read, path, state['head_offset'])
+
+
+async def spool_dead_letter(context, spool, record_size):
+    ''' Appends the first unwritten record, as is, to the dead-letter file '''
+    state = spool.state
+    path = _segment_path(spool.directory, state['head_segment'])
+    record = await _spool_run(spool, _segment_read_from, path, state['head_offset'])
+    await _spool_run(spool, _segment_append,
+                     os.path.join(spool.directory, SPOOL_DEAD_LETTER_FILE), record[:record_size])
+    context.metrics['ingest_spool_records_total'].labels('dead_lettered').inc()
+
+
+async def spool_dead_letter_payload(context, spool, payload):
+    ''' Appends bulk ingest contents to the dead-letter file, as a record of the spool '''
+    await _spool_run(spool, _segment_append,
+                     os.path.join(spool.directory, SPOOL_DEAD_LETTER_FILE),
+                     SPOOL_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+    context.metrics['ingest_spool_records_total'].labels('dead_lettered').inc()
+
+
+async def spool_pop(context, spool, record_size):
+    state = spool.state
+    state['head_offset'] += record_size
+    state['num_records'] -= 1
+    state['num_bytes'] -= record_size
+    state['num_written'] += 1
+    await _spool_run(spool, _head_write,
+                     spool.directory, state['head_segment'], state['head_offset'])
+
+    if not state['num_records']:
+        spool.is_not_empty.clear()
+    _set_spool_metrics(context, spool)
+
+
+async def es_bulk_or_spool(context, es_endpoint, items):
+    ''' Returns the size of the bulk ingest in bytes. If Elasticsearch is unavailable, the
+    bulk ingest is spooled to be written later, and if anything is already spooled, so they are
+    written in order '''
+    spool = context.es_bulk_spool
+    with logged(context.logger, 'Pushing (%s) items into Elasticsearch', [len(items)]):
+        if not items:
+            return 0
+
+        es_bulk_contents = get_es_bulk_contents(context, items)
+        if spool is None:
+            await es_bulk_post_or_dead_letter(context, es_endpoint, es_bulk_contents)
+            return len(es_bulk_contents)
+
+        if not spool.state['num_records']:
+            try:
+                await es_bulk_post_or_dead_letter(context, es_endpoint, es_bulk_contents)
+                return len(es_bulk_contents)
+            except (ESUnavailable, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                context.logger.warning('Elasticsearch unavailable, spooling')
+
+        await spool_append(context, spool, es_bulk_contents)
+        return len(es_bulk_contents)
+
+
+async def es_bulk_post_or_dead_letter(context, es_endpoint, es_bulk_contents):
+    ''' Items that Elasticsearch rejects in a bulk ingest that it accepts would be rejected
+    again, so are dead-lettered, or without a spool, dropped '''
+    rejected_positions = await es_bulk_contents_post(context, es_endpoint, es_bulk_contents)
+    if not rejected_positions:
+        return
+
+    context.logger.warning('Elasticsearch rejected (%s) items', len(rejected_positions))
+    if context.es_bulk_spool is not None:
+        await spool_dead_letter_payload(
+            context, context.es_bulk_spool,
+            select_es_bulk_contents(es_bulk_contents, rejected_positions),
+        )
+
+
+async def es_bulk_spool_written(context):
+    ''' Waits until everything spooled before the call is written to Elasticsearch '''
+    spool = context.es_bulk_spool
+    if spool is None:
+        return
+
+    num_to_write = spool.state['num_appended']
+    with logged(context.logger, 'Waiting for spool to be written', []):
+        while spool.state['num_written'] < num_to_write:
+            await sleep(context, SPOOL_WRITE_INTERVAL)
+
+
+def create_spool_writer(parent_context, es_endpoint, exception_intervals):
+    context = get_child_context(parent_context, 'spool')
+    spool = context.es_bulk_spool
+
+    # The names of the indexes, fetched once for each time the spool is written until it's
+    # empty, and again if a record is into an index that didn't exist when they were fetched
+    index_names = [None]
+
+    async def fetch_index_names():
+        indexes_without_alias, indexes_with_alias = \
+            await get_old_index_names(context, es_endpoint)
+        index_names[0] = indexes_without_alias + indexes_with_alias
+
+    async def write_record():
+        await spool.is_not_empty.wait()
+        if not es_any_node_healthy(context.es_nodes):
+            await sleep(context, SPOOL_WRITE_INTERVAL)
+            return
+
+        payload, record_size = await spool_peek(spool)
+        if payload is None:
+            context.logger.warning('Dead-lettering corrupt spool record')
+            await spool_dead_letter(context, spool, record_size)
+            await spool_pop(context, spool, record_size)
+            return
+
+        # An index may have been deleted since the record was spooled, for example if another
+        # instance has taken over the feed, and writing into it would recreate it
+        if index_names[0] is None:
+            await fetch_index_names()
+        es_bulk_contents = filter_es_bulk_contents(payload, index_names[0])
+        if es_bulk_contents != payload:
+            await fetch_index_names()
+            es_bulk_contents = filter_es_bulk_contents(payload, index_names[0])
+
+        with logged(context.logger, 'Writing spooled (%s) bytes', [len(es_bulk_contents)]):
+            try:
+                if es_bulk_contents:
+                    await es_bulk_post_or_dead_letter(context, es_endpoint, es_bulk_contents)
+                result = 'written' if es_bulk_contents else 'discarded'
+            except ESRejected:
+                context.logger.warning('Dead-lettering spool record rejected by Elasticsearch')
+                await spool_dead_letter(context, spool, record_size)
+                result = None
+
+        await spool_pop(context, spool, record_size)
+        if result is not None:
+            context.metrics['ingest_spool_records_total'].labels(result).inc()
+        if not spool.state['num_records']:
+            index_names[0] = None
+
+    asyncio.get_event_loop().create_task(
+        async_repeat_until_cancelled(context, exception_intervals, write_record)
+    )
@@ -1,19 +1,30 @@
 import asyncio
 import collections
-import logging
+import hashlib
+import os
 import signal
-import sys
 
 import aiohttp
 
 from shared.logger import (
+    configure_root_logger,
+    configure_tracing,
     logged,
     get_child_logger,
 )
+from shared.utils import (
+    normalise_environment,
+)
+
+from .app_profiler import (
+    write_memory_diff,
+    write_profile,
+)
 
 
 Context = collections.namedtuple(
-    'Context', ['logger', 'metrics', 'raven_client', 'redis_client', 'session'],
+    'Context', ['logger', 'metrics', 'raven_client', 'redis_client', 'redis_write_queue',
+                'session', 'es_session', 'es_nodes', 'es_refresh_queue', 'es_bulk_spool'],
 )
 
 
@@ -58,6 +69,16 @@ async def async_repeat_until_cancelled(context, exception_intervals, coroutine):
                 break
 
 
+def rendezvous_owner(owner_ids, item_id):
+    ''' The owner of an item using rendezvous hashing: if an owner is added or removed, only
+    the items it owns move to another owner, and all clients that agree on the owners agree
+    on the owner of every item, without any coordination '''
+    def weight(owner_id):
+        return hashlib.sha256(f'{owner_id}:{item_id}'.encode('utf-8')).digest()
+
+    return max(owner_ids, key=weight)
+
+
 def sub_dict_lower(super_dict, keys):
     return {
         key.lower(): super_dict[key]
@@ -75,6 +96,50 @@ async def cancel_non_current_tasks():
     await asyncio.sleep(0)
 
 
+def get_priority_lock(max_consecutive_priority):
+    ''' A lock where waiters with priority acquire it before those without, but after
+    `max_consecutive_priority` acquisitions with priority while others wait, one without
+    priority acquires it, so they still make progress. Returns (acquire, release) '''
+    waiters = {True: collections.deque(), False: collections.deque()}
+    is_locked = [False]
+    num_consecutive_priority = [0]
+
+    async def acquire(is_priority):
+        if not is_locked[0]:
+            is_locked[0] = True
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        waiters[is_priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # The lock may have been passed to this waiter just before it was cancelled
+            if waiter.done() and not waiter.cancelled():
+                release()
+            else:
+                waiters[is_priority].remove(waiter)
+            raise
+
+    def release():
+        # The lock is passed directly to the next waiter, so nothing can acquire it in between
+        is_priority_next = waiters[True] and (
+            not waiters[False] or num_consecutive_priority[0] < max_consecutive_priority
+        )
+        if is_priority_next:
+            # Only acquisitions while others wait count, so those without priority that start
+            # waiting after a run of priority acquisitions still wait for at most the maximum
+            num_consecutive_priority[0] = num_consecutive_priority[0] + 1 if waiters[False] else 0
+            waiters[True].popleft().set_result(None)
+        elif waiters[False]:
+            num_consecutive_priority[0] = 0
+            waiters[False].popleft().set_result(None)
+        else:
+            is_locked[0] = False
+
+    return acquire, release
+
+
 async def sleep(context, interval):
     with logged(context.logger, 'Sleeping for %s seconds', [interval]):
         await asyncio.sleep(interval)
@@ -103,10 +168,14 @@ def http_429_retry_after(coroutine):
 
 
 def main(run_application_coroutine):
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    app_logger = logging.getLogger('activity-stream')
-    app_logger.setLevel(logging.DEBUG)
-    app_logger.addHandler(stdout_handler)
+    env = normalise_environment(os.environ)
+    app_logger, log_listener = configure_root_logger(
+        env.get('LOG_LEVEL', 'DEBUG'), float(env.get('LOG_DEBUG_SAMPLE_RATE', '1')),
+    )
+    trace_listener = \
+        configure_tracing(env['TRACE_FILE'], float(env.get('TRACE_SAMPLE_RATE', '1'))) if \
+        'TRACE_FILE' in env else \
+        None
 
     loop = asyncio.get_event_loop()
     cleanup = loop.run_until_complete(run_application_coroutine())
@@ -119,5 +188,13 @@ def main(run_application_coroutine):
     cleanup_then_stop = cleanup_then_stop_loop()
     loop.add_signal_handler(signal.SIGINT, loop.create_task, cleanup_then_stop)
     loop.add_signal_handler(signal.SIGTERM, loop.create_task, cleanup_then_stop)
+
+    # Outgoing has no HTTP server, so a profile or memory diff is requested by a signal
+    loop.add_signal_handler(signal.SIGUSR1, lambda: loop.create_task(write_profile(app_logger)))
+    loop.add_signal_handler(signal.SIGUSR2,
+                            lambda: loop.create_task(write_memory_diff(app_logger)))
     loop.run_forever()
     app_logger.info('Reached end of main. Exiting now.')
+    log_listener.stop()
+    if trace_listener is not None:
+        trace_listener.stop()
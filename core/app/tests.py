@@ -1,16 +1,76 @@
 import asyncio
+import collections
 import datetime
 import json
 import os
 import re
+import tempfile
+import tracemalloc
 import unittest
-from unittest.mock import patch
+from unittest.mock import (
+    ANY,
+    Mock,
+    patch,
+)
+import zlib
 
 import aiohttp
 from aiohttp import web
 import aioredis
 from freezegun import freeze_time
+from prometheus_client import (
+    CollectorRegistry,
+)
+
+from shared.logger import (
+    get_root_logger,
+    logged,
+    set_trace_exporter,
+    traced,
+)
 
+from .app_elasticsearch import (
+    ESRejected,
+    ESUnavailable,
+    create_es_refresher,
+    es_bulk_contents_post,
+    es_get_refresh_queue,
+    force_merge_index,
+    number_of_shards_for_size,
+    refresh_indexes_later,
+    wait_for_index_health,
+)
+from .app_feeds import (
+    IndexConfig,
+)
+from .app_metrics import (
+    get_metrics,
+)
+from .app_outgoing import (
+    fetch_feed_page,
+    get_feed_state,
+    get_updates_interval,
+    run_outgoing_application,
+)
+from .app_redis import (
+    append_feed_updates_journal,
+    get_feed_updates_journal,
+)
+from .app_spool import (
+    SPOOL_RECORD_HEADER,
+    _segment_read,
+    es_bulk_or_spool,
+    get_spool,
+    spool_append,
+    spool_dead_letter,
+    spool_peek,
+    spool_pop,
+)
+from .app_utils import (
+    Context,
+    cancel_non_current_tasks,
+    get_priority_lock,
+)
 from .tests_utils import (
     ORIGINAL_SLEEP,
     append_until,
@@ -21,6 +81,8 @@ from .tests_utils import (
     fetch_all_es_data_until,
     fetch_es_index_names,
     fetch_es_index_names_with_alias,
+    fetch_es_index_mappings,
+    fetch_es_index_settings,
     get,
     get_until,
     has_at_least,
@@ -28,6 +90,7 @@ from .tests_utils import (
     hawk_auth_header,
     mock_env,
     post,
+    post_body,
     post_with_headers,
     read_file,
     respond_http,
@@ -35,6 +98,7 @@ from .tests_utils import (
     run_es_application,
     run_feed_application,
     run_sentry_application,
+    wait_until,
     wait_until_get_working,
 )
 
@@ -358,7 +422,7 @@ class TestAuthentication(TestBase):
         self.assertEqual(text, '{"details": "Incorrect authentication credentials."}')
 
     @async_test
-    async def test_second_id_returns_object(self):
+    async def test_second_id_returns_accepted(self):
         await self.setup_manual(env=mock_env(), mock_feed=read_file, mock_feed_status=lambda: 200,
                                 mock_headers=lambda: {})
 
@@ -369,10 +433,10 @@ class TestAuthentication(TestBase):
         x_forwarded_for = '1.2.3.4, 127.0.0.0'
         text, status = await post(url, auth, x_forwarded_for)
         self.assertEqual(status, 200)
-        self.assertEqual(text, '{"secret": "to-be-hidden"}')
+        self.assertEqual(text, '{"accepted": 0}')
 
     @async_test
-    async def test_post_returns_object(self):
+    async def test_post_returns_accepted(self):
         await self.setup_manual(env=mock_env(), mock_feed=read_file, mock_feed_status=lambda: 200,
                                 mock_headers=lambda: {})
 
@@ -383,7 +447,7 @@ class TestAuthentication(TestBase):
         x_forwarded_for = '1.2.3.4, 127.0.0.0'
         text, status = await post(url, auth, x_forwarded_for)
         self.assertEqual(status, 200)
-        self.assertEqual(text, '{"secret": "to-be-hidden"}')
+        self.assertEqual(text, '{"accepted": 0}')
 
     @async_test
     async def test_post_creds_get_403(self):
@@ -593,6 +657,69 @@ class TestApplication(TestBase):
         self.assertEqual('Create', data['orderedItems'][0]['type'])
         self.assertIn('dit:exportOpportunities:Enquiry', data['orderedItems'][0]['object']['type'])
 
+    @async_test
+    async def test_get_routed_to_feed_aliases(self):
+        env = {
+            **mock_env(),
+            'FEEDS__1__SEED': (
+                'http://localhost:8081/'
+                'tests_fixture_activity_stream_multipage_1.json'
+            ),
+            'FEEDS__1__DIT_APPLICATIONS__1': 'exportOpportunities',
+            'FEEDS__2__UNIQUE_ID': 'second_feed',
+            'FEEDS__2__SEED': 'http://localhost:8081/tests_fixture_zendesk_1.json',
+            'FEEDS__2__API_EMAIL': 'test@test.com',
+            'FEEDS__2__API_KEY': 'some-key',
+            'FEEDS__2__TYPE': 'zendesk',
+        }
+
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=env, mock_feed=read_file, mock_feed_status=lambda: 200,
+                                    mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(4))
+
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+        query = json.dumps({
+            'query': {
+                'bool': {
+                    'filter': [{
+                        'term': {
+                            'dit:application.keyword': 'zendesk',
+                        },
+                    }],
+                },
+            },
+        }).encode('utf-8')
+
+        # The aliases are fetched in the background, and until they are, all feeds are searched
+        searched = {}
+
+        async def is_routed_to_feeds():
+            auth = hawk_auth_header(
+                'incoming-some-id-3', 'incoming-some-secret-3', url, 'GET', query,
+                'application/json',
+            )
+            searched['result'], status, _ = await get(url, auth, x_forwarded_for, query)
+            self.assertEqual(status, 200)
+            async with aiohttp.ClientSession() as session:
+                searched['metrics'] = \
+                    await (await session.get('http://127.0.0.1:8080/metrics')).text()
+            return 'incoming_elasticsearch_search_shards_count{route="feeds"}' in \
+                searched['metrics']
+
+        await wait_until(is_routed_to_feeds, 60)
+        metrics = searched['metrics']
+
+        data = json.loads(searched['result'])
+        self.assertEqual(len(data['orderedItems']), 2)
+        self.assertEqual(data['orderedItems'][0]['dit:application'], 'zendesk')
+        self.assertEqual(data['orderedItems'][1]['dit:application'], 'zendesk')
+
+        # Narrowed to the zendesk feed, so to only the shards of its index
+        self.assertIn('incoming_elasticsearch_search_shards_count{route="feeds"} 1.0', metrics)
+        self.assertIn('incoming_elasticsearch_search_shards_sum{route="feeds"} 4.0', metrics)
+
     @freeze_time('2012-01-14 12:00:01')
     @patch('os.urandom', return_value=b'something-random')
     @patch('secrets.choice', return_value='qwerty12')
@@ -1032,6 +1159,218 @@ class TestApplication(TestBase):
             str(results),
         )
 
+    @async_test
+    async def test_index_durability_restored(self):
+        # The default of 1 replica, which on a single node cluster is never allocated, so the
+        # ingest waits for yellow rather than green
+        env = {
+            **mock_env(),
+            'FEEDS__1__FORCE_MERGE_SEGMENTS': '1',
+        }
+        with \
+                patch('asyncio.sleep', wraps=fast_sleep), \
+                patch('core.app.app_outgoing.force_merge_index',
+                      wraps=force_merge_index) as force_merge_index_mock:
+            await self.setup_manual(env=env, mock_feed=read_file, mock_feed_status=lambda: 200,
+                                    mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(2))
+
+        [index_settings] = await fetch_es_index_settings()
+        self.assertEqual(index_settings['number_of_replicas'], '1')
+        self.assertEqual(index_settings['translog']['durability'], 'request')
+
+        [index_name] = await fetch_es_index_names_with_alias()
+        force_merge_index_mock.assert_any_call(ANY, ANY, index_name, 1)
+        async with aiohttp.ClientSession() as session:
+            response = await session.get(f'http://127.0.0.1:9200/{index_name}/_segments')
+            shards = json.loads(await response.text())['indices'][index_name]['shards']
+        for shard_copies in shards.values():
+            for shard_copy in shard_copies:
+                self.assertLessEqual(shard_copy['num_search_segments'], 1)
+
+    @async_test
+    async def test_shards_from_previous_index(self):
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=mock_env(), mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(2))
+            [index_settings] = await fetch_es_index_settings()
+            self.assertEqual(index_settings['number_of_shards'], '4')
+
+            # The next index is based on the previous, which is tiny
+            async def has_one_shard():
+                return [
+                    index_settings['number_of_shards']
+                    for index_settings in await fetch_es_index_settings()
+                ] == ['1']
+
+            await wait_until(has_one_shard, 60)
+
+    @async_test
+    async def test_index_mappings_typed(self):
+        env = {
+            **mock_env(),
+            'FEEDS__2__UNIQUE_ID': 'second_feed',
+            'FEEDS__2__SEED': 'http://localhost:8081/tests_fixture_zendesk_1.json',
+            'FEEDS__2__API_EMAIL': 'test@test.com',
+            'FEEDS__2__API_KEY': 'some-key',
+            'FEEDS__2__TYPE': 'zendesk',
+        }
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=env, mock_feed=read_file, mock_feed_status=lambda: 200,
+                                    mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(4))
+
+        mappings = await fetch_es_index_mappings()
+        [activity_stream_mapping] = [
+            mapping for index_name, mapping in mappings.items() if 'first_feed' in index_name
+        ]
+        [zendesk_mapping] = [
+            mapping for index_name, mapping in mappings.items() if 'second_feed' in index_name
+        ]
+
+        properties = activity_stream_mapping['properties']
+        self.assertEqual(properties['published']['type'], 'date')
+        self.assertNotIn('published_date', properties)
+        for keyword in [properties['id'], properties['dit:application'],
+                        properties['object']['properties']['id']]:
+            self.assertEqual(keyword['type'], 'keyword')
+            self.assertEqual(keyword['fields']['keyword']['type'], 'keyword')
+
+        # Strings not in the schema are still text, with a keyword sub-field
+        companies_house_number = properties['actor']['properties']['dit:companiesHouseNumber']
+        self.assertEqual(companies_house_number['type'], 'text')
+        self.assertEqual(companies_house_number['fields']['keyword']['type'], 'keyword')
+
+        self.assertEqual(zendesk_mapping['dynamic'], 'false')
+        self.assertEqual(zendesk_mapping['properties']['published']['type'], 'date')
+        zendesk_actor = zendesk_mapping['properties']['actor']['properties']
+        self.assertEqual(
+            zendesk_actor['dit:companiesHouseNumber']['fields']['keyword']['type'], 'keyword')
+
+        for index_settings in await fetch_es_index_settings():
+            self.assertEqual(index_settings['sort']['field'], ['published', 'id'])
+            self.assertEqual(index_settings['sort']['order'], ['desc', 'desc'])
+
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+        query = json.dumps({
+            'query': {
+                'bool': {
+                    'filter': [
+                        {'term': {'dit:application': 'exportOpportunities'}},
+                        {'term': {'object.id.keyword': 'dit:exportOpportunities:Enquiry:49863'}},
+                        {'term': {'actor.dit:companiesHouseNumber.keyword': '123432'}},
+                    ],
+                },
+            },
+            'size': 1,
+            'sort': [{'published': 'desc'}, {'id': 'desc'}],
+        }).encode('utf-8')
+        auth = hawk_auth_header(
+            'incoming-some-id-3', 'incoming-some-secret-3', url, 'GET', query, 'application/json',
+        )
+        result, status, _ = await get(url, auth, x_forwarded_for, query)
+        self.assertEqual(status, 200)
+        data = json.loads(result)
+        self.assertEqual(data['orderedItems'][0]['id'],
+                         'dit:exportOpportunities:Enquiry:49863:Create')
+
+    @async_test
+    async def test_long_string_searchable(self):
+        # Longer than the 256 characters the keyword sub-field of a dynamic string indexes
+        content = ' '.join(['word'] * 60 + ['needle'])
+
+        def read_with_long_content(path):
+            feed = json.loads(read_file(path))
+            if path == 'tests_fixture_activity_stream_1.json':
+                feed['orderedItems'][0]['object']['content'] = content
+            return json.dumps(feed)
+
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=mock_env(), mock_feed=read_with_long_content,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(2))
+
+        url = 'http://127.0.0.1:8080/v1/'
+        query = json.dumps({
+            'query': {
+                'match': {
+                    'object.content': 'needle',
+                },
+            },
+        }).encode('utf-8')
+        auth = hawk_auth_header(
+            'incoming-some-id-3', 'incoming-some-secret-3', url, 'GET', query, 'application/json',
+        )
+        result, status, _ = await get(url, auth, '1.2.3.4, 127.0.0.0', query)
+        self.assertEqual(status, 200)
+        [activity] = json.loads(result)['orderedItems']
+        self.assertEqual(activity['object']['content'], content)
+
+    @async_test
+    async def test_es_bulk_503_spooled(self):
+        num_posts = 0
+
+        async def send_503_then_post(*args, **kwargs):
+            nonlocal num_posts
+            num_posts += 1
+            if num_posts <= 2:
+                raise ESUnavailable('{}')
+            return await es_bulk_contents_post(*args, **kwargs)
+
+        with \
+                tempfile.TemporaryDirectory() as spool_directory, \
+                patch('asyncio.sleep', wraps=fast_sleep), \
+                patch('core.app.app_spool.es_bulk_contents_post', wraps=send_503_then_post):
+            await self.setup_manual(env={**mock_env(), 'SPOOL__DIRECTORY': spool_directory},
+                                    mock_feed=read_file, mock_feed_status=lambda: 200,
+                                    mock_headers=lambda: {})
+            results = await fetch_all_es_data_until(has_at_least(2))
+            self.assertTrue(os.path.exists(os.path.join(spool_directory, 'outgoing', 'head')))
+
+        self.assertIn(
+            'dit:exportOpportunities:Enquiry:49863:Create',
+            str(results),
+        )
+
+    @async_test
+    async def test_es_bulk_400_dead_lettered(self):
+        num_posts = 0
+
+        async def send_503_then_400_then_post(*args, **kwargs):
+            nonlocal num_posts
+            num_posts += 1
+            if num_posts == 1:
+                raise ESUnavailable('{}')
+            if num_posts == 2:
+                raise ESRejected('{}')
+            return await es_bulk_contents_post(*args, **kwargs)
+
+        with \
+                tempfile.TemporaryDirectory() as spool_directory, \
+                patch('asyncio.sleep', wraps=fast_sleep), \
+                patch('core.app.app_spool.es_bulk_contents_post',
+                      wraps=send_503_then_400_then_post):
+            await self.setup_manual(env={**mock_env(), 'SPOOL__DIRECTORY': spool_directory},
+                                    mock_feed=read_file, mock_feed_status=lambda: 200,
+                                    mock_headers=lambda: {})
+
+            # The rejected page is ingested again by the next full ingest
+            await fetch_all_es_data_until(has_at_least(2))
+            with open(os.path.join(spool_directory, 'outgoing', 'dead-letter'), 'rb') as file:
+                dead_lettered = file.read()
+
+        self.assertIn(b'dit:exportOpportunities:Enquiry:49863:Create', dead_lettered)
+
+        async def is_dead_lettered_counted():
+            async with aiohttp.ClientSession() as session:
+                result = await session.get('http://127.0.0.1:8080/metrics')
+                text = await result.text()
+            return 'ingest_spool_records_total{result="dead_lettered"} 1.0' in text
+
+        await wait_until(is_dead_lettered_counted, 60)
+
     @async_test
     async def test_returns_some_metrics(self):
         with patch('asyncio.sleep', wraps=fast_sleep):
@@ -1066,6 +1405,289 @@ class TestApplication(TestBase):
         self.assertIn('elasticsearch_feed_activities_total'
                       '{feed_unique_id="first_feed",searchable="searchable"} 2.0', text)
 
+        self.assertIn('redis_command_duration_seconds_bucket{', text)
+        self.assertIn('command="LOCK_EXTEND"', text)
+        self.assertIn('command="PIPELINE"', text)
+        self.assertIn('elasticsearch_connections_total{event="created"}', text)
+        self.assertIn('elasticsearch_connections_total{event="reused"}', text)
+        self.assertIn('elasticsearch_request_signing_duration_seconds_bucket{', text)
+        self.assertIn('event_loop_lag_seconds_bucket{', text)
+        self.assertIn('event_loop_tasks_total ', text)
+        self.assertIn('ingest_page_size_bytes_bucket{', text)
+        self.assertIn('ingest_page_items_bucket{', text)
+        self.assertIn('ingest_page_bulk_size_bytes_bucket{', text)
+        self.assertIn('ingest_feed_lock_wait_seconds_bucket{', text)
+        self.assertIn('ingest_spool_records ', text)
+        self.assertIn('ingest_feed_full_stage_duration_seconds_count{', text)
+        self.assertIn('ingest_feed_index_shards{feed_unique_id="first_feed"} ', text)
+        self.assertIn('elasticsearch_refresh_delay_seconds_bucket{', text)
+
+    @async_test
+    async def test_returns_incoming_metrics(self):
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=mock_env(), mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(2))
+
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+        await get_until(url, x_forwarded_for, has_at_least_ordered_items(2))
+
+        auth = hawk_auth_header(
+            'incoming-some-id-1', 'incoming-some-secret-2', url, 'POST', '', '',
+        )
+        await post(url, auth, x_forwarded_for)
+
+        async with aiohttp.ClientSession() as session:
+            result = await session.get('http://127.0.0.1:8080/metrics')
+            text = await result.text()
+
+        # The outgoing metrics are still present
+        self.assertIn('python_info', text)
+        self.assertIn('ingest_feed_duration_seconds_count', text)
+
+        # The order of labels is apparently not deterministic
+        self.assertIn('incoming_http_request_duration_seconds_bucket{', text)
+        self.assertIn('route="/v1/"', text)
+        self.assertIn('key_id="incoming-some-id-3"', text)
+        self.assertIn('status="200"', text)
+        self.assertIn('incoming_http_response_size_bytes_bucket{', text)
+        self.assertIn('incoming_http_request_stage_duration_seconds_bucket{', text)
+        self.assertIn('stage="auth"', text)
+        self.assertIn('stage="elasticsearch"', text)
+        self.assertIn('stage="serialization"', text)
+        self.assertIn('incoming_elasticsearch_took_seconds_count', text)
+        self.assertIn('incoming_redis_command_duration_seconds_bucket{', text)
+        self.assertIn('incoming_elasticsearch_connections_total{event="created"}', text)
+        self.assertIn('incoming_elasticsearch_request_signing_duration_seconds_bucket{', text)
+        self.assertIn('incoming_event_loop_lag_seconds_bucket{', text)
+        self.assertIn('incoming_http_authentication_failures_total{reason="Invalid mac"} 1.0',
+                      text)
+
+    @async_test
+    async def test_traces_requests_and_pages(self):
+        spans = []
+        set_trace_exporter(spans.append, 1.0)
+        self.addCleanup(set_trace_exporter, None, 0.0)
+
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=mock_env(), mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(2))
+
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+        await get_until(url, x_forwarded_for, has_at_least_ordered_items(2))
+
+        def get_trace(root_span):
+            return [span for span in spans if span['trace_id'] == root_span['trace_id']]
+
+        def assert_is_tree(root_span, trace):
+            self.assertIsNone(root_span['parent_id'])
+            span_ids = [span['span_id'] for span in trace]
+            for span in trace:
+                if span is not root_span:
+                    self.assertIn(span['parent_id'], span_ids)
+
+        request_span = [
+            span for span in spans
+            if span['name'] == 'Request' and span['path'] == '/v1/'
+        ][-1]
+        request_trace = get_trace(request_span)
+        request_span_names = [span['name'] for span in request_trace]
+        assert_is_tree(request_span, request_trace)
+        self.assertIn('incoming_http_request_stage_duration_seconds', request_span_names)
+        self.assertIn('incoming_elasticsearch_request_signing_duration_seconds',
+                      request_span_names)
+        self.assertIn('Elasticsearch request by (%s) to (%s) (%s) (%s) (%s)',
+                      request_span_names)
+
+        page_span = [span for span in spans if span['name'] == 'Page'][0]
+        page_trace = get_trace(page_span)
+        page_span_names = [span['name'] for span in page_trace]
+        assert_is_tree(page_span, page_trace)
+        self.assertIn('ingest_page_duration_seconds', page_span_names)
+        self.assertIn('Polling page (%s)', page_span_names)
+        self.assertIn('Parsing JSON', page_span_names)
+        self.assertIn('Pushing (%s) items into Elasticsearch', page_span_names)
+
+    @async_test
+    async def test_traced_outside_task(self):
+        spans = []
+        set_trace_exporter(spans.append, 1.0)
+        self.addCleanup(set_trace_exporter, None, 0.0)
+
+        # Callbacks run by the event loop directly aren't in a task, and if one raises, the
+        # exception is only logged
+        logged_outside_task = []
+
+        def log_outside_task():
+            with \
+                    traced('some-trace-id', 'Outside a task', {}), \
+                    logged(get_root_logger('test'), 'Outside a task', []):
+                pass
+            logged_outside_task.append(True)
+
+        asyncio.get_event_loop().call_soon(log_outside_task)
+        await ORIGINAL_SLEEP(0)
+        self.assertEqual(logged_outside_task, [True])
+        self.assertEqual(spans, [])
+
+    @async_test
+    async def test_profile_if_admin_ip(self):
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=mock_env(), mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+
+        url = 'http://127.0.0.1:8080/admin/profile'
+        async with aiohttp.ClientSession() as session:
+            result = await session.get(url + '?seconds=0.5', headers={
+                'X-Forwarded-For': '1.2.3.4, 127.0.0.0',
+            })
+            collapsed = await result.text()
+            self.assertEqual(result.status, 200)
+
+            result = await session.get(url + '?seconds=0.5&format=speedscope', headers={
+                'X-Forwarded-For': '1.2.3.4, 127.0.0.0',
+            })
+            speedscope = await result.json()
+            self.assertEqual(result.status, 200)
+
+            result = await session.get(url + '?seconds=61', headers={
+                'X-Forwarded-For': '1.2.3.4, 127.0.0.0',
+            })
+            self.assertEqual(result.status, 400)
+
+            result = await session.get(url + '?seconds=0.5', headers={
+                'X-Forwarded-For': '2.3.4.5, 127.0.0.0',
+            })
+            self.assertEqual(result.status, 401)
+
+        # The event loop is sampled, and each line is a stack then its count
+        self.assertIn('run_until_complete', collapsed)
+        for line in collapsed.strip().split('\n'):
+            self.assertRegex(line, r'^.+ \d+$')
+
+        self.assertEqual(speedscope['profiles'][0]['type'], 'sampled')
+        self.assertIn('run_until_complete', [
+            frame['name'] for frame in speedscope['shared']['frames']
+        ])
+
+    @async_test
+    async def test_memory_diff_if_admin_ip(self):
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=mock_env(), mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+
+        url = 'http://127.0.0.1:8080/admin/memory'
+        async with aiohttp.ClientSession() as session:
+            result = await session.get(url + '?seconds=0.5', headers={
+                'X-Forwarded-For': '1.2.3.4, 127.0.0.0',
+            })
+            diff = await result.text()
+            self.assertEqual(result.status, 200)
+
+            # Tracing stays on until the last of overlapping diffs has finished
+            async def get_diff(seconds):
+                result = await session.get(url + f'?seconds={seconds}', headers={
+                    'X-Forwarded-For': '1.2.3.4, 127.0.0.0',
+                })
+                return result.status, await result.text()
+
+            overlapping = await asyncio.gather(get_diff(0.5), get_diff(1))
+            for status, overlapping_diff in overlapping:
+                self.assertEqual(status, 200)
+                self.assertRegex(overlapping_diff, r'^Traced memory: current=\d+ peak=\d+\n')
+
+            result = await session.get(url + '?seconds=a', headers={
+                'X-Forwarded-For': '1.2.3.4, 127.0.0.0',
+            })
+            self.assertEqual(result.status, 400)
+
+            result = await session.get(url + '?seconds=0.5', headers={
+                'X-Forwarded-For': '2.3.4.5, 127.0.0.0',
+            })
+            self.assertEqual(result.status, 401)
+
+        self.assertRegex(diff, r'^Traced memory: current=\d+ peak=\d+\n')
+        self.assertFalse(tracemalloc.is_tracing())
+
+    @async_test
+    async def test_es_node_down_is_ejected(self):
+        env = {
+            **mock_env(),
+            'ELASTICSEARCH__NODES__1__HOST': '127.0.0.1',
+            'ELASTICSEARCH__NODES__1__PORT': '9200',
+            'ELASTICSEARCH__NODES__2__HOST': '127.0.0.1',
+            'ELASTICSEARCH__NODES__2__PORT': '9202',  # Nothing listening
+        }
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=env, mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(2))
+
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+        result, _, _ = await get_until(url, x_forwarded_for, has_at_least_ordered_items(2))
+        self.assertEqual(len(result['orderedItems']), 2)
+
+        async with aiohttp.ClientSession() as session:
+            result = await session.get('http://127.0.0.1:8080/metrics')
+            text = await result.text()
+
+        # The order of labels is apparently not deterministic
+        self.assertIn('elasticsearch_node_ejections_total{', text)
+        self.assertIn('node="http://127.0.0.1:9202"', text)
+        self.assertIn('reason="connection"', text)
+
+    @async_test
+    async def test_es_node_5xx_stays_ejected(self):
+        routes = [
+            web.get('/', respond_http('{}', 200)),
+            web.post('/_bulk', respond_http('{}', 500)),
+            web.get('/{index_names}/_search', respond_http('{}', 500)),
+            web.post('/{index_names}/_search', respond_http('{}', 500)),
+        ]
+        es_runner = await run_es_application(port=9201, override_routes=routes)
+        self.add_async_cleanup(es_runner.cleanup)
+
+        env = {
+            **mock_env(),
+            'ELASTICSEARCH__NODES__1__HOST': '127.0.0.1',
+            'ELASTICSEARCH__NODES__1__PORT': '9200',
+            'ELASTICSEARCH__NODES__2__HOST': '127.0.0.1',
+            'ELASTICSEARCH__NODES__2__PORT': '9201',  # Responds to probes, but not requests
+        }
+
+        async def get_num_5xx_ejections():
+            async with aiohttp.ClientSession() as session:
+                result = await session.get('http://127.0.0.1:8080/metrics')
+                text = await result.text()
+            # The order of labels is apparently not deterministic
+            return sum(
+                float(value)
+                for labels, value in re.findall(r'elasticsearch_node_ejections_total{(.*?)} (.*)',
+                                                text)
+                if 'node="http://127.0.0.1:9201"' in labels and 'reason="500"' in labels
+            )
+
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=env, mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+            for _ in range(0, 60):
+                num_ejections_before = await get_num_5xx_ejections()
+                if num_ejections_before:
+                    break
+                await ORIGINAL_SLEEP(0.5)
+
+            # Probes are made every 0.5 seconds, and the node still responds to them, but
+            # it's only sent requests again once its ejection of 10 seconds has expired
+            await ORIGINAL_SLEEP(4)
+            num_ejections_after = await get_num_5xx_ejections()
+
+        self.assertGreater(num_ejections_before, 0)
+        self.assertLessEqual(num_ejections_after - num_ejections_before, 1)
+
     @async_test
     async def test_empty_feed_is_success(self):
         env = {
@@ -1089,7 +1711,239 @@ class TestApplication(TestBase):
         self.assertIn('status="success"', await result.text())
 
     @async_test
-    async def test_if_lost_lock_then_raise(self):
+    async def test_pushed_are_searchable(self):
+        env = {**mock_env(), 'INCOMING_ACCESS_KEY_PAIRS__1__FEED_UNIQUE_ID': 'first_feed'}
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=env, mock_feed=read_file, mock_feed_status=lambda: 200,
+                                    mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(2))
+
+        body = json.dumps({'orderedItems': [{
+            'id': 'dit:exportOpportunities:Enquiry:50001:Create',
+            'type': 'Create',
+            'published': '2018-04-12T12:48:13+00:00',
+            'object': {'id': 'dit:exportOpportunities:Enquiry:50001'},
+        }]})
+        auth = hawk_auth_header(
+            'incoming-some-id-1', 'incoming-some-secret-1', url, 'POST', body,
+            'application/json',
+        )
+        text, status, _ = await post_body(url, auth, x_forwarded_for, body)
+        self.assertEqual(status, 200)
+        self.assertEqual(text, '{"accepted": 1}')
+
+        def has_pushed_item(results):
+            return 'dit:exportOpportunities:Enquiry:50001:Create' in str(results)
+
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            _, status, _ = await get_until(url, x_forwarded_for, has_pushed_item)
+        self.assertEqual(status, 200)
+
+        # The second key pair isn't for a feed, and invalid activities are rejected
+        auth = hawk_auth_header(
+            'incoming-some-id-2', 'incoming-some-secret-2', url, 'POST', body,
+            'application/json',
+        )
+        _, status, _ = await post_body(url, auth, x_forwarded_for, body)
+        self.assertEqual(status, 403)
+
+        auth = hawk_auth_header(
+            'incoming-some-id-1', 'incoming-some-secret-1', url, 'POST', '{}',
+            'application/json',
+        )
+        _, status, _ = await post_body(url, auth, x_forwarded_for, '{}')
+        self.assertEqual(status, 400)
+
+    @async_test
+    async def test_push_queue_full_then_429(self):
+        env = {**mock_env(), 'INCOMING_ACCESS_KEY_PAIRS__1__FEED_UNIQUE_ID': 'first_feed'}
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+
+        body = json.dumps({'orderedItems': [
+            {'id': 'dit:exportOpportunities:Enquiry:50001:Create'},
+            {'id': 'dit:exportOpportunities:Enquiry:50002:Create'},
+        ]})
+
+        # Pushes are only accepted once the feed has an index
+        with \
+                patch('asyncio.sleep', wraps=fast_sleep), \
+                patch('core.app.app_incoming.PUSH_QUEUE_MAX_ITEMS', 1):
+            await self.setup_manual(env=env, mock_feed=read_file, mock_feed_status=lambda: 200,
+                                    mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(2))
+
+            for _ in range(0, 20):
+                auth = hawk_auth_header(
+                    'incoming-some-id-1', 'incoming-some-secret-1', url, 'POST', body,
+                    'application/json',
+                )
+                _, status, headers = await post_body(url, auth, x_forwarded_for, body)
+                if status != 503:
+                    break
+                await ORIGINAL_SLEEP(0.5)
+
+        self.assertEqual(status, 429)
+        self.assertEqual(headers['Retry-After'], '1')
+
+    @async_test
+    async def test_push_without_index_503(self):
+        # The feed isn't ingested, so never has an index
+        env = {**mock_env(), 'INCOMING_ACCESS_KEY_PAIRS__1__FEED_UNIQUE_ID': 'unknown_feed'}
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+
+        await self.setup_manual(env=env, mock_feed=read_file, mock_feed_status=lambda: 200,
+                                mock_headers=lambda: {})
+
+        body = json.dumps({'orderedItems': [
+            {'id': 'dit:exportOpportunities:Enquiry:50001:Create'},
+        ]})
+        auth = hawk_auth_header(
+            'incoming-some-id-1', 'incoming-some-secret-1', url, 'POST', body,
+            'application/json',
+        )
+        _, status, headers = await post_body(url, auth, x_forwarded_for, body)
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['Retry-After'], '10')
+
+    @async_test
+    async def test_push_rejected_dropped(self):
+        # Elasticsearch accepts the bulk ingest, but rejects the bad item in it, so it's
+        # dropped, and the others are written
+        bulk_contents_written = []
+
+        async def handle_bulk(request):
+            lines = (await request.read()).split(b'\n')
+            items = []
+            for source in lines[1::2]:
+                if b'Bad' in source:
+                    items.append({'index': {
+                        'status': 400, 'error': {'type': 'mapper_parsing_exception'},
+                    }})
+                else:
+                    bulk_contents_written.append(source)
+                    items.append({'index': {'status': 201}})
+            return web.json_response({'errors': True, 'items': items}, status=200)
+
+        es_runner = await run_es_application(port=9201, override_routes=[
+            web.post('/_bulk', handle_bulk),
+            web.get('/_aliases', respond_http(json.dumps({
+                'activities__feed_id_first_feed__date_2018-01-01__timestamp_1__batch_id_a__': {
+                    'aliases': {'activities': {}},
+                },
+            }), 200)),
+        ])
+        self.add_async_cleanup(es_runner.cleanup)
+
+        env = {
+            **mock_env(),
+            'ELASTICSEARCH__PORT': '9201',
+            'INCOMING_ACCESS_KEY_PAIRS__1__FEED_UNIQUE_ID': 'first_feed',
+        }
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+        pushed_ids = [
+            'dit:exportOpportunities:Enquiry:50001:Create',
+            'dit:exportOpportunities:Enquiry:50002:Create',
+            'dit:exportOpportunities:Enquiry:Bad:Create',
+            'dit:exportOpportunities:Enquiry:50003:Create',
+        ]
+        body = json.dumps({'orderedItems': [{'id': pushed_id} for pushed_id in pushed_ids]})
+
+        def written_ids():
+            return [
+                pushed_id
+                for pushed_id in pushed_ids
+                for es_bulk_contents in bulk_contents_written
+                if pushed_id.encode('utf-8') in es_bulk_contents
+            ]
+
+        async def is_all_good_written():
+            return len(written_ids()) == 3
+
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=env, mock_feed=read_file, mock_feed_status=lambda: 200,
+                                    mock_headers=lambda: {})
+            for _ in range(0, 20):
+                auth = hawk_auth_header(
+                    'incoming-some-id-1', 'incoming-some-secret-1', url, 'POST', body,
+                    'application/json',
+                )
+                _, status, _ = await post_body(url, auth, x_forwarded_for, body)
+                if status != 503:
+                    break
+                await ORIGINAL_SLEEP(0.5)
+            self.assertEqual(status, 200)
+            await wait_until(is_all_good_written, 30)
+
+        self.assertEqual(sorted(written_ids()), sorted(pushed_ids[:2] + pushed_ids[3:]))
+
+    @async_test
+    async def test_updates_long_polled(self):
+        env = {**mock_env(), 'FEEDS__1__LONG_POLL_SECONDS': '30'}
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=env, mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+            self.feed_requested.extend([asyncio.Future() for _ in range(0, 20)])
+
+            def requests_long_polled():
+                return [
+                    future.result().headers.get('Prefer') == 'wait=30'
+                    for future in self.feed_requested
+                    if future.done()
+                ]
+
+            async def is_long_polled():
+                return True in requests_long_polled()
+
+            await wait_until(is_long_polled, 60)
+
+        # The full ingest isn't long polled, only the updates
+        self.assertFalse(requests_long_polled()[0])
+
+    @async_test
+    async def test_journal_replayed_in_full(self):
+        async def delete_feed_updates_journal(*_):
+            pass
+
+        journal_key = 'feed-updates-journal-first_feed'
+        with \
+                patch('asyncio.sleep', wraps=fast_sleep), \
+                patch('core.app.app_outgoing.delete_feed_updates_journal',
+                      wraps=delete_feed_updates_journal):
+            await self.setup_manual(env=mock_env(), mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+            redis_client = await aioredis.create_redis('redis://127.0.0.1:6379')
+            try:
+                journaled_id = 'dit:test:Journaled:Create'
+                await redis_client.execute('HSET', journal_key, journaled_id, json.dumps({
+                    'id': 'dit:test:Journaled:Create',
+                    'type': 'Create',
+                    'published': '2018-04-12T12:48:13+00:00',
+                    'object': {'id': 'dit:test:Journaled'},
+                }))
+
+                # Only in the journal, so only searchable if it's replayed by a full ingest
+                await fetch_all_es_data_until(
+                    lambda results: 'dit:test:Journaled:Create' in str(results))
+
+                # The updates ingest journals what it writes
+                async def is_update_journaled():
+                    return b'dit:exportOpportunities:Enquiry:49863:Create' in \
+                        await redis_client.execute('HKEYS', journal_key)
+
+                await wait_until(is_update_journaled, 60)
+                self.assertGreater(await redis_client.execute('TTL', journal_key), 0)
+            finally:
+                redis_client.close()
+                await redis_client.wait_closed()
+
+    @async_test
+    async def test_if_lost_lease_then_raise(self):
         async def mock_close():
             await ORIGINAL_SLEEP(0)
 
@@ -1098,7 +1952,379 @@ class TestApplication(TestBase):
             await self.setup_manual(env=mock_env(), mock_feed=read_file,
                                     mock_feed_status=lambda: 200, mock_headers=lambda: {})
             redis_client = await aioredis.create_redis('redis://127.0.0.1:6379')
-            await redis_client.execute('DEL', 'lock')
+            await redis_client.execute('DEL', 'feed-lease-first_feed')
             await ORIGINAL_SLEEP(2)
 
-        raven_client().captureMessage.assert_called()
+        raven_client().captureMessage.assert_called_with('Lease has been lost')
+
+    @async_test
+    async def test_leased_unknown_feed_kept(self):
+        with patch('asyncio.sleep', wraps=fast_sleep):
+            await self.setup_manual(env=mock_env(), mock_feed=read_file,
+                                    mock_feed_status=lambda: 200, mock_headers=lambda: {})
+            await fetch_all_es_data_until(has_at_least(2))
+
+            # Feeds this instance isn't configured with, one of which is being ingested by
+            # another instance, as if during a deploy that adds it
+            leased_index = 'activities__feed_id_leased__date_2018-01-01__timestamp_1__batch_id_a__'
+            unleased_index = \
+                'activities__feed_id_unleased__date_2018-01-01__timestamp_1__batch_id_b__'
+            async with aiohttp.ClientSession() as session:
+                for index_name in [leased_index, unleased_index]:
+                    await session.put(f'http://127.0.0.1:9200/{index_name}')
+            redis_client = await aioredis.create_redis('redis://127.0.0.1:6379')
+            try:
+                await redis_client.execute('SET', 'feed-lease-leased', 'other', 'EX', '60')
+            finally:
+                redis_client.close()
+                await redis_client.wait_closed()
+
+            cleanup = await run_outgoing_application()
+            self.add_async_cleanup(cleanup)
+
+            for _ in range(0, 60):
+                index_names = await fetch_es_index_names()
+                if unleased_index not in index_names:
+                    break
+                await ORIGINAL_SLEEP(0.5)
+
+        self.assertNotIn(unleased_index, index_names)
+        self.assertIn(leased_index, index_names)
+
+
+def get_unit_test_context(registry):
+    ''' A context for functions that don't need Redis or Elasticsearch '''
+    return Context(
+        logger=get_root_logger('test'), metrics=get_metrics(registry),
+        raven_client=Mock(), redis_client=None, redis_write_queue=None, session=None,
+        es_session=None, es_nodes=None, es_refresh_queue=es_get_refresh_queue(),
+        es_bulk_spool=None,
+    )
+
+
+class TestRefresher(unittest.TestCase):
+
+    @async_test
+    async def test_coalesced_into_one_refresh(self):
+        context = get_unit_test_context(CollectorRegistry())
+        refreshed = []
+
+        async def refresh(path, **_):
+            refreshed.append(path)
+
+        with patch('core.app.app_elasticsearch.es_request_non_200_exception', wraps=refresh):
+            refresh_indexes_later(context, ['a'])
+            create_es_refresher(context, None, 0.5, [0])
+            await ORIGINAL_SLEEP(0.1)
+            refresh_indexes_later(context, ['b', 'a'])
+            refresh_indexes_later(context, [])
+            refresh_indexes_later(context, ['c'])
+            await ORIGINAL_SLEEP(1.5)
+            await cancel_non_current_tasks()
+
+        self.assertEqual(refreshed, ['/a,b,c/_refresh'])
+
+    @async_test
+    async def test_failed_requeued(self):
+        registry = CollectorRegistry()
+        context = get_unit_test_context(registry)
+        refreshed = []
+        now = [100]
+
+        async def fail_then_refresh(path, **_):
+            refreshed.append(path)
+            now[0] += 100
+            if len(refreshed) == 1:
+                raise ESUnavailable('{}')
+
+        with \
+                patch('core.app.app_elasticsearch.es_request_non_200_exception',
+                      wraps=fail_then_refresh), \
+                patch('core.app.app_elasticsearch.time',
+                      Mock(monotonic=lambda: now[0])):
+            refresh_indexes_later(context, ['a', 'b'])
+            create_es_refresher(context, None, 0, [0])
+            await ORIGINAL_SLEEP(0.5)
+            await cancel_non_current_tasks()
+
+        # The delay is from when they were first requested, before the failed refresh
+        self.assertEqual(refreshed, ['/a,b/_refresh', '/a,b/_refresh'])
+        self.assertEqual(registry.get_sample_value('elasticsearch_refresh_delay_seconds_sum'),
+                         200 * 2)
+
+
+class TestIndexHealth(unittest.TestCase):
+
+    @async_test
+    async def test_unavailable_if_unhealthy(self):
+        context = get_unit_test_context(CollectorRegistry())
+
+        async def cluster_health(**_):
+            response = Mock()
+            response.json = asyncio.coroutine(lambda: {'number_of_data_nodes': 2})
+            return response
+
+        async def index_health(**_):
+            response = Mock()
+            response.status = 408
+            await ORIGINAL_SLEEP(0.1)
+            return response
+
+        with \
+                patch('core.app.app_elasticsearch.es_request_non_200_exception',
+                      wraps=cluster_health), \
+                patch('core.app.app_elasticsearch.es_request', wraps=index_health), \
+                patch('core.app.app_elasticsearch.ES_HEALTH_WAIT_MAX', 0.5):
+            with self.assertRaises(ESUnavailable) as raised:
+                await wait_for_index_health(context, None, 'index', 1)
+
+        self.assertIsInstance(raised.exception.__cause__, asyncio.TimeoutError)
+
+
+class TestJournal(unittest.TestCase):
+
+    @async_test
+    async def test_read_in_batches(self):
+        redis_client = await aioredis.create_redis('redis://127.0.0.1:6379')
+        context = get_unit_test_context(CollectorRegistry())._replace(redis_client=redis_client)
+        journal_key = 'feed-updates-journal-journal_feed'
+        try:
+            await redis_client.execute('DEL', journal_key)
+            ids_and_sources = [(str(i), {'id': str(i)}) for i in range(0, 1000)]
+            await append_feed_updates_journal(context, 'journal_feed', ids_and_sources[:500])
+            await append_feed_updates_journal(context, 'journal_feed', ids_and_sources[500:])
+            ttl = await redis_client.execute('TTL', journal_key)
+
+            cursor, num_batches, journal = 0, 0, {}
+            while True:
+                cursor, batch = await get_feed_updates_journal(
+                    context, 'journal_feed', cursor, 100)
+                journal.update(batch)
+                num_batches += 1
+                if not cursor:
+                    break
+        finally:
+            await redis_client.execute('DEL', journal_key)
+            redis_client.close()
+            await redis_client.wait_closed()
+
+        self.assertGreater(ttl, 0)
+        self.assertGreater(num_batches, 1)
+        self.assertEqual(journal, dict(ids_and_sources))
+
+
+class TestUpdatesInterval(unittest.TestCase):
+
+    def test_doubles_while_idle(self):
+        feed = collections.namedtuple('Feed', [
+            'updates_page_interval', 'updates_page_interval_max', 'long_poll_seconds',
+        ])(updates_page_interval=1, updates_page_interval_max=8, long_poll_seconds=0)
+        updates_interval = get_updates_interval(feed)
+
+        # Empty, or the same single page as before, is idle
+        self.assertEqual(updates_interval([None]), 2)
+        self.assertEqual(updates_interval([b'a']), 1)
+        self.assertEqual(updates_interval([b'a']), 2)
+        self.assertEqual(updates_interval([None]), 4)
+        self.assertEqual(updates_interval([None]), 8)
+        self.assertEqual(updates_interval([None]), 8)
+        self.assertEqual(updates_interval([]), 8)
+
+        # New data, or more than one page, resets the interval
+        self.assertEqual(updates_interval([b'b']), 1)
+        self.assertEqual(updates_interval([b'b']), 2)
+        self.assertEqual(updates_interval([b'b', None]), 1)
+
+    def test_constant_if_long_polled(self):
+        feed = collections.namedtuple('Feed', [
+            'updates_page_interval', 'updates_page_interval_max', 'long_poll_seconds',
+        ])(updates_page_interval=1, updates_page_interval_max=8, long_poll_seconds=30)
+        updates_interval = get_updates_interval(feed)
+
+        self.assertEqual(updates_interval([None]), 1)
+        self.assertEqual(updates_interval([None]), 1)
+        self.assertEqual(updates_interval([]), 1)
+
+
+class TestNumberOfShards(unittest.TestCase):
+
+    index_config = IndexConfig(
+        number_of_replicas=1, force_merge_segments=0, shard_target_bytes=1000,
+        shard_target_docs=100, max_shards=16,
+    )
+
+    def test_larger_of_bytes_and_docs(self):
+        self.assertEqual(number_of_shards_for_size([
+            {'pri.store.size': '2500', 'docs.count': '10'},
+        ], self.index_config), 3)
+        self.assertEqual(number_of_shards_for_size([
+            {'pri.store.size': '10', 'docs.count': '250'},
+            {'pri.store.size': '10', 'docs.count': '250'},
+        ], self.index_config), 5)
+
+    def test_clamped(self):
+        self.assertEqual(number_of_shards_for_size([
+            {'pri.store.size': '0', 'docs.count': '0'},
+        ], self.index_config), 1)
+        self.assertEqual(number_of_shards_for_size([
+            {'pri.store.size': '100000', 'docs.count': '0'},
+        ], self.index_config), 16)
+
+    def test_unallocated_null_sizes(self):
+        self.assertEqual(number_of_shards_for_size([
+            {'pri.store.size': None, 'docs.count': None},
+            {'pri.store.size': '1500', 'docs.count': '10'},
+        ], self.index_config), 2)
+
+
+class TestPriorityLock(unittest.TestCase):
+
+    @staticmethod
+    async def acquisition_order(acquire, release, waiters):
+        ''' The order that waiters, (name, is_priority) pairs that start waiting in order while
+        the lock is held, acquire the lock once it's released '''
+        acquired = []
+
+        async def acquire_and_release(name, is_priority):
+            await acquire(is_priority=is_priority)
+            acquired.append(name)
+            release()
+
+        await acquire(is_priority=False)
+        tasks = [
+            asyncio.ensure_future(acquire_and_release(name, is_priority))
+            for name, is_priority in waiters
+        ]
+        await asyncio.sleep(0)
+        release()
+        await asyncio.gather(*tasks)
+        return acquired
+
+    @async_test
+    async def test_priority_without_starving(self):
+        acquire, release = get_priority_lock(max_consecutive_priority=2)
+
+        self.assertEqual(await self.acquisition_order(acquire, release, [
+            ('a', False), ('b', True), ('c', True), ('d', True), ('e', False), ('f', True),
+        ]), ['b', 'c', 'a', 'd', 'f', 'e'])
+
+    @async_test
+    async def test_priority_counted_if_waits(self):
+        acquire, release = get_priority_lock(max_consecutive_priority=2)
+
+        self.assertEqual(await self.acquisition_order(acquire, release, [
+            ('a', True), ('b', True), ('c', True),
+        ]), ['a', 'b', 'c'])
+        self.assertEqual(await self.acquisition_order(acquire, release, [
+            ('d', False), ('e', True), ('f', True), ('g', True),
+        ]), ['e', 'f', 'd', 'g'])
+
+
+class TestFetchFeedPage(unittest.TestCase):
+
+    @async_test
+    async def test_long_poll_interrupted(self):
+        context = get_unit_test_context(CollectorRegistry())
+        feed = collections.namedtuple('Feed', [
+            'unique_id', 'auth_headers', 'updates_page_interval',
+        ])(unique_id='feed', auth_headers=lambda _: {}, updates_page_interval=1)
+        feed_lock = get_priority_lock(max_consecutive_priority=2)
+        feed_state = get_feed_state(feed)
+        requested = []
+
+        async def get_feed_contents(_, href, headers, **__):
+            requested.append((href, 'Prefer' in headers))
+            if 'Prefer' in headers:
+                await asyncio.Future()
+            return b'contents'
+
+        with patch('core.app.app_outgoing.get_feed_contents', wraps=get_feed_contents):
+            updates = asyncio.ensure_future(fetch_feed_page(
+                context, 'updates', feed_lock, feed_state, feed, 'updates-href', 60))
+
+            async def is_long_polled():
+                return feed_state['long_poll'] is not None
+
+            await wait_until(is_long_polled, 1)
+            full = await fetch_feed_page(
+                context, 'full', feed_lock, feed_state, feed, 'full-href', 0)
+            updates_contents = await updates
+
+        # The full request was made under the lock after the long poll had been interrupted
+        self.assertEqual(full, b'contents')
+        self.assertEqual(updates_contents, None)
+        self.assertEqual(requested, [('updates-href', True), ('full-href', False)])
+        self.assertEqual(feed_state['long_poll'], None)
+
+
+class TestSpool(unittest.TestCase):
+
+    @async_test
+    async def test_corrupt_dead_lettered(self):
+        registry = CollectorRegistry()
+        context = get_unit_test_context(registry)
+        record_size = SPOOL_RECORD_HEADER.size + 1
+
+        with tempfile.TemporaryDirectory() as directory:
+            spool = get_spool(context, directory, 1024, 1024)
+            for payload in [b'a', b'b', b'c', b'd']:
+                await spool_append(context, spool, payload)
+
+            # At startup, a partially written record is dead-lettered
+            segment_path = os.path.join(directory, f'{0:020d}.segment')
+            with open(segment_path, 'r+b') as segment_file:
+                segment_file.truncate(record_size * 4 - 1)
+            spool = get_spool(context, directory, 1024, 1024)
+            self.assertEqual(spool.state['num_records'], 3)
+
+            # While writing, a corrupt record is dead-lettered, and the rest are written
+            with open(segment_path, 'r+b') as segment_file:
+                segment_file.seek(record_size * 2 - 1)
+                segment_file.write(b'x')
+            self.assertEqual(await spool_peek(spool), (b'a', record_size))
+            await spool_pop(context, spool, record_size)
+            self.assertEqual(await spool_peek(spool), (None, record_size))
+            await spool_dead_letter(context, spool, record_size)
+            await spool_pop(context, spool, record_size)
+            self.assertEqual(await spool_peek(spool), (b'c', record_size))
+
+            dead_letter_path = os.path.join(directory, 'dead-letter')
+            dead_lettered_1, dead_lettered_1_size = _segment_read(dead_letter_path, 0)
+            dead_lettered_2, _ = _segment_read(dead_letter_path, dead_lettered_1_size)
+
+        # The dead-lettered records are the bytes of the spool, as they were
+        self.assertEqual(dead_lettered_1, SPOOL_RECORD_HEADER.pack(1, zlib.crc32(b'd')))
+        self.assertEqual(dead_lettered_2, SPOOL_RECORD_HEADER.pack(1, zlib.crc32(b'b')) + b'x')
+        self.assertEqual(registry.get_sample_value(
+            'ingest_spool_records_total', {'result': 'dead_lettered'}), 2)
+
+    @async_test
+    async def test_items_dead_lettered(self):
+        registry = CollectorRegistry()
+        context = get_unit_test_context(registry)
+        items = [
+            {
+                'action_and_metadata': {'index': {'_id': item_id, '_index': 'index'}},
+                'source': {'id': item_id},
+            }
+            for item_id in ['a', 'b', 'c']
+        ]
+
+        async def reject_second(*_, **__):
+            return [1]
+
+        with \
+                tempfile.TemporaryDirectory() as directory, \
+                patch('core.app.app_spool.es_bulk_contents_post', wraps=reject_second):
+            context = context._replace(es_bulk_spool=get_spool(context, directory, 1024, 1024))
+            await es_bulk_or_spool(context, None, items)
+            dead_lettered, _ = _segment_read(os.path.join(directory, 'dead-letter'), 0)
+
+        # Only the rejected item is dead-lettered, as a record of the spool would be
+        payload = \
+            b'{"index":{"_id":"b","_index":"index"}}\n' + \
+            b'{"id":"b"}\n'
+        self.assertEqual(dead_lettered,
+                         SPOOL_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.assertEqual(registry.get_sample_value(
+            'ingest_spool_records_total', {'result': 'dead_lettered'}), 1)
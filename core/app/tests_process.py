@@ -1,10 +1,12 @@
 import asyncio
 import os
+import signal
 import sys
 import unittest
 from unittest.mock import Mock
 
 from aiohttp import web
+import aioredis
 
 from .tests_utils import (
     async_test,
@@ -22,6 +24,30 @@ from .tests_utils import (
 )
 
 
+def child_pids(pid):
+    ''' The running processes whose parent is pid, from /proc, so only on Linux '''
+    return [
+        int(child_pid)
+        for child_pid in os.listdir('/proc')
+        if child_pid.isdigit()
+        for state, parent_pid in [_proc_state_and_parent(child_pid)]
+        if parent_pid == pid and state not in ['Z', 'X']
+    ]
+
+
+def is_process_running(pid):
+    return _proc_state_and_parent(pid)[0] not in [None, 'Z', 'X']
+
+
+def _proc_state_and_parent(pid):
+    try:
+        with open(f'/proc/{pid}/stat', encoding='utf-8') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None, None
+    return fields[0], int(fields[1])
+
+
 class TestProcess(unittest.TestCase):
 
     def add_async_cleanup(self, coroutine):
@@ -127,6 +153,86 @@ class TestProcess(unittest.TestCase):
         self.assertEqual(server_inc.returncode, 0)
         self.assertEqual(server_out.returncode, 0)
 
+    @async_test
+    async def test_workers_and_exit_clean(self):
+        (server_out, stdout_out), (server_inc, stdout_inc), _ = await self.setup_manual({
+            **mock_env(), 'OUTGOING_WORKERS': '2',
+        })
+        self.assertTrue(await is_http_accepted_eventually())
+        await wait_until_get_working()
+
+        url = 'http://127.0.0.1:8080/v1/'
+        x_forwarded_for = '1.2.3.4, 127.0.0.0'
+        result, _, _ = await get_until(url, x_forwarded_for,
+                                       has_at_least_ordered_items(500))
+        ids = [item['id'] for item in result['orderedItems']]
+        self.assertIn('dit:activityStreamVerificationFeed:Verifier', str(ids))
+
+        await self.terminate(server_out, server_inc)
+
+        final_string = b'Reached end of main. Exiting now.\n'
+        self.assertEqual(final_string, stdout_inc())
+        self.assertEqual(final_string, stdout_out())
+        self.assertEqual(server_inc.returncode, 0)
+        self.assertEqual(server_out.returncode, 0)
+
+    @async_test
+    async def test_killed_worker_keeps_feeds(self):
+        (server_out, _), _, _ = await self.setup_manual({
+            **mock_env(), 'OUTGOING_WORKERS': '2',
+        })
+        redis_client = await aioredis.create_redis('redis://127.0.0.1:6379')
+        self.add_async_cleanup(redis_client.wait_closed)
+        self.addCleanup(redis_client.close)
+        lease_keys = ['feed-lease-first_feed', 'feed-lease-verification']
+
+        async def get_instances_and_owners():
+            instance_ids = await redis_client.execute('ZRANGE', 'outgoing-instances', '0', '-1')
+            owners = await redis_client.execute('MGET', *lease_keys)
+            return set(instance_ids), owners
+
+        for _ in range(0, 60):
+            instance_ids, owners = await get_instances_and_owners()
+            worker_pids = child_pids(server_out.pid)
+            if len(instance_ids) == 2 and set(owners) <= instance_ids and len(worker_pids) == 2:
+                break
+            await asyncio.sleep(0.5)
+        self.assertEqual(len(worker_pids), 2)
+
+        # The worker is restarted, and meanwhile its leases may expire, but its feeds are
+        # never taken by the other worker
+        os.kill(worker_pids[0], signal.SIGKILL)
+        for _ in range(0, 20):
+            await asyncio.sleep(0.5)
+            instance_ids_after, owners_after = await get_instances_and_owners()
+            self.assertEqual(instance_ids_after, instance_ids)
+            for owner, owner_after in zip(owners, owners_after):
+                self.assertIn(owner_after, [owner, None])
+
+        self.assertEqual(owners_after, owners)
+        restarted_worker_pids = child_pids(server_out.pid)
+        self.assertEqual(len(restarted_worker_pids), 2)
+        self.assertNotIn(worker_pids[0], restarted_worker_pids)
+
+    @async_test
+    async def test_workers_stop_if_orphaned(self):
+        (server_out, _), _, _ = await self.setup_manual({
+            **mock_env(), 'OUTGOING_WORKERS': '2',
+        })
+        for _ in range(0, 60):
+            worker_pids = child_pids(server_out.pid)
+            if len(worker_pids) == 2:
+                break
+            await asyncio.sleep(0.5)
+        self.assertEqual(len(worker_pids), 2)
+
+        server_out.kill()
+        for _ in range(0, 40):
+            if not any(is_process_running(worker_pid) for worker_pid in worker_pids):
+                break
+            await asyncio.sleep(0.5)
+        self.assertFalse(any(is_process_running(worker_pid) for worker_pid in worker_pids))
+
     @async_test
     async def test_if_es_down_exit_clean(self):
         (server_out, stdout_out), (server_inc, stdout_inc), _ = await self.setup_manual({
@@ -202,3 +308,54 @@ class TestProcess(unittest.TestCase):
         verification_feed.terminate()
         check_down, _, _ = await get_until_raw(check_url, x_forwarded_for, check_is_not_up)
         self.assertIn('__DOWN__', check_down)
+
+    @async_test
+    async def test_feeds_handed_over(self):
+        (server_out, _), _, _ = await self.setup_manual(mock_env())
+        server_out_2 = await asyncio.create_subprocess_exec(
+            *[sys.executable, '-m', 'core.app.app_outgoing'], env={
+                **mock_env(),
+                'COVERAGE_PROCESS_START': os.environ['COVERAGE_PROCESS_START'],
+                'FEEDS__2__UNIQUE_ID': 'verification',
+                'FEEDS__2__SEED': 'http://localhost:8082/0',
+                'FEEDS__2__ACCESS_KEY_ID': '',
+                'FEEDS__2__SECRET_ACCESS_KEY': '',
+                'FEEDS__2__TYPE': 'activity_stream',
+            }, stdout=asyncio.subprocess.DEVNULL)
+
+        async def terminate_server_out_2():
+            if server_out_2.returncode is None:
+                server_out_2.terminate()
+            await server_out_2.wait()
+        self.add_async_cleanup(terminate_server_out_2)
+
+        redis_client = await aioredis.create_redis('redis://127.0.0.1:6379')
+        self.add_async_cleanup(redis_client.wait_closed)
+        self.addCleanup(redis_client.close)
+        lease_keys = ['feed-lease-first_feed', 'feed-lease-verification']
+
+        async def get_instances_and_owners():
+            instance_ids = await redis_client.execute('ZRANGE', 'outgoing-instances', '0', '-1')
+            owners = await redis_client.execute('MGET', *lease_keys)
+            return set(instance_ids), set(owners)
+
+        async def wait_until(predicate):
+            for _ in range(0, 60):
+                instance_ids, owners = await get_instances_and_owners()
+                if predicate(instance_ids, owners):
+                    return instance_ids, owners
+                await asyncio.sleep(0.5)
+            raise Exception('Timed out')
+
+        # Both instances have joined, and every feed is leased by one of them
+        both_instance_ids, _ = await wait_until(
+            lambda instance_ids, owners: len(instance_ids) == 2 and owners <= instance_ids)
+
+        # Once one leaves, the remaining instance takes over all its feeds
+        await terminate_server_out_2()
+        instance_ids, owners = await wait_until(
+            lambda instance_ids, owners: len(instance_ids) == 1 and owners == instance_ids)
+        self.assertLess(instance_ids, both_instance_ids)
+        self.assertEqual(owners, instance_ids)
+        self.assertEqual(server_out_2.returncode, 0)
+        self.assertIsNone(server_out.returncode)
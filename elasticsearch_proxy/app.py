@@ -1,25 +1,44 @@
 import asyncio
-import logging
+import collections
+import fnmatch
+import hashlib
+import json
 import os
 import secrets
-import sys
+import signal
+import tempfile
+import time
 import urllib
 
 import aiohttp
 from aiohttp import web
 from aiohttp_session import (
+    Session,
     get_session,
     session_middleware,
 )
 from aiohttp_session.redis_storage import RedisStorage
 import aioredis
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    generate_latest,
+)
 
+from shared.elasticsearch import (
+    METRICS_CONF_ES_SESSION,
+    es_trace_config,
+    get_es_session,
+)
 from shared.logger import (
+    configure_root_logger,
+    configure_tracing,
     get_root_logger,
     logged,
 )
 from shared.utils import (
-    aws_auth_headers,
+    aws_auth_headers_payload_hash,
     get_common_config,
     normalise_environment,
 )
@@ -30,94 +49,505 @@ from shared.web import (
 
 INCORRECT = 'Incorrect authentication credentials.'
 
+# Only protected by the IP whitelist, so Prometheus can access them
+METRICS_PATH = '/__metrics'
+
+# Bodies are streamed through in chunks, so memory per request doesn't grow with their size
+PROXY_CHUNK_SIZE = 65536
+PROXY_MAX_IN_MEMORY_BODY = 1048576
+PROXY_MAX_LOGGED_BODY = 1024
+
+# Apply to a single connection, so aren't passed on from Elasticsearch
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding'}
+
+# A dashboard load makes many requests at once, so the session and the Staff SSO profile are
+# cached rather than fetched for each. An instance can use a revoked session or profile for
+# at most the time it's cached in memory
+SESSION_CACHE_SECONDS = 5
+ME_PROFILE_MEMORY_CACHE_SECONDS = 10
+ME_PROFILE_REDIS_CACHE_SECONDS = 60
+
+# Kibana re-sends the same searches on every refresh of every open dashboard, so responses to
+# them can be cached, if RESPONSE_CACHE__SECONDS is set
+RESPONSE_CACHE_MAX_BYTES = 67108864
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 4194304
+RESPONSE_CACHE_METHODS = {'GET', 'POST'}
+RESPONSE_CACHE_ENDPOINTS = {'_search', '_msearch'}
+
+# Kibana's requests to Elasticsearch are under this path, with the usual path after it
+KIBANA_ES_PATH_PARTS = ['_plugin', 'kibana', 'elasticsearch']
+KIBANA_INDEX = '.kibana'
+
+METRICS_CONF_RESPONSE_CACHE = [
+    (Counter, 'elasticsearch_proxy_response_cache_requests_total',
+     'The number of requests to Elasticsearch that hit, missed, or bypassed the cache',
+     ['result']),
+    (Gauge, 'elasticsearch_proxy_response_cache_size_bytes',
+     'The size of the responses in the cache in bytes', []),
+]
+
+ProxyConfig = collections.namedtuple(
+    'ProxyConfig', [
+        'port', 'ip_whitelist', 'staff_sso_base', 'staff_sso_client_id',
+        'staff_sso_client_secret', 'es_endpoint', 'redis_uri', 'response_cache',
+    ],
+)
+
+ResponseCacheConfig = collections.namedtuple(
+    'ResponseCacheConfig', [
+        'seconds', 'max_bytes', 'index_seconds',
+    ],
+)
+
+CachedResponse = collections.namedtuple(
+    'CachedResponse', [
+        'status', 'headers', 'body',
+    ],
+)
+
 
 async def run_application():
     logger = get_root_logger('elasticsearch-proxy')
 
     with logged(logger, 'Examining environment', []):
-        env = normalise_environment(os.environ)
-        port = env['PORT']
-        ip_whitelist = env['INCOMING_IP_WHITELIST']
-        staff_sso_client_base = env['STAFF_SSO_BASE']
-        staff_sso_client_id = env['STAFF_SSO_CLIENT_ID']
-        staff_sso_client_secret = env['STAFF_SSO_CLIENT_SECRET']
-        es_endpoint, redis_uri, _ = get_common_config(env)
+        config = parse_proxy_config(normalise_environment(os.environ))
+
+    metrics_registry = CollectorRegistry()
+    metrics = get_metrics(metrics_registry,
+                          METRICS_CONF_ES_SESSION + METRICS_CONF_RESPONSE_CACHE)
 
     client_session = aiohttp.ClientSession(skip_auto_headers=['Accept-Encoding'])
+    es_session = get_es_session([es_trace_config(metrics)],
+                                skip_auto_headers=['Accept-Encoding'])
+    redis_pool = await aioredis.create_pool(config.redis_uri)
+
+    with logged(logger, 'Creating listening web application', []):
+        runner = await create_proxy_application(
+            logger, config, client_session, redis_pool,
+            handle_proxy(config, metrics, es_session), metrics_registry,
+        )
+
+    async def cleanup():
+        await runner.cleanup()
+        await client_session.close()
+        await es_session.close()
+        redis_pool.close()
+        await redis_pool.wait_closed()
+        # https://github.com/aio-libs/aiohttp/issues/1925
+        await asyncio.sleep(0.250)
+
+    return cleanup
+
+
+async def create_proxy_application(logger, config, client_session, redis_pool, handle,
+                                   metrics_registry):
+    redis_storage = CachedRedisStorage(redis_pool, max_age=60*60*24)
+    app = web.Application(middlewares=[
+        server_logger(logger),
+        authenticate_by_ip(INCORRECT, config.ip_whitelist),
+        session_middleware(redis_storage),
+        authenticate_by_staff_sso(client_session, redis_pool, config.staff_sso_base,
+                                  config.staff_sso_client_id,
+                                  config.staff_sso_client_secret),
+    ])
+
+    app.add_routes([
+        web.get(METRICS_PATH, handle_get_metrics(metrics_registry)),
+        web.delete(r'/{path:.*}', handle),
+        web.get(r'/{path:.*}', handle),
+        web.post(r'/{path:.*}', handle),
+        web.put(r'/{path:.*}', handle),
+        web.head(r'/{path:.*}', handle),
+    ])
+
+    class NullAccessLogger(aiohttp.abc.AbstractAccessLogger):
+        # pylint: disable=too-few-public-methods
+
+        # The parameters are aiohttp's, one of which shadows the time module
+        # pylint: disable=redefined-outer-name
+        def log(self, request, response, time):
+            pass
+
+    runner = web.AppRunner(app, access_log_class=NullAccessLogger)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', config.port)
+    await site.start()
+
+    return runner
+
+
+def handle_proxy(config, metrics, es_session):
+    es_endpoint = config.es_endpoint
+    response_cache_get, response_cache_set = response_cache(
+        config.response_cache.max_bytes,
+        metrics['elasticsearch_proxy_response_cache_size_bytes'],
+    )
 
     async def handle(request):
         url = request.url.with_scheme(es_endpoint['protocol']) \
                          .with_host(es_endpoint['host']) \
                          .with_port(int(es_endpoint['port']))
-        request_body = await request.read()
         source_headers = {
             header: request.headers[header]
             for header in ['Kbn-Version', 'Content-Type']
             if header in request.headers
         }
-        auth_headers = aws_auth_headers(
-            'es', es_endpoint, request.method, request.path,
-            dict(request.query), source_headers, request_body,
-        )
 
-        with logged(
-            request['logger'], 'Elasticsearch request by (%s)/(%s) to (%s) (%s) (%s)', [
-                request['me_profile']['email'], es_endpoint['access_key_id'],
-                request.method, str(url), request_body,
-            ],
-        ):
-            async with client_session.request(
-                request.method, str(url), data=request_body,
-                headers={**source_headers, **auth_headers}
-            ) as response:
-                response_body = await response.read()
+        # The signature needs the hash of the body before it's sent, so the body is hashed as
+        # it's read, and kept in a file if it's too large for memory
+        with tempfile.SpooledTemporaryFile(max_size=PROXY_MAX_IN_MEMORY_BODY) as request_body:
+            request_body_hash = hashlib.sha256()
+            async for chunk in request.content.iter_chunked(PROXY_CHUNK_SIZE):
+                request_body_hash.update(chunk)
+                request_body.write(chunk)
+            request_body_length = request_body.tell()
+            request_body_logged = \
+                request_body_readall(request_body) \
+                if request_body_length <= PROXY_MAX_LOGGED_BODY else \
+                f'{request_body_length} bytes'
+
+            # The body is only parsed for its indexes if it's in memory
+            cache_seconds = get_response_cache_seconds(
+                config.response_cache, request.method, request.path,
+                request_body_readall(request_body)
+                if request_body_length <= PROXY_MAX_IN_MEMORY_BODY else
+                None,
+            )
+            request_body.seek(0)
+            cache_key = (request.method, request.path, request.query_string,
+                         request_body_hash.hexdigest())
+            cached = response_cache_get(cache_key) if cache_seconds else None
+            metrics['elasticsearch_proxy_response_cache_requests_total'].labels(
+                'bypass' if not cache_seconds else
+                'hit' if cached is not None else
+                'miss'
+            ).inc()
+            if cached is not None:
+                return web.Response(status=cached.status, headers=cached.headers,
+                                    body=cached.body)
+
+            with metrics['elasticsearch_request_signing_duration_seconds'] \
+                    .labels('success').time():
+                auth_headers = aws_auth_headers_payload_hash(
+                    'es', es_endpoint, request.method, request.path,
+                    dict(request.query), source_headers, request_body_hash.hexdigest(),
+                )
+
+            with logged(
+                request['logger'], 'Elasticsearch request by (%s)/(%s) to (%s) (%s) (%s)', [
+                    request['me_profile']['email'], es_endpoint['access_key_id'],
+                    request.method, str(url), request_body_logged,
+                ],
+            ):
+                async with es_session.request(
+                    request.method, str(url), data=request_body_chunks(request_body),
+                    headers={
+                        **source_headers, **auth_headers,
+                        'Content-Length': str(request_body_length),
+                    }
+                ) as response:
+                    downstream_headers = {
+                        header: value
+                        for header, value in response.headers.items()
+                        if header.lower() not in HOP_BY_HOP_HEADERS
+                    }
+                    downstream_response = web.StreamResponse(status=response.status,
+                                                             headers=downstream_headers)
+                    await downstream_response.prepare(request)
+
+                    # Kept while streaming if the response might be cached, up to a limit
+                    is_cacheable = cache_seconds > 0 and response.status == 200
+                    cache_chunks = []
+                    cache_bytes = 0
+                    async for chunk in response.content.iter_chunked(PROXY_CHUNK_SIZE):
+                        await downstream_response.write(chunk)
+                        cache_bytes += len(chunk)
+                        is_cacheable = \
+                            is_cacheable and cache_bytes <= RESPONSE_CACHE_MAX_ENTRY_BYTES
+                        if is_cacheable:
+                            cache_chunks.append(chunk)
+                    await downstream_response.write_eof()
+
+                    if is_cacheable:
+                        response_cache_set(cache_key, cache_seconds, CachedResponse(
+                            status=response.status, headers=downstream_headers,
+                            body=b''.join(cache_chunks),
+                        ))
+
+        return downstream_response
+
+    return handle
+
+
+def handle_get_metrics(metrics_registry):
+    async def handle(_):
+        return web.Response(body=generate_latest(metrics_registry), status=200, headers={
+            'Content-Type': 'text/plain; charset=utf-8',
+        })
+
+    return handle
+
+
+def get_metrics(registry, metrics_conf):
+    return {
+        # The metric classes are constructed via decorators which
+        # result in pylint giving a false positive
+        # pylint: disable=unexpected-keyword-arg
+        name: metric_class(name, description, labels, registry=registry,
+                           **(optional[0] if optional else {}))
+        for metric_class, name, description, labels, *optional in metrics_conf
+    }
+
+
+def parse_proxy_config(env):
+    es_endpoint, redis_uri, _ = get_common_config(env)
+    return ProxyConfig(
+        port=env['PORT'],
+        ip_whitelist=env['INCOMING_IP_WHITELIST'],
+        staff_sso_base=env['STAFF_SSO_BASE'],
+        staff_sso_client_id=env['STAFF_SSO_CLIENT_ID'],
+        staff_sso_client_secret=env['STAFF_SSO_CLIENT_SECRET'],
+        es_endpoint=es_endpoint,
+        redis_uri=redis_uri,
+        response_cache=parse_response_cache_config(env),
+    )
+
+
+def parse_response_cache_config(env):
+    response_cache_env = env.get('RESPONSE_CACHE', {})
+    return ResponseCacheConfig(
+        seconds=int(response_cache_env.get('SECONDS', '0')),
+        max_bytes=int(response_cache_env.get('MAX_BYTES', RESPONSE_CACHE_MAX_BYTES)),
+        index_seconds=[
+            (index['PATTERN'], int(index['SECONDS']))
+            for index in response_cache_env.get('INDEXES', [])
+        ],
+    )
+
+
+def get_response_cache_seconds(config, method, path, body):
+    ''' The number of seconds to cache the response to a request for, 0 if not cached. Not
+    cached if the indexes it searches can't be determined, or could include Kibana's own '''
+    path_parts = path.strip('/').split('/')
+    if path_parts[:len(KIBANA_ES_PATH_PARTS)] == KIBANA_ES_PATH_PARTS:
+        path_parts = path_parts[len(KIBANA_ES_PATH_PARTS):]
+    if method not in RESPONSE_CACHE_METHODS or path_parts[-1] not in RESPONSE_CACHE_ENDPOINTS:
+        return 0
+
+    indexes = get_searched_indexes(path_parts, body)
+    if not indexes or any(
+            index == '_all' or
+            index.startswith(KIBANA_INDEX) or
+            fnmatch.fnmatchcase(KIBANA_INDEX, index)
+            for index in indexes
+    ):
+        return 0
+
+    return min(
+        next((
+            seconds
+            for pattern, seconds in config.index_seconds
+            if fnmatch.fnmatchcase(index, pattern)
+        ), config.seconds)
+        for index in indexes
+    )
+
+
+def get_searched_indexes(path_parts, body):
+    ''' The indexes a _search or _msearch searches, or an empty list if they can't be
+    determined. Each search in an _msearch can name its indexes in its header line, and
+    otherwise searches the indexes in the path '''
+    path_indexes = path_parts[0].split(',') if len(path_parts) == 2 else []
+    if path_parts[-1] == '_search':
+        return path_indexes
+
+    try:
+        lines = [json.loads(line) for line in (body or b'').splitlines() if line.strip()]
+    except ValueError:
+        return []
+    headers = lines[0::2]
+    if not headers or not all(isinstance(header, dict) for header in headers):
+        return []
+
+    searches_indexes = [
+        header.get('index', path_indexes)
+        for header in headers
+    ]
+    searches_indexes = [
+        index.split(',') if isinstance(index, str) else index
+        for index in searches_indexes
+    ]
+    if not all(isinstance(indexes, list) and indexes for indexes in searches_indexes):
+        return []
+
+    return [
+        index
+        for indexes in searches_indexes
+        for index in indexes
+    ]
+
+
+def request_body_readall(request_body):
+    request_body.seek(0)
+    return request_body.read()
+
+
+async def request_body_chunks(request_body):
+    while True:
+        chunk = request_body.read(PROXY_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+def expiring_cache(seconds):
+    ''' An in-memory cache whose entries expire after `seconds`. Expired entries are removed
+    at most every `seconds`, so it doesn't grow with entries that are never looked up again '''
+    entries = {}
+    next_prune = [0]
+
+    def get(key):
+        now = time.monotonic()
+        if now >= next_prune[0]:
+            for expired_key in [
+                    entry_key for entry_key, (expires, _) in entries.items() if expires <= now
+            ]:
+                del entries[expired_key]
+            next_prune[0] = now + seconds
+
+        expires, value = entries.get(key, (0, None))
+        return value if expires > now else None
+
+    def set_(key, value):
+        entries[key] = (time.monotonic() + seconds, value)
+
+    def delete(key):
+        entries.pop(key, None)
+
+    return get, set_, delete
+
+
+def response_cache(max_bytes, size_gauge):
+    ''' An in-memory cache of responses, each with its own expiry, that evicts the least
+    recently used responses to keep their total size under `max_bytes` '''
+    entries = collections.OrderedDict()
+    total_bytes = [0]
+
+    def delete(key):
+        _, response = entries.pop(key)
+        total_bytes[0] -= len(response.body)
+
+    def get(key):
+        expires, response = entries.get(key, (0, None))
+        if response is None:
+            return None
+
+        if expires <= time.monotonic():
+            delete(key)
+            size_gauge.set(total_bytes[0])
+            return None
+
+        # Re-inserted to be the most recently used
+        entries[key] = entries.pop(key)
+        return response
+
+    def set_(key, seconds, response):
+        if key in entries:
+            delete(key)
+        entries[key] = (time.monotonic() + seconds, response)
+        total_bytes[0] += len(response.body)
+        while total_bytes[0] > max_bytes:
+            delete(next(iter(entries)))
+        size_gauge.set(total_bytes[0])
+
+    return get, set_
+
+
+class CachedRedisStorage(RedisStorage):
+    ''' Loads each session from Redis at most once every SESSION_CACHE_SECONDS per instance. A
+    session is saved to Redis as usual, and removed from the cache, when it's changed '''
+
+    def __init__(self, redis_pool, **kwargs):
+        super().__init__(redis_pool, **kwargs)
+        self._cache_get, self._cache_set, self._cache_delete = \
+            expiring_cache(SESSION_CACHE_SECONDS)
+
+    async def load_session(self, request):
+        cookie = self.load_cookie(request)
+        data = self._cache_get(cookie) if cookie is not None else None
+        if data is not None:
+            return Session(cookie, data=data, new=False, max_age=self.max_age)
 
-        return web.Response(status=response.status, body=response_body, headers=response.headers)
+        session = await super().load_session(request)
+        if session.identity is not None:
+            # Copied, since the session's mapping is changed by the request that loaded it
+            data = self._get_session_data(session)
+            self._cache_set(session.identity, {**data, 'session': dict(data['session'])})
+        return session
 
-    redis_pool = await aioredis.create_pool(redis_uri)
-    redis_storage = RedisStorage(redis_pool, max_age=60*60*24)
+    async def save_session(self, request, response, session):
+        await super().save_session(request, response, session)
+        if session.identity is not None:
+            self._cache_delete(str(session.identity))
 
-    with logged(logger, 'Creating listening web application', []):
-        app = web.Application(middlewares=[
-            server_logger(logger),
-            authenticate_by_ip(INCORRECT, ip_whitelist),
-            session_middleware(redis_storage),
-            authenticate_by_staff_sso(client_session, staff_sso_client_base,
-                                      staff_sso_client_id, staff_sso_client_secret),
-        ])
 
-        app.add_routes([
-            web.delete(r'/{path:.*}', handle),
-            web.get(r'/{path:.*}', handle),
-            web.post(r'/{path:.*}', handle),
-            web.put(r'/{path:.*}', handle),
-            web.head(r'/{path:.*}', handle),
-        ])
+def staff_sso_me_profile_cache(client_session, redis_pool, base):
+    ''' Fetches the Staff SSO profile of a token, cached in memory and in Redis, so it's fetched
+    from Staff SSO at most once every ME_PROFILE_REDIS_CACHE_SECONDS across instances '''
+
+    me_path = '/api/v1/user/me/'
+
+    me_profile_cache_get, me_profile_cache_set, me_profile_cache_delete = \
+        expiring_cache(ME_PROFILE_MEMORY_CACHE_SECONDS)
+
+    def me_profile_redis_key(token):
+        # Tokens are secret, so aren't stored in Redis as-is
+        return 'staff-sso-me-profile-' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    async def get_me_profile(token):
+        me_profile = me_profile_cache_get(token)
+        if me_profile is not None:
+            return me_profile
 
-        class NullAccessLogger(aiohttp.abc.AbstractAccessLogger):
-            # pylint: disable=too-few-public-methods
+        redis_key = me_profile_redis_key(token)
+        me_profile_json = await redis_pool.execute('GET', redis_key)
+        if me_profile_json is not None:
+            me_profile = json.loads(me_profile_json)
+        else:
+            async with client_session.get(f'{base}{me_path}', headers={
+                'Authorization': f'Bearer {token}'
+            }) as me_response:
+                if me_response.status != 200:
+                    return None
+                me_profile = await me_response.json()
+            await redis_pool.execute('SET', redis_key, json.dumps(me_profile),
+                                     'EX', ME_PROFILE_REDIS_CACHE_SECONDS)
 
-            def log(self, request, response, time):
-                pass
+        me_profile_cache_set(token, me_profile)
+        return me_profile
 
-        runner = web.AppRunner(app, access_log_class=NullAccessLogger)
-        await runner.setup()
-        site = web.TCPSite(runner, '0.0.0.0', port)
-        await site.start()
+    async def revoke_me_profile(token):
+        me_profile_cache_delete(token)
+        await redis_pool.execute('DEL', me_profile_redis_key(token))
 
+    return get_me_profile, revoke_me_profile
 
-def authenticate_by_staff_sso(client_session, base, client_id, client_secret):
+
+def authenticate_by_staff_sso(client_session, redis_pool, base, client_id, client_secret):
 
     auth_path = '/o/authorize/'
     token_path = '/o/token/'
-    me_path = '/api/v1/user/me/'
     grant_type = 'authorization_code'
     scope = 'read write'
     response_type = 'code'
 
     redirect_from_sso_path = '/__redirect_from_sso'
+    sign_out_path = '/__sign_out'
     session_token_key = 'staff_sso_access_token'
 
+    get_me_profile, revoke_me_profile = \
+        staff_sso_me_profile_cache(client_session, redis_pool, base)
+
     def get_redirect_uri_authenticate(session, request):
         state = secrets.token_urlsafe(32)
         set_redirect_uri_final(session, state, request)
@@ -143,8 +573,17 @@ def authenticate_by_staff_sso(client_session, base, client_id, client_secret):
 
     @web.middleware
     async def _authenticate_by_sso(request, handler):
+        if request.path == METRICS_PATH and request.method in ('GET', 'HEAD'):
+            return await handler(request)
+
         session = await get_session(request)
 
+        if request.path == sign_out_path:
+            token = session.pop(session_token_key, None)
+            if token is not None:
+                await revoke_me_profile(token)
+            return web.Response(status=200, text='Signed out')
+
         if request.path != redirect_from_sso_path and session_token_key not in session:
             return web.Response(status=302, headers={
                 'Location': get_redirect_uri_authenticate(session, request),
@@ -166,15 +605,11 @@ def authenticate_by_staff_sso(client_session, base, client_id, client_secret):
             session[session_token_key] = (await sso_response.json())['access_token']
             return web.Response(status=302, headers={'Location': redirect_uri_final})
 
-        token = session[session_token_key]
-        async with client_session.get(f'{base}{me_path}', headers={
-            'Authorization': f'Bearer {token}'
-        }) as me_response:
-            me_profile = await me_response.json()
+        me_profile = await get_me_profile(session[session_token_key])
 
         request['me_profile'] = me_profile
         return \
-            await handler(request) if me_response.status == 200 else \
+            await handler(request) if me_profile is not None else \
             web.Response(status=302, headers={
                 'Location': get_redirect_uri_authenticate(session, request),
             })
@@ -183,14 +618,30 @@ def authenticate_by_staff_sso(client_session, base, client_id, client_secret):
 
 
 def main():
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    app_logger = logging.getLogger('activity-stream')
-    app_logger.setLevel(logging.DEBUG)
-    app_logger.addHandler(stdout_handler)
+    env = normalise_environment(os.environ)
+    _, log_listener = configure_root_logger(
+        env.get('LOG_LEVEL', 'DEBUG'), float(env.get('LOG_DEBUG_SAMPLE_RATE', '1')),
+    )
+    trace_listener = \
+        configure_tracing(env['TRACE_FILE'], float(env.get('TRACE_SAMPLE_RATE', '1'))) if \
+        'TRACE_FILE' in env else \
+        None
 
     loop = asyncio.get_event_loop()
-    loop.create_task(run_application())
+    cleanup = loop.run_until_complete(run_application())
+
+    async def cleanup_then_stop_loop():
+        await cleanup()
+        asyncio.get_event_loop().stop()
+        return 'anything-to-avoid-pylint-assignment-from-none-error'
+
+    cleanup_then_stop = cleanup_then_stop_loop()
+    loop.add_signal_handler(signal.SIGINT, loop.create_task, cleanup_then_stop)
+    loop.add_signal_handler(signal.SIGTERM, loop.create_task, cleanup_then_stop)
     loop.run_forever()
+    log_listener.stop()
+    if trace_listener is not None:
+        trace_listener.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,64 @@
+import aiohttp
+from prometheus_client import (
+    Counter,
+    Histogram,
+)
+
+# Connections to Elasticsearch are kept alive and reused, rather than each request
+# paying for a new TCP and TLS handshake. The host is resolved at most once per
+# ES_DNS_CACHE_TTL seconds, so a change of the addresses behind it is still picked up
+ES_CONNECTIONS_LIMIT = 100
+ES_CONNECTIONS_LIMIT_PER_HOST = 20
+ES_KEEPALIVE_TIMEOUT = 30
+ES_DNS_CACHE_TTL = 60
+
+SIGNING_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, float('inf'),
+)
+
+# Exported by incoming, outgoing, and the proxy, so each can be compared with the others
+METRICS_CONF_ES_SESSION = [
+    (Counter, 'elasticsearch_connections_total',
+     'The number of connections to Elasticsearch created, reused from the pool, or queued '
+     'waiting for a free connection',
+     ['event']),
+    (Counter, 'elasticsearch_dns_cache_total',
+     'The number of hits and misses of the cached DNS lookups of Elasticsearch',
+     ['result']),
+    (Histogram, 'elasticsearch_request_signing_duration_seconds',
+     'Time to sign a request to Elasticsearch in seconds',
+     ['status'], {'buckets': SIGNING_BUCKETS}),
+]
+
+
+def get_es_session(trace_configs, resolver=None, **session_kwargs):
+    connector = aiohttp.TCPConnector(
+        limit=ES_CONNECTIONS_LIMIT,
+        limit_per_host=ES_CONNECTIONS_LIMIT_PER_HOST,
+        keepalive_timeout=ES_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=ES_DNS_CACHE_TTL,
+        resolver=resolver,
+    )
+    return aiohttp.ClientSession(
+        connector=connector, trace_configs=trace_configs, **session_kwargs,
+    )
+
+
+def es_trace_config(metrics):
+    ''' Exports whether requests to Elasticsearch reuse pooled connections and cached DNS '''
+    def inc(metric_name, label):
+        async def _inc(*_):
+            metrics[metric_name].labels(label).inc()
+        return _inc
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(inc('elasticsearch_connections_total',
+                                                     'created'))
+    trace_config.on_connection_reuseconn.append(inc('elasticsearch_connections_total',
+                                                    'reused'))
+    trace_config.on_connection_queued_start.append(inc('elasticsearch_connections_total',
+                                                       'queued'))
+    trace_config.on_dns_cache_hit.append(inc('elasticsearch_dns_cache_total', 'hit'))
+    trace_config.on_dns_cache_miss.append(inc('elasticsearch_dns_cache_total', 'miss'))
+    return trace_config
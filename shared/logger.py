@@ -1,30 +1,192 @@
 import asyncio
 import contextlib
+import json
 import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import weakref
+
+# As the rest of the configuration of logging, these are process-wide
+_DEBUG_SAMPLE_RATE = {'rate': 1.0}
+_TRACING = {'export': None, 'sample_rate': 0.0}
+
+# The trace of each task, and the ids of its open spans. logged and metric_timer are not
+# passed the context, and each incoming request or ingest of a page is in a single task
+_TASK_TRACES = weakref.WeakKeyDictionary()
 
 
 class ContextAdapter(logging.LoggerAdapter):
     def process(self, msg, kwargs):
         return '[%s] %s' % (','.join(self.extra['context']), msg), kwargs
 
+    def isEnabledFor(self, level):
+        # Checked before a record is created, so unsampled debug logs cost very little. Each
+        # debug log is sampled on its own, unless the adapter has a sample point
+        sample_point = self.extra['sample_point']
+        return \
+            (level > logging.DEBUG or _DEBUG_SAMPLE_RATE['rate'] >= 1.0 or
+             (random.random() if sample_point is None else sample_point) <
+             _DEBUG_SAMPLE_RATE['rate']) \
+            and self.logger.isEnabledFor(level)
+
 
 def get_root_logger(context):
     logger = logging.getLogger('activity-stream')
-    return ContextAdapter(logger, {'context': [context]})
+    return ContextAdapter(logger, {'context': [context], 'sample_point': None})
 
 
 def get_child_logger(logger, child_context):
-    existing_context = logger.extra['context']
-    return ContextAdapter(logger.logger, {'context': existing_context + [child_context]})
+    return ContextAdapter(logger.logger, {
+        'context': logger.extra['context'] + [child_context],
+        'sample_point': logger.extra['sample_point'],
+    })
+
+
+def configure_root_logger(level, debug_sample_rate):
+    ''' Logs are formatted and written to stdout by a thread, so never block the event loop.
+    Stop the returned listener before exiting to flush any remaining logs '''
+    _DEBUG_SAMPLE_RATE['rate'] = debug_sample_rate
+
+    log_queue = queue.Queue()
+    queue_handler = _UnformattedQueueHandler(log_queue)
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+
+    app_logger = logging.getLogger('activity-stream')
+    app_logger.setLevel(level)
+    app_logger.addHandler(queue_handler)
+    listener.start()
+
+    return app_logger, listener
+
+
+def configure_tracing(trace_file, sample_rate):
+    ''' Exports a sample of traces to trace_file as JSON lines. Stop the returned listener
+    before exiting to flush any remaining spans '''
+    file_handler = logging.FileHandler(trace_file)
+    file_handler.setFormatter(_JsonLinesFormatter())
+    span_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(span_queue, file_handler)
+
+    spans_logger = logging.getLogger('activity-stream-spans')
+    spans_logger.propagate = False
+    spans_logger.setLevel(logging.INFO)
+    spans_logger.addHandler(_UnformattedQueueHandler(span_queue))
+    listener.start()
+
+    set_trace_exporter(spans_logger.info, sample_rate)
+    return listener
+
+
+def set_trace_exporter(export, sample_rate):
+    ''' export is called with a dict for each finished span, so can send spans anywhere '''
+    _TRACING['export'] = export
+    _TRACING['sample_rate'] = sample_rate
+
+
+@contextlib.contextmanager
+def traced(trace_id, name, attributes):
+    ''' Records the spans in the current task as a trace, if tracing and it's sampled '''
+    task = asyncio.Task.current_task()
+    if _TRACING['export'] is None or task is None or task in _TASK_TRACES or \
+            random.random() >= _TRACING['sample_rate']:
+        yield
+        return
+
+    _TASK_TRACES[task] = {'trace_id': trace_id, 'span_ids': []}
+    try:
+        with span(name, attributes):
+            yield
+    finally:
+        del _TASK_TRACES[task]
+
+
+def span(name, attributes):
+    # Not traced is by far the most common case, so it avoids creating a context manager
+    export = _TRACING['export']
+    task = asyncio.Task.current_task() if export is not None else None
+    trace = _TASK_TRACES.get(task) if task is not None else None
+    return \
+        _NOT_TRACED if trace is None else \
+        _traced_span(export, trace, name, attributes)
+
+
+@contextlib.contextmanager
+def _traced_span(export, trace, name, attributes):
+    span_ids = trace['span_ids']
+    span_id = '%016x' % random.getrandbits(64)
+    parent_id = span_ids[-1] if span_ids else None
+    span_ids.append(span_id)
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield
+        status = 'success'
+    except asyncio.CancelledError:
+        status = 'cancelled'
+        raise
+    except BaseException:
+        status = 'failure'
+        raise
+    finally:
+        end_counter = time.perf_counter()
+        span_ids.pop()
+        export({
+            'trace_id': trace['trace_id'],
+            'span_id': span_id,
+            'parent_id': parent_id,
+            'name': name,
+            'start': start_time,
+            'duration': end_counter - start_counter,
+            'status': status,
+            **attributes,
+        })
+
+
+class _NotTraced:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *_):
+        pass
+
+
+_NOT_TRACED = _NotTraced()
+
+
+class _JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        # Arguments of logged that aren't JSON serializable, e.g. bytes, are output as strings
+        return json.dumps(record.msg, default=str)
+
+
+class _UnformattedQueueHandler(logging.handlers.QueueHandler):
+    ''' The standard QueueHandler formats records before enqueueing them, so they can be
+    pickled. Since the queue is in-process, only the message is rendered, so later changes to
+    mutable arguments don't change it, and the more expensive formatting, including of any
+    traceback, is left to the listener's thread '''
+
+    def prepare(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
 
 
 @contextlib.contextmanager
 def logged(logger, message, logger_args):
+    # The start and end are sampled together, so a sampled action is logged as a pair
+    if _DEBUG_SAMPLE_RATE['rate'] < 1.0 and logger.extra['sample_point'] is None:
+        logger = ContextAdapter(logger.logger, {**logger.extra, 'sample_point': random.random()})
+
     try:
         logger.debug(message + '...', *logger_args)
         status = 'done'
         logger_func = logger.debug
-        yield
+        with span(message, {'context': logger.extra['context'], 'args': logger_args}):
+            yield
     except asyncio.CancelledError:
         status = 'cancelled'
         logger_func = logger.debug
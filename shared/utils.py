@@ -1,8 +1,10 @@
 import datetime
+import functools
 import hashlib
 import hmac
 import itertools
 import json
+import random
 import secrets
 import string
 import urllib
@@ -12,7 +14,19 @@ def random_url_safe(count):
     return ''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(count))
 
 
+def random_log_id():
+    ''' Only to distinguish the logs of concurrent requests, so doesn't need the
+    cryptographically secure, but much slower, random_url_safe '''
+    return '%08x' % random.getrandbits(32)
+
+
 def get_common_config(env):
+    # Optionally, several nodes that requests are spread over. The HOST and PORT are still
+    # required, and used where a single node is enough
+    es_nodes = env['ELASTICSEARCH'].get('NODES', [{
+        'HOST': env['ELASTICSEARCH']['HOST'],
+        'PORT': env['ELASTICSEARCH']['PORT'],
+    }])
     es_endpoint = {
         'host': env['ELASTICSEARCH']['HOST'],
         'access_key_id': env['ELASTICSEARCH']['AWS_ACCESS_KEY_ID'],
@@ -24,6 +38,13 @@ def get_common_config(env):
             env['ELASTICSEARCH']['HOST'] + ':' + env['ELASTICSEARCH']['PORT']
         ),
         'port': env['ELASTICSEARCH']['PORT'],
+        'nodes': [{
+            'host': es_node['HOST'],
+            'port': es_node['PORT'],
+            'base_url': (
+                env['ELASTICSEARCH']['PROTOCOL'] + '://' + es_node['HOST'] + ':' + es_node['PORT']
+            ),
+        } for es_node in es_nodes],
     }
     redis_uri = json.loads(env['VCAP_SERVICES'])['redis'][0]['credentials']['uri']
     sentry = {
@@ -138,11 +159,17 @@ def normalise_environment(key_values):
 
 
 def aws_auth_headers(service, endpoint, method, path, query, headers, payload):
+    return aws_auth_headers_payload_hash(service, endpoint, method, path, query, headers,
+                                         hashlib.sha256(payload).hexdigest())
+
+
+def aws_auth_headers_payload_hash(service, endpoint, method, path, query, headers,
+                                  payload_hash):
+    ''' For payloads that are hashed as they are read, rather than held in memory '''
     algorithm = 'AWS4-HMAC-SHA256'
 
-    now = datetime.datetime.utcnow()
-    amzdate = now.strftime('%Y%m%dT%H%M%SZ')
-    datestamp = now.strftime('%Y%m%d')
+    amzdate = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    datestamp = amzdate[:8]
     credential_scope = f'{datestamp}/{endpoint["region"]}/{service}/aws4_request'
     headers_lower = {
         header_key.lower().strip(): header_value.strip()
@@ -170,23 +197,16 @@ def aws_auth_headers(service, endpoint, method, path, query, headers, payload):
                 header_key + ':' + header_values[header_key] + '\n'
                 for header_key in signed_header_keys
             ])
-            payload_hash = hashlib.sha256(payload).hexdigest()
-
             return f'{method}\n{canonical_uri}\n{canonical_querystring}\n' + \
                    f'{canonical_headers}\n{signed_headers}\n{payload_hash}'
 
-        def sign(key, msg):
-            return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
-
         string_to_sign = \
             f'{algorithm}\n{amzdate}\n{credential_scope}\n' + \
             hashlib.sha256(canonical_request().encode('utf-8')).hexdigest()
 
-        date_key = sign(('AWS4' + endpoint['secret_key']).encode('utf-8'), datestamp)
-        region_key = sign(date_key, endpoint['region'])
-        service_key = sign(region_key, service)
-        request_key = sign(service_key, 'aws4_request')
-        return sign(request_key, string_to_sign).hex()
+        request_key = aws_signing_key(endpoint['secret_key'], datestamp, endpoint['region'],
+                                      service)
+        return aws_sign(request_key, string_to_sign).hex()
 
     return {
         'x-amz-date': amzdate,
@@ -195,3 +215,16 @@ def aws_auth_headers(service, endpoint, method, path, query, headers, payload):
             f'SignedHeaders={signed_headers}, Signature=' + signature()
         ),
     }
+
+
+@functools.lru_cache(maxsize=16)
+def aws_signing_key(secret_key, datestamp, region, service):
+    ''' The signing key only changes daily, so is derived once rather than on every request '''
+    date_key = aws_sign(('AWS4' + secret_key).encode('utf-8'), datestamp)
+    region_key = aws_sign(date_key, region)
+    service_key = aws_sign(region_key, service)
+    return aws_sign(service_key, 'aws4_request')
+
+
+def aws_sign(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
@@ -3,9 +3,10 @@ from aiohttp import web
 from .logger import (
     get_child_logger,
     logged,
+    traced,
 )
 from .utils import (
-    random_url_safe,
+    random_log_id,
 )
 
 
@@ -13,7 +14,8 @@ def server_logger(logger):
 
     @web.middleware
     async def _server_logger(request, handler):
-        child_logger = get_child_logger(logger, random_url_safe(8))
+        request_id = random_log_id()
+        child_logger = get_child_logger(logger, request_id)
         request['logger'] = child_logger
         child_logger.debug('Receiving request (%s) (%s %s HTTP/%s.%s) (%s) (%s)', *(
             (
@@ -28,7 +30,10 @@ def server_logger(logger):
             )
         ))
 
-        with logged(child_logger, 'Processing request', []):
+        # The trace id is the same as in the logs, so they can be found from each other
+        with \
+                traced(request_id, 'Request', {'method': request.method, 'path': request.path}), \
+                logged(child_logger, 'Processing request', []):
             response = await handler(request)
 
         child_logger.debug(
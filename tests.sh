@@ -9,4 +9,5 @@ SITE_PACKAGES_DIR=$(python -c "import site; print(site.getsitepackages()[0])")
 echo "import coverage; coverage.process_startup()" > "${SITE_PACKAGES_DIR}/coverage.pth"
 export COVERAGE_PROCESS_START=.coveragerc
 cp -r -f shared core
-python -m unittest -v
+# The proxy's tests are run separately, with its own requirements
+python -m unittest discover -v -s core -t .
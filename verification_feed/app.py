@@ -4,8 +4,11 @@ from datetime import (
     timedelta,
     timezone,
 )
+import functools
+import json
 import logging
 import os
+import random
 import sys
 
 from aiohttp import web
@@ -19,25 +22,55 @@ async def run_application():
 
     app_logger.debug('Examining environment...')
     port = os.environ['PORT']
+    config = get_config(os.environ)
     app_logger.debug('Examining environment: done')
 
-    await create_incoming_application(port)
+    await create_incoming_application(port, config)
 
 
-async def create_incoming_application(port):
+def get_config(environ):
+    ''' By default, one small activity a second for the past 24 hours, in pages of 1000. The
+    other settings allow the feed to be used as a source of load, up to and beyond that of
+    production, without being the bottleneck itself '''
+    return {
+        'seconds': int(environ.get('ACTIVITIES_SECONDS', 60 * 60 * 24)),
+        'per_second': int(environ.get('ACTIVITIES_PER_SECOND', 1)),
+        'page_size': int(environ.get('PAGE_SIZE', 1000)),
+        'payload_bytes': int(environ.get('PAYLOAD_BYTES', 0)),
+        'payload_fields': int(environ.get('PAYLOAD_FIELDS', 1)),
+        'latency_seconds': float(environ.get('LATENCY_SECONDS', 0)),
+        'too_many_requests_rate': float(environ.get('TOO_MANY_REQUESTS_RATE', 0)),
+        'page_cache_size': int(environ.get('PAGE_CACHE_SIZE', 1024)),
+    }
+
+
+async def create_incoming_application(port, config):
     app_logger = logging.getLogger(LOGGER_NAME)
 
+    # Every crawl after the first requests the same pages, so their bodies are cached
+    get_page_body = functools.lru_cache(maxsize=config['page_cache_size'])(
+        functools.partial(get_page_body_uncached, get_payload(config)),
+    )
+
     async def handle(request):
-        timestamp = int(request.match_info['timestamp'])
+        if config['latency_seconds']:
+            await asyncio.sleep(config['latency_seconds'])
 
-        def get_next_page_href(next_timestamp):
+        if random.random() < config['too_many_requests_rate']:
+            return web.Response(status=429, headers={'Retry-After': '1'})
+
+        index = int(request.match_info['index'])
+
+        def get_next_page_href(next_index):
             return str(request.url.with_scheme(request.headers.get(
-                'X-Forwarded-Proto', 'http')).with_path(f'/{next_timestamp}'))
-        return web.json_response(get_page(timestamp, get_next_page_href))
+                'X-Forwarded-Proto', 'http')).with_path(f'/{next_index}'))
+
+        return web.Response(body=get_page(config, get_page_body, index, get_next_page_href),
+                            content_type='application/json')
 
     app_logger.debug('Creating listening web application...')
     app = web.Application()
-    app.add_routes([web.get(r'/{timestamp:\d+}', handle)])
+    app.add_routes([web.get(r'/{index:\d+}', handle)])
 
     access_log_format = '%a %t "%r" %s %b "%{Referer}i" "%{User-Agent}i" %{X-Forwarded-For}i'
     runner = web.AppRunner(app, access_log_format=access_log_format)
@@ -58,20 +91,40 @@ def setup_logging():
     app_logger.addHandler(stdout_handler)
 
 
-def get_page(timestamp, get_next_page_href):
-    ''' Creates dummy activities where one has been created every second for the past 24 hours'''
-    now = datetime.now(timezone.utc).replace(microsecond=0)
-    one_day_ago = now - timedelta(hours=24)
+def get_payload(config):
+    ''' The extra data of each activity, built once since it's the same for all of them '''
+    num_fields = config['payload_fields']
+    bytes_per_field = config['payload_bytes'] // num_fields if num_fields else 0
+    return {
+        f'dit:activityStreamVerificationFeedPayload{field}': 'x' * bytes_per_field
+        for field in range(0, num_fields if bytes_per_field else 0)
+    }
+
 
-    first_timestamp = int(one_day_ago.timestamp())
+def get_page(config, get_page_body, index, get_next_page_href):
+    ''' Activities have been created at `per_second` a second for the past `seconds`. An
+    activity's index is its creation timestamp multiplied by `per_second`, plus its position
+    within that second, so by default its index is its timestamp '''
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    first_timestamp = int((now - timedelta(seconds=config['seconds'])).timestamp())
     final_timestamp = int(now.timestamp())
 
-    max_per_page = 1000
-    first_timestamp_of_page = max(first_timestamp, timestamp)
-    final_timestamp_of_page = min(first_timestamp_of_page + max_per_page, final_timestamp)
-    timestamps = range(first_timestamp_of_page, final_timestamp_of_page)
+    first_index = first_timestamp * config['per_second']
+    final_index = final_timestamp * config['per_second']
 
-    return {
+    first_index_of_page = max(first_index, index)
+    final_index_of_page = min(first_index_of_page + config['page_size'], final_index)
+    next_href = \
+        get_next_page_href(final_index_of_page) if final_index_of_page > first_index_of_page else \
+        None
+
+    return get_page_body(config['per_second'], first_index_of_page, final_index_of_page,
+                         next_href)
+
+
+def get_page_body_uncached(payload, per_second, first_index_of_page, final_index_of_page,
+                           next_href):
+    return json.dumps({
         '@context': [
             'https://www.w3.org/ns/ettystreams',
             {
@@ -95,17 +148,18 @@ def get_page(timestamp, get_next_page_href):
                         'Document',
                         'dit:activityStreamVerificationFeed:Verifier'
                     ],
-                    'url': f'https://activitystream.uktrade.io/activities/{activity_id}'
+                    'url': f'https://activitystream.uktrade.io/activities/{activity_id}',
+                    **payload,
                 },
-                'published': datetime.utcfromtimestamp(timestamp).isoformat(),
+                'published': datetime.utcfromtimestamp(index // per_second).isoformat(),
                 'type': 'Create'
             }
-            for timestamp in timestamps
-            for activity_id in [str(timestamp)]
+            for index in range(first_index_of_page, final_index_of_page)
+            for activity_id in [str(index)]
         ],
         'type': 'Collection',
-        **({'next': get_next_page_href(final_timestamp_of_page)} if timestamps else {}),
-    }
+        **({'next': next_href} if next_href is not None else {}),
+    }).encode('utf-8')
 
 
 def main():